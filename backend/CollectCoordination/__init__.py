@@ -1,19 +1,18 @@
 import logging
 import azure.functions as func
-import os
-from azure.data.tables import TableClient, UpdateMode
 import json
 import uuid
-import requests
+from shared_code import gps_filter, ingest, partitions
+from shared_code.instrumentation import instrument, log_payloads
+from shared_code.route_codec import merge_points
+from shared_code.tables import STORAGE_CONFIGURED
 
-CONNECTION_STRING = os.getenv('AzureWebJobsStorage')
-CREATE_HEATMAP_URL = "https://assignment1-sophie-miki-omer.azurewebsites.net/api/CreateHeatMap"
-
-def main(req: func.HttpRequest) -> func.HttpResponse:
+@instrument
+def main(req: func.HttpRequest, msg: func.Out[str]) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request to collect coordination.')
 
     try:
-        if not CONNECTION_STRING:
+        if not STORAGE_CONFIGURED:
             logging.error("AzureWebJobsStorage environment variable is not set.")
             return func.HttpResponse("Internal Server Error", status_code=500)
 
@@ -25,84 +24,105 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
         partition_key = req_body.get('partition_key')
         if not partition_key:
-            partition_key = "Tel Aviv"
-        index = req_body.get('index')
+            partition_key = partitions.DEFAULT_CITY
         finish_status = req_body.get('finish_status')
-        data = req_body.get('data')
-        logging.info(f"request from front is {req_body}")
+        if isinstance(finish_status, dict):
+            # The app sends its React ref, {"current": <bool>}
+            finish_status = finish_status.get('current')
+        # Also store the unfiltered samples of the route, for debugging the GPS filter
+        keep_raw = bool(req_body.get('keep_raw', gps_filter.KEEP_RAW))
+        if log_payloads():
+            logging.info(f"request from front is {req_body}")
         logging.info(f"partition_key is {partition_key}")
 
-        if index is None or data is None:
-            return func.HttpResponse("Name, index, and data are required.", status_code=400)
+        # A request carries either a single point (index + data) or a batch of indexed points
+        try:
+            points = parse_points(req_body)
+        except ValueError as e:
+            return func.HttpResponse(str(e), status_code=400)
+
+        indexes = [point[0] for point in points]
+        name = req_body.get('row_key')
+        # Generate a unique name using UUID when a new route starts
+        if 0 in indexes and (not name or 'points' not in req_body):
+            name = f"route{uuid.uuid4()}"
+        if not name:
+            return func.HttpResponse("Name is required for non-zero index.", status_code=400)
 
-        coord = data.get('coordination')
-        if not coord or 'latitude' not in coord or 'longitude' not in coord:
-            return func.HttpResponse("Coordination data is missing or incomplete.", status_code=400)
+        # A route is stored in the partition of its start, the app sends it back with the next points
+        if 0 in indexes:
+            partition_key = partitions.route_partition(partition_key, points[0][1], points[0][2])
 
-        latitude = coord['latitude']
-        longitude = coord['longitude']
+        logging.info(f"name is {name} and indexes are {indexes}")
+        last_index = max(indexes)
+        finish = finish_status and last_index != 0
 
-        # Generate a unique name using UUID if index is 0
-        if index == 0:
-            name = f"route{uuid.uuid4()}"
-        else:
-            name = req_body.get('row_key')
-            if not name:
-                return func.HttpResponse("Name is required for non-zero index.", status_code=400)
-
-        logging.info(f"name is {name} and index is {index}")
-        # Connect to the tables
-        route_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='RoutesCordinations')
-        coord_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='AllRouteCoordinations')
-
-        # Add or update the route entity in RoutesCordinations
-        if index == 0:
-            route_entity = {
-                'PartitionKey': partition_key,
-                'RowKey': name,
-                'start_cord_latitude': latitude,
-                'start_cord_longitude': longitude
-            }
-            logging.info(f"start route_table with {route_entity}")
-            route_table.create_entity(entity=route_entity)
-            logging.info(f"end route_table with {route_entity}")
-            # Also create the initial entity in AllRouteCoordinations
-            coord_entity = {'PartitionKey': partition_key, 'RowKey': name}
-            coord_entity[f'Coord{index}_Lat'] = latitude
-            coord_entity[f'Coord{index}_Lon'] = longitude
-            logging.info(f"start coord_entity update with {coord_entity}")
-            coord_table.create_entity(entity=coord_entity)
-            logging.info(f"end coord_entity update with {coord_entity}")
-        else:
-            if finish_status:
-                try:
-                    logging.info(f"start route_table after finish with {partition_key} and {name}")
-                    route_entity = route_table.get_entity(partition_key=partition_key, row_key=name)
-                    route_entity['end_cord_latitude'] = latitude
-                    route_entity['end_cord_longitude'] = longitude
-                    logging.info(f"start update route_table after finish with {partition_key} and {name}")
-                    route_table.update_entity(entity=route_entity, mode=UpdateMode.REPLACE)
-                    logging.info(f"finish update route_table after finish with {partition_key} and {name}")
-                except Exception as e:
-                    logging.error(f"Error updating route entity: {e}")
-                    return func.HttpResponse("Error updating route entity", status_code=500)
-
-            # Add coordinates to AllRouteCoordinations
-            try:
-                coord_entity = coord_table.get_entity(partition_key=partition_key, row_key=name)
-            except:
-                coord_entity = {
-                    'PartitionKey': partition_key,
-                    'RowKey': name
-                }
+        # In queue mode the points are written in the background by ProcessRoutePoints. The answer
+        # stays 200, app versions treating any other status as a failure remove the route.
+        if ingest.use_queue():
+            msg.set(ingest.build_message(partition_key, name, points, finish, keep_raw))
+            return func.HttpResponse(json.dumps({"row_key": name, "partition_key": partition_key, "index": last_index}), status_code=200, mimetype="application/json")
 
-            coord_entity[f'Coord{index}_Lat'] = latitude
-            coord_entity[f'Coord{index}_Lon'] = longitude
-            coord_table.upsert_entity(entity=coord_entity)
+        # Add the route entity and the points to the tables
+        ingest.write_points(partition_key, name, points, finish, keep_raw)
 
+        result = {"row_key": name, "partition_key": partition_key, "index": last_index}
+        if finish:
+            try:
+                match = ingest.finish_route(partition_key, name, points[-1])
+            except Exception as e:
+                logging.error(f"Error updating route entity: {e}")
+                return func.HttpResponse("Error updating route entity", status_code=500)
+            # The run follows a route of the catalog and was attached to it
+            if match:
+                result["matched_route"] = {"partition_key": match[0], "row_key": match[1]}
 
-        return func.HttpResponse(json.dumps({"row_key": name, "partition_key": partition_key, "index": index}), status_code=200, mimetype="application/json")
+        return func.HttpResponse(json.dumps(result), status_code=200, mimetype="application/json")
 
     except Exception as e:
         logging.error(f"Error processing the request: {e}")
         return func.HttpResponse(f"Something went wrong: {e}", status_code=500)
+
+
+def parse_points(req_body):
+    """Return the (index, latitude, longitude, timestamp) points of a single point or batch request.
+
+    A batch request has a ``points`` list whose items hold an ``index`` and a
+    ``coordination`` (or ``data.coordination``) like the single point request,
+    and optionally the ``timestamp`` of the fix in epoch milliseconds.
+    Raises ValueError with a message suitable for a 400 response.
+    """
+    raw_points = req_body.get('points')
+    if raw_points is None:
+        if req_body.get('index') is None or req_body.get('data') is None:
+            raise ValueError("Name, index, and data are required.")
+        raw_points = [{'index': req_body.get('index'), 'data': req_body.get('data'),
+                       'timestamp': req_body.get('timestamp')}]
+    elif not isinstance(raw_points, list) or not raw_points:
+        raise ValueError("points must be a non-empty list.")
+
+    points = []
+    for raw_point in raw_points:
+        if not isinstance(raw_point, dict):
+            raise ValueError("Every point must be an object.")
+        coord = raw_point.get('coordination')
+        if coord is None and isinstance(raw_point.get('data'), dict):
+            coord = raw_point['data'].get('coordination')
+        if not coord or 'latitude' not in coord or 'longitude' not in coord:
+            raise ValueError("Coordination data is missing or incomplete.")
+        try:
+            index = int(raw_point.get('index'))
+        except (TypeError, ValueError):
+            raise ValueError("Every point requires an integer index.")
+        if index < 0:
+            raise ValueError("Point index must not be negative.")
+        timestamp = raw_point.get('timestamp')
+        if timestamp is not None and not isinstance(timestamp, (int, float)):
+            raise ValueError("Point timestamp must be epoch milliseconds.")
+        try:
+            latitude, longitude = float(coord['latitude']), float(coord['longitude'])
+        except (TypeError, ValueError):
+            raise ValueError("Coordination data must be numeric.")
+        points.append((index, latitude, longitude, timestamp))
+    # Sorted by index, the last point of a duplicate index wins
+    return merge_points(points)
@@ -0,0 +1,47 @@
+import logging
+import azure.functions as func
+from shared_code import cache, changes, live_updates, ratings
+from shared_code.bootstrap import azure_core, core_exceptions
+from shared_code.concurrency import collect, gather_bounded
+from shared_code.instrumentation import instrument
+from shared_code.partitions import city_of
+from shared_code.tables import (METADATA_TABLE, ROUTE_CHANGES_TABLE, ROUTE_EVENTS_TABLE, ROUTE_RATINGS_TABLE,
+                               STORAGE_CONFIGURED, get_async_table_client)
+
+
+@instrument
+async def main(timer: func.TimerRequest) -> None:
+    logging.info('Python timer trigger function refreshed the cached route ratings.')
+
+    if not STORAGE_CONFIGURED:
+        logging.error("AzureWebJobsStorage environment variable is not set.")
+        return
+
+    ratings_table = get_async_table_client(ROUTE_RATINGS_TABLE)
+    metadata_table = get_async_table_client(METADATA_TABLE)
+
+    # Two concurrent raters may cache their aggregates in the wrong order, the aggregates of
+    # the routes UpdateRoute marked are recomputed from all their shards
+    markers = await collect(ratings_table.query_entities(
+        "PartitionKey eq @dirty", parameters={'dirty': ratings.DIRTY_PARTITION}))
+    logging.info(f"refreshing the ratings of {len(markers)} routes")
+    await gather_bounded(*(refresh_rating(ratings_table, metadata_table, marker) for marker in markers))
+
+
+async def refresh_rating(ratings_table, metadata_table, marker):
+    partition_key, row_key = marker['route_partition_key'], marker['RowKey']
+    try:
+        if await ratings.refresh_rating(ratings_table, metadata_table, partition_key, row_key):
+            cache.invalidate(cache.ROUTES, city_of(partition_key))
+            # The new score reaches the apps with their next delta sync
+            await changes.record_change_async(get_async_table_client(ROUTE_CHANGES_TABLE), partition_key, row_key,
+                                              changes.OP_UPSERT)
+            await live_updates.mark_routes_async(get_async_table_client(ROUTE_EVENTS_TABLE), partition_key)
+        # A rating given since the marker was read rewrote it, it stays for the next run
+        await ratings_table.delete_entity(partition_key=ratings.DIRTY_PARTITION, row_key=row_key,
+                                          etag=marker.metadata['etag'],
+                                          match_condition=azure_core.MatchConditions.IfNotModified)
+    except (core_exceptions.ResourceModifiedError, core_exceptions.ResourceNotFoundError):
+        pass
+    except Exception as e:
+        logging.error(f"Error refreshing the rating of route {row_key}: {e}")
@@ -1,17 +1,23 @@
 import logging
 import azure.functions as func
-import os
-from azure.data.tables import TableClient
 import json
 import uuid
+from shared_code import cache, heat_grid, live_updates, partitions
+from shared_code.instrumentation import instrument, log_payloads
+from shared_code.route_store import append_points
+from shared_code.tables import (HEAT_MAP_GRID_TABLE, HEAT_MAP_TABLE, ROUTE_EVENTS_TABLE, STORAGE_CONFIGURED,
+                               get_table_client)
 
-CONNECTION_STRING = os.getenv('AzureWebJobsStorage')
-
+@instrument
 def main(req: func.HttpRequest) -> func.HttpResponse:
+    # The points of recorded routes reach the heat map through CollectCoordination. This endpoint
+    # is kept for the points that are not part of a recorded route (RouteTimerScreen). Older app
+    # versions still send the points of the routes they record here too, only the points marked
+    # standalone are stored.
     logging.info('Python HTTP trigger function processed a request to create a heat map.')
 
     try:
-        if not CONNECTION_STRING:
+        if not STORAGE_CONFIGURED:
             logging.error("AzureWebJobsStorage environment variable is not set.")
             return func.HttpResponse("Internal Server Error", status_code=500)
 
@@ -23,10 +29,11 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
         partition_key = req_body.get('partition_key')
         if not partition_key:
-            partition_key = "Tel Aviv"
+            partition_key = partitions.DEFAULT_CITY
         index = req_body.get('index')
         data = req_body.get('data')
-        logging.info(f"request from front is {req_body}")
+        if log_payloads():
+            logging.info(f"request from front is {req_body}")
         logging.info(f"partition_key is {partition_key}")
 
         if index is None or data is None:
@@ -39,40 +46,38 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         latitude = coord['latitude']
         longitude = coord['longitude']
 
-        # Generate a unique name using UUID if index is 0
+        # Generate a unique name using UUID if index is 0, in the partition of the start point
         if index == 0:
             name = f"route{uuid.uuid4()}"
+            partition_key = partitions.route_partition(partition_key, float(latitude), float(longitude))
         else:
             name = req_body.get('row_key')
             if not name:
                 return func.HttpResponse("Name is required for non-zero index.", status_code=400)
 
         logging.info(f"name is {name} and index is {index}")
+        # The current app marks the points of RouteTimerScreen as standalone. Older app versions
+        # send the same request for the points of the routes they record, which CollectCoordination
+        # already counts, so their points are answered without being stored.
+        response = json.dumps({"row_key": name, "partition_key": partition_key, "index": index})
+        if not req_body.get('standalone'):
+            logging.info(f"Skipping point {index} of {name}, not marked standalone")
+            return func.HttpResponse(response, status_code=200, mimetype="application/json")
+
         # Connect to the tables
-        heat_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='HeatMapTable')
+        heat_table = get_table_client(HEAT_MAP_TABLE)
+        grid_table = get_table_client(HEAT_MAP_GRID_TABLE)
 
-        # Add or update the route entity in HeatMapTable
-        if index == 0:
-            coord_entity = {'PartitionKey': partition_key, 'RowKey': name}
-            coord_entity[f'Coord{index}_Lat'] = latitude
-            coord_entity[f'Coord{index}_Lon'] = longitude
-            logging.info(f"start coord_entity update with {coord_entity}")
-            heat_table.create_entity(entity=coord_entity)
-            logging.info(f"end coord_entity update with {coord_entity}")
-        else:
-            try:
-                coord_entity = heat_table.get_entity(partition_key=partition_key, row_key=name)
-            except:
-                coord_entity = {
-                    'PartitionKey': partition_key,
-                    'RowKey': name
-                }
+        # Append the point to the packed track of the route in HeatMapTable
+        point = (index, float(latitude), float(longitude), req_body.get('timestamp'))
+        append_points(heat_table, partition_key, name, [point])
 
-            coord_entity[f'Coord{index}_Lat'] = latitude
-            coord_entity[f'Coord{index}_Lon'] = longitude
-            heat_table.upsert_entity(entity=coord_entity)
+        # Count the point in the cells of the heat map grid served by GetHeatMap
+        heat_grid.add_points(grid_table, [point])
+        cache.invalidate(cache.HEAT_MAP)
+        live_updates.mark_heat_map(get_table_client(ROUTE_EVENTS_TABLE))
 
-        return func.HttpResponse(json.dumps({"row_key": name, "partition_key": partition_key, "index": index}), status_code=200, mimetype="application/json")
+        return func.HttpResponse(response, status_code=200, mimetype="application/json")
 
     except Exception as e:
         logging.error(f"Error processing the request: {e}")
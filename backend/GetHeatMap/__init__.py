@@ -1,55 +1,139 @@
 import logging
 import azure.functions as func
-import os
-from azure.data.tables import TableClient
-import json
+from shared_code import cache, changes, heat_grid, track_format
+from shared_code.geo import parse_bbox
+from shared_code.instrumentation import instrument
+from shared_code.paging import decode_token, get_page_size, read_page
+from shared_code.responses import cached_response, delta_response, list_response
+from shared_code.route_store import group_tracks, route_row_key
+from shared_code.tables import (COORDINATES_TABLE, HEAT_MAP_GRID_TABLE, HEAT_MAP_TABLE, STORAGE_CONFIGURED,
+                               get_table_client)
 
-CONNECTION_STRING = os.getenv('AzureWebJobsStorage')
+# The raw heat map is made of the standalone heat map points and of the recorded routes.
+# The HeatMapTable copies of the routes recorded by older app versions are removed by
+# shared_code.migrate_heat_map, and CreateHeatMap no longer stores new ones.
+RAW_SOURCES = (HEAT_MAP_TABLE, COORDINATES_TABLE)
+# The raw heat map is always read by pages, this one when no page_size is given. Clients
+# showing a map read the weighted cells of its bounding box instead, with bbox and zoom.
+RAW_PAGE_SIZE = 100
 
 
+@instrument
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request to retrieve heat map coordinations.')
 
+    # The heat map is served from the response cache until new points are written
+    return cached_response(req, cache.HEAT_MAP, cache.ALL_PARTITIONS, get_heat_map)
+
+
+def get_heat_map(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        if not CONNECTION_STRING:
+        if not STORAGE_CONFIGURED:
             logging.error("AzureWebJobsStorage environment variable is not set.")
             return func.HttpResponse("Internal Server Error", status_code=500)
 
-        # Connect to the HeatMapTable
-        heat_map_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='HeatMapTable')
+        # With a since watermark only the cells or points written after it are returned.
+        # The watermark is taken before reading so nothing written meanwhile is missed.
+        try:
+            since = changes.parse_since(req.params.get('since'))
+        except ValueError as e:
+            return func.HttpResponse(str(e), status_code=400)
+        watermark = changes.now_ms()
+        since_filter = since_datetime = None
+        if since is not None:
+            since_datetime = changes.since_datetime(since)
+            since_filter = "Timestamp ge @since"
+
+        # Serve the weighted cells of the aggregated grid when a bounding box is requested
+        if req.params.get('bbox'):
+            try:
+                bbox = parse_bbox(req.params.get('bbox'))
+                zoom = float(req.params.get('zoom', 15))
+                coords = track_format.get_format(req.params, (track_format.OBJECTS, track_format.COLUMNS))
+            except ValueError as e:
+                return func.HttpResponse(str(e), status_code=400)
+            precision = heat_grid.precision_for_zoom(zoom)
+            try:
+                precision, cells = heat_grid.query_cells(get_table_client(HEAT_MAP_GRID_TABLE), bbox, precision,
+                                                         since_datetime)
+            except ValueError as e:
+                return func.HttpResponse(str(e), status_code=400)
+            results = [{
+                "partition_key": "grid",
+                "row_key": str(precision),
+                "data": format_cells(cells, coords)
+            }]
+            if since is not None:
+                # The weights are totals, clients replace the cells they already have
+                return delta_response("heat_map", results, watermark)
+            return list_response(results, req)
+
+        try:
+            page_size = get_page_size(req.params) or RAW_PAGE_SIZE
+            coords = track_format.get_format(req.params)
+            source, token = get_source(decode_token(req.params.get('continuation')))
+        except ValueError as e:
+            return func.HttpResponse(str(e), status_code=400)
+
+        def query(table_name):
+            table_client = get_table_client(table_name)
+            if since_filter:
+                return table_client.query_entities(since_filter, parameters={'since': since_datetime},
+                                                   results_per_page=page_size)
+            return table_client.list_entities(results_per_page=page_size)
 
-        # Query the table for all entities
-        entities = list(heat_map_table.list_entities())
+        # Query one page of the tables. The pages of HeatMapTable come first, the token
+        # records which table the next page is read from.
+        next_token = None
+        entities, token = read_page(query(source), token)
+        if token:
+            next_token = {'table': source, 'token': token}
+        elif source != RAW_SOURCES[-1]:
+            next_token = {'table': RAW_SOURCES[RAW_SOURCES.index(source) + 1], 'token': None}
 
-        logging.info(f"entities are {entities}")
-        # Process each entity to filter columns and format data
-        results = []
-        for entity in entities:
-            parsed_entity = parse_entity(entity)
-            results.append(parsed_entity)
+        # Decode the track of each route and format the data
+        logging.info(f"read {len(entities)} heat map entities from {source}")
+        partition_keys = {route_row_key(entity['RowKey']): entity['PartitionKey'] for entity in entities}
+        results = [parse_track(partition_keys[row_key], row_key, track, coords)
+                   for row_key, track in group_tracks(entities).items()]
 
-        # Convert the results to JSON
-        response_body = json.dumps(results, default=str)  # default=str to handle any non-serializable fields
-        return func.HttpResponse(response_body, status_code=200, mimetype="application/json")
+        if since is not None:
+            # Only the updated chunks of a route are read, clients merge the points by route
+            return delta_response("heat_map", results, watermark, continuation_token=next_token)
+        # Convert the results to JSON, or to NDJSON with format=ndjson
+        return list_response(results, req, next_token)
 
     except Exception as e:
         logging.error(f"Error processing the request: {e}")
         return func.HttpResponse(f"Something went wrong: {e}", status_code=500)
 
 
-def parse_entity(entity):
+def parse_track(partition_key, row_key, track, coords=track_format.OBJECTS):
     parsed_dict = {
-        "partition_key": entity["PartitionKey"],
-        "row_key": entity["RowKey"],
-        "data": []
+        "partition_key": partition_key,
+        "row_key": row_key,
+        "data": track_format.format_track(track, coords)
     }
+    return parsed_dict
 
-    for key, value in entity.items():
-        if key.startswith("Coord") and key.endswith("_Lat"):
-            index = key.split("_")[0]
-            latitude = value
-            longitude = entity.get(f"{index}_Lon")
-            if latitude is not None and longitude is not None:
-                parsed_dict["data"].append({"latitude": latitude, "longitude": longitude})
 
-    return parsed_dict
+def get_source(continuation_token):
+    """Return the table and the Table SDK token a raw heat map continuation token points to.
+
+    Raises ValueError if the token does not name one of the raw sources.
+    """
+    if not continuation_token:
+        return RAW_SOURCES[0], None
+    if 'table' not in continuation_token:
+        # Tokens issued before the routes were served are plain HeatMapTable tokens
+        return HEAT_MAP_TABLE, continuation_token
+    if continuation_token['table'] not in RAW_SOURCES:
+        raise ValueError("Invalid continuation token.")
+    return continuation_token['table'], continuation_token['token']
+
+
+def format_cells(cells, coords):
+    if coords == track_format.COLUMNS:
+        return {"latitude": [cell[0] for cell in cells], "longitude": [cell[1] for cell in cells],
+                "weight": [cell[2] for cell in cells]}
+    return [{"latitude": latitude, "longitude": longitude, "weight": count} for latitude, longitude, count in cells]
@@ -0,0 +1,71 @@
+import logging
+import azure.functions as func
+from shared_code import partitions, route_match, track_format
+from shared_code.bootstrap import core_exceptions
+from shared_code.instrumentation import instrument
+from shared_code.responses import conditional_response, dumps
+from shared_code.route_store import read_track
+from shared_code.tables import (COORDINATES_TABLE, ROUTE_MATCH_TABLE, ROUTES_TABLE, STORAGE_CONFIGURED,
+                               get_table_client)
+
+
+@instrument
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a request to retrieve a full route track.')
+
+    try:
+        if not STORAGE_CONFIGURED:
+            logging.error("AzureWebJobsStorage environment variable is not set.")
+            return func.HttpResponse("Internal Server Error", status_code=500)
+
+        # Get partition key and row key from request parameters
+        partition_key = req.params.get('partitionKey', partitions.DEFAULT_CITY)
+        row_key = req.params.get('row_key')
+        if not partition_key or not row_key:
+            return func.HttpResponse("PartitionKey and RowKey are required.", status_code=400)
+        try:
+            coords = track_format.get_format(req.params)
+        except ValueError as e:
+            return func.HttpResponse(str(e), status_code=400)
+
+        # Connect to the tables
+        route_table = get_table_client(ROUTES_TABLE)
+        route_coordinations_table = get_table_client(COORDINATES_TABLE)
+
+        entity = read_route(route_table, partition_key, row_key)
+        if entity is None and route_match.ENABLED:
+            # A run attached to a route of the catalog is answered with that route
+            resolved = route_match.resolve(get_table_client(ROUTE_MATCH_TABLE), partition_key, row_key)
+            if resolved != (partition_key, row_key):
+                partition_key, row_key = resolved
+                entity = read_route(route_table, partition_key, row_key)
+        if entity is None:
+            return func.HttpResponse(f"Route {row_key} not found.", status_code=404)
+
+        # Return the route with its full resolution track
+        track = read_track(route_coordinations_table, partition_key, row_key)
+        result = {
+            "start": {"latitude": entity.get("start_cord_latitude"), "longitude": entity.get("start_cord_longitude")},
+            "end": {"latitude": entity.get("end_cord_latitude"), "longitude": entity.get("end_cord_longitude")},
+            "row_key": row_key,
+            "partition_key": partition_key,
+            "data": track_format.format_track(track, coords, timestamps=True)
+        }
+        if coords == track_format.POLYLINE:
+            result["timestamps"] = track_format.format_timestamps(track)
+
+        # Clients revalidate a track they already have with its ETag
+        return conditional_response(req, dumps(result), "application/json", {})
+
+    except Exception as e:
+        logging.error(f"Error processing the request: {e}")
+        return func.HttpResponse(f"Something went wrong: {e}", status_code=500)
+
+
+def read_route(route_table, partition_key, row_key):
+    try:
+        return route_table.get_entity(partition_key=partition_key, row_key=row_key,
+                                      select=['start_cord_latitude', 'start_cord_longitude',
+                                              'end_cord_latitude', 'end_cord_longitude'])
+    except core_exceptions.ResourceNotFoundError:
+        return None
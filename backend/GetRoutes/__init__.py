@@ -1,70 +1,243 @@
 import logging
 import azure.functions as func
-import os
-from azure.data.tables import TableClient
-import json
 from typing import Dict
+from shared_code import cache, changes, geo_index, partitions, ratings, route_stats, track_format
+from shared_code.geo import parse_bbox
+from shared_code.concurrency import collect, gather_bounded
+from shared_code.instrumentation import instrument, log_payloads
+from shared_code.paging import decode_token, get_page_size, read_page_async
+from shared_code.responses import cached_response_async, delta_response, list_response
+from shared_code.route_store import group_tracks, query_track_rows_async
+from shared_code.simplify import (DEFAULT_DETAIL, LEVELS_OF_DETAIL, detail_for_zoom, get_level_of_detail,
+                                  simplify)
+from shared_code.tables import (COORDINATES_TABLE, METADATA_TABLE, PERSONAL_METADATA_TABLE, ROUTE_CHANGES_TABLE,
+                               ROUTE_GEO_INDEX_TABLE, ROUTE_PARTITIONS_TABLE, ROUTES_TABLE, STORAGE_CONFIGURED,
+                               get_async_table_client)
 
-CONNECTION_STRING = os.getenv('AzureWebJobsStorage')
+# Azure Tables allows 15 comparisons per filter, one is taken by the PartitionKey
+MAX_FILTER_ROW_KEYS = 14
 
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+@instrument
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request to retrieve route coordinations.')
 
+    # Unchanged routes are served from the response cache, the writers invalidate the cache of their city
+    city = partitions.city_of(req.params.get('partitionKey', partitions.DEFAULT_CITY))
+    # Delta syncs skip it, without Redis only the worker of a write drops its entries and the
+    # others would keep answering a watermark with a delta missing the write
+    return await cached_response_async(req, cache.ROUTES, city, get_routes,
+                                       cacheable=not req.params.get('since'))
+
+
+async def get_routes(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        if not CONNECTION_STRING:
+        if not STORAGE_CONFIGURED:
             logging.error("AzureWebJobsStorage environment variable is not set.")
             return func.HttpResponse("Internal Server Error", status_code=500)
 
         # Connect to the tables
-        route_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='RoutesCordinations')
-        metadata_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='RoutesMetadata')
-        route_coordinations_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='AllRouteCoordinations')
-        personal_metadata_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='RoutePersonalMetadata')
+        route_table = get_async_table_client(ROUTES_TABLE)
+        metadata_table = get_async_table_client(METADATA_TABLE)
+        route_coordinations_table = get_async_table_client(COORDINATES_TABLE)
+        personal_metadata_table = get_async_table_client(PERSONAL_METADATA_TABLE)
 
         # Get partition key and user name from request parameters
-        partition_key = req.params.get('partitionKey', "Tel Aviv")
+        partition_key = req.params.get('partitionKey', partitions.DEFAULT_CITY)
         user_name = req.params.get('user_name')
         if not partition_key:
             return func.HttpResponse("PartitionKey is required.", status_code=400)
 
-        # Query the table for all entities with the specified PartitionKey
-        entities = list(route_table.query_entities(f"PartitionKey eq '{partition_key}'"))
-        metadata_entities = list(metadata_table.query_entities(f"PartitionKey eq '{partition_key}'"))
-
-        # Convert the metadata entities to a dictionary for quick lookup
-        metadata_dict = {entity['RowKey']: entity for entity in metadata_entities}
-
-        # Collect the entities in a list
-        results = []
-        for entity in entities:
-            parsed_entity = parse_entity(dict(entity))
-            parsed_entity["data"] = get_coordinates(route_coordinations_table, partition_key, parsed_entity.get('row_key'))
-
-            # Get the metadata for the same RowKey
-            metadata_entity = metadata_dict.get(parsed_entity.get('row_key'))
-            if metadata_entity:
-                # Remove PartitionKey and RowKey from metadata entity to avoid overwriting
-                metadata_entity.pop('PartitionKey', None)
-                metadata_entity.pop('RowKey', None)
-                parsed_entity.update(metadata_entity)
-
-            # Get the personal metadata for the user
-            if user_name:
-                try:
-                    personal_metadata_entity = personal_metadata_table.get_entity(partition_key=user_name, row_key=parsed_entity.get('row_key'))
-                    personal_metadata_dict = dict(personal_metadata_entity)
-                    personal_metadata_dict.pop('PartitionKey', None)
-                    personal_metadata_dict.pop('RowKey', None)
-                    parsed_entity.update(personal_metadata_dict)
-                except Exception as e:
-                    logging.info(f"No personal metadata found for user {user_name} and route {parsed_entity.get('row_key')}")
-            logging.info(parsed_entity)
-            results.append(parsed_entity)
-
-        # Convert the results to JSON
-        response_body = json.dumps(results, default=str)  # default=str to handle any non-serializable fields
-        return func.HttpResponse(response_body, status_code=200, mimetype="application/json")
+        # Level of detail of the route geometries, the full track is only served by GetRoute
+        try:
+            detail = get_detail(req.params)
+            coords = track_format.get_format(req.params)
+            page_size = get_page_size(req.params)
+            continuation_token = decode_token(req.params.get('continuation'))
+            since = changes.parse_since(req.params.get('since'))
+            sort = route_stats.parse_sort(req.params.get('sort'))
+            stat_filter = route_stats.parse_filter(req.params.get('filter'))
+        except ValueError as e:
+            return func.HttpResponse(str(e), status_code=400)
+
+        def respond(results, next_token=None):
+            if since is None:
+                # Convert the results to JSON, or to NDJSON with format=ndjson
+                return list_response(results, req, next_token)
+            return delta_response("routes", results, watermark, deleted, full_sync, next_token)
+
+        # The routes of a city may be spread over several partitions, see shared_code.partitions.
+        # The RowKeys to read are kept per partition, None for all the routes of a partition.
+        partition_keys = await partitions.read_partitions_async(get_async_table_client(ROUTE_PARTITIONS_TABLE),
+                                                                partition_key)
+        row_keys = {key: None for key in partition_keys}
+
+        # Restrict the routes to a bounding box or a radius through the geospatial index
+        try:
+            area = get_area(req.params)
+        except ValueError as e:
+            return func.HttpResponse(str(e), status_code=400)
+        if area:
+            bbox, near = area
+            row_keys = await geo_index.query_partition_routes_async(get_async_table_client(ROUTE_GEO_INDEX_TABLE),
+                                                                    partition_keys, bbox, near)
+            if row_keys is None:
+                return func.HttpResponse("The requested area is too large.", status_code=400)
+
+        # With a since watermark only the routes changed after it are returned, with the
+        # RowKeys of the routes removed since then
+        deleted = []
+        watermark = None
+        full_sync = False
+        if since is not None:
+            changes_table = get_async_table_client(ROUTE_CHANGES_TABLE)
+            partition_changes = await gather_bounded(*(changes.read_changes_async(changes_table, key, since)
+                                                       for key in partition_keys))
+            watermark = max((changed[2] for changed in partition_changes), default=since)
+            deleted = sorted(row_key for changed in partition_changes for row_key in changed[1])
+            full_sync = any(changed[0] is None for changed in partition_changes)
+            if not full_sync:
+                for key, (changed, _, _) in zip(partition_keys, partition_changes):
+                    row_keys[key] = changed if row_keys[key] is None else row_keys[key] & changed
+
+        async def read_partition(partition_key, row_keys, page_size, continuation_token):
+            # Return the results of the routes of a partition, and the token of its next page
+            next_token = None
+
+            # Query each table once for the whole partition (or the matching routes) and join
+            # the results in memory, so the number of storage calls does not grow with the routes.
+            # The independent queries run concurrently. With a page size only one page of routes
+            # is read first, and the other tables are read for the RowKey range of that page.
+            row_key_range = None
+            if page_size and row_keys is None:
+                query_filter, parameters = with_stat_filter("PartitionKey eq @partition_key",
+                                                            {"partition_key": partition_key}, stat_filter)
+                entities, next_token = await read_page_async(
+                    route_table.query_entities(query_filter, parameters=parameters, results_per_page=page_size),
+                    continuation_token)
+                if not entities:
+                    return [], None
+                row_key_range = (entities[0]['RowKey'], entities[-1]['RowKey'])
+                metadata_entities, personal_metadata_entities = await gather_bounded(
+                    query_partition(metadata_table, partition_key, row_keys, row_key_range),
+                    query_personal_metadata(personal_metadata_table, user_name, row_keys, row_key_range))
+            else:
+                if page_size:
+                    # The matching routes are already known, page over their sorted RowKeys
+                    remaining = sorted(row_key for row_key in row_keys
+                                       if not continuation_token or row_key > continuation_token.get('RowKey', ''))
+                    row_keys = remaining[:page_size]
+                    if len(remaining) > page_size:
+                        next_token = {'RowKey': row_keys[-1]}
+                    if not row_keys:
+                        return [], None
+                entities, metadata_entities, personal_metadata_entities = await gather_bounded(
+                    query_partition(route_table, partition_key, row_keys, stat_filter=stat_filter),
+                    query_partition(metadata_table, partition_key, row_keys),
+                    query_personal_metadata(personal_metadata_table, user_name, row_keys))
+
+            # Convert the metadata entities to dictionaries for quick lookup
+            metadata_dict = {entity['RowKey']: entity for entity in metadata_entities}
+            personal_metadata_dict = {entity['RowKey']: entity for entity in personal_metadata_entities}
+
+            # Use the simplified geometries stored when the routes were finished. Routes still
+            # being recorded have no geometry yet, and only finished routes the levels of detail
+            # were not built for (see shared_code.build_levels_of_detail) are simplified on the fly.
+            tracks_dict = {entity['RowKey']: get_level_of_detail(entity, detail)
+                           if entity.get('end_cord_latitude') is not None else [] for entity in entities}
+            missing_row_keys = [row_key for row_key, track in tracks_dict.items() if track is None]
+            if missing_row_keys:
+                logging.info(f"{len(missing_row_keys)} finished routes without levels of detail, "
+                             f"run shared_code.build_levels_of_detail")
+                # Every chunk row of the tracks, a track longer than CHUNK_SIZE points spans several rows
+                chunk_rows = await gather_bounded(*(query_track_rows_async(route_coordinations_table, partition_key,
+                                                                           row_key)
+                                                    for row_key in missing_row_keys))
+                full_tracks = group_tracks(entity for rows in chunk_rows for entity in rows)
+                for row_key in missing_row_keys:
+                    tracks_dict[row_key] = simplify(full_tracks.get(row_key, []), LEVELS_OF_DETAIL[detail])
+
+            # Collect the entities in a list
+            results = []
+            for entity in entities:
+                parsed_entity = parse_entity(dict(entity))
+                row_key = parsed_entity.get('row_key')
+                parsed_entity["data"] = track_format.format_track(tracks_dict[row_key], coords)
+
+                # Get the metadata for the same RowKey
+                metadata_entity = metadata_dict.get(row_key)
+                if metadata_entity:
+                    # Remove PartitionKey and RowKey from metadata entity to avoid overwriting,
+                    # and the bookkeeping of the ratings
+                    metadata_entity = dict(metadata_entity)
+                    metadata_entity.pop('PartitionKey', None)
+                    metadata_entity.pop('RowKey', None)
+                    metadata_entity.pop(ratings.SHARDED_PROPERTY, None)
+                    parsed_entity.update(metadata_entity)
+
+                # Get the personal metadata for the user
+                personal_metadata_entity = personal_metadata_dict.get(row_key)
+                if personal_metadata_entity:
+                    personal_metadata_entity = dict(personal_metadata_entity)
+                    personal_metadata_entity.pop('PartitionKey', None)
+                    personal_metadata_entity.pop('RowKey', None)
+                    parsed_entity.update(personal_metadata_entity)
+                if log_payloads():
+                    logging.info(parsed_entity)
+                results.append(parsed_entity)
+            return results, next_token
+
+        # With a sort only the statistics of the routes are read to order them, then the
+        # routes of the requested page are read in that order. Pages are offsets in the order.
+        if sort:
+            ordered = await sort_routes(route_table, row_keys, stat_filter, sort)
+            offset = (continuation_token or {}).get('offset', 0)
+            if not isinstance(offset, int) or offset < 0:
+                return func.HttpResponse("Invalid continuation token.", status_code=400)
+            next_token = None
+            if page_size:
+                if len(ordered) > offset + page_size:
+                    next_token = {'offset': offset + page_size}
+                ordered = ordered[offset:offset + page_size]
+            order = {route: i for i, route in enumerate(ordered)}
+            page_row_keys = {}
+            for key, row_key in ordered:
+                page_row_keys.setdefault(key, set()).add(row_key)
+            stat_filter = None
+            pages = await gather_bounded(*(read_partition(key, keys, None, None)
+                                           for key, keys in page_row_keys.items()))
+            results = [result for page, _ in pages for result in page]
+            results.sort(key=lambda result: order[(result['partition_key'], result['row_key'])])
+            return respond(results, next_token)
+
+        # The pages of a city spanning several partitions go through its partitions one after
+        # the other, the token holds the partition and the token of the page within it
+        if page_size and partitions.spans_partitions(partition_key):
+            if not partition_keys:
+                return respond([])
+            current = (continuation_token or {}).get('partition', partition_keys[0])
+            if current not in row_keys:
+                return func.HttpResponse("Invalid continuation token.", status_code=400)
+            position = partition_keys.index(current)
+            partition_token = (continuation_token or {}).get('token')
+            while True:
+                results, partition_token = await read_partition(current, row_keys[current], page_size,
+                                                                partition_token)
+                if partition_token:
+                    return respond(results, {'partition': current, 'token': partition_token})
+                position += 1
+                if position == len(partition_keys):
+                    return respond(results)
+                current = partition_keys[position]
+                if results:
+                    return respond(results, {'partition': current, 'token': None})
+
+        # Otherwise the partitions are read concurrently, a paged read has a single partition
+        pages = await gather_bounded(*(read_partition(key, keys, page_size, continuation_token)
+                                       for key, keys in row_keys.items()))
+        results = [result for page, _ in pages for result in page]
+        next_token = pages[0][1] if len(pages) == 1 else None
+        return respond(results, next_token)
 
     except Exception as e:
         logging.error(f"Error processing the request: {e}")
@@ -76,27 +249,104 @@ def parse_entity(entity: Dict) -> Dict:
     parsed_dict["end"] = {"latitude": entity.get("end_cord_latitude"), "longitude": entity.get("end_cord_longitude")}
     parsed_dict["row_key"] = entity.get("RowKey")
     parsed_dict["partition_key"] = entity.get("PartitionKey")
+    # Statistics stored when the route was finished
+    for field in route_stats.STAT_FIELDS:
+        if entity.get(field) is not None:
+            parsed_dict[field] = entity[field]
     return parsed_dict
 
 
-def get_coordinates(table_client, partition_key, row_key):
-    try:
-        # Retrieve the entity
-        entity = table_client.get_entity(partition_key=partition_key, row_key=row_key)
-
-        # Extract coordinates from the entity
-        temp_coordinates = []
-        for key, value in entity.items():
-            if key.startswith("Coord") and key.endswith("_Lat"):
-                coord_id = key.split("_")[0]
-                latitude = value
-                longitude = entity.get(f"{coord_id}_Lon")
-                if latitude is not None and longitude is not None:
-                    temp_coordinates.append((int(coord_id[5:]), latitude, longitude))
-
-        temp_coordinates.sort()
-        coordinates = [{"latitude": lat, "longitude": lon} for num, lat, lon in temp_coordinates]
-        return coordinates
-    except Exception as e:
-        logging.error(f"Error retrieving coordinates for route {row_key}: {e}")
+async def query_partition(table_client, partition_key, row_keys=None, row_key_range=None, stat_filter=None,
+                          **kwargs):
+    """Return the entities of a partition.
+
+    Only the entities with the given RowKeys are returned when row_keys is set,
+    or those within the inclusive (first, last) RowKey range when row_key_range is set,
+    and only those matching the (filter, parameters) stat_filter when it is set.
+    More than MAX_FILTER_ROW_KEYS RowKeys are split into queries that run concurrently.
+    """
+    if row_keys is None and row_key_range is not None:
+        query_filter, parameters = with_stat_filter(
+            "PartitionKey eq @partition_key and RowKey ge @first and RowKey le @last",
+            {"partition_key": partition_key, "first": row_key_range[0], "last": row_key_range[1]}, stat_filter)
+        return await collect(table_client.query_entities(query_filter, parameters=parameters, **kwargs))
+    if row_keys is None:
+        query_filter, parameters = with_stat_filter("PartitionKey eq @partition_key",
+                                                    {"partition_key": partition_key}, stat_filter)
+        return await collect(table_client.query_entities(query_filter, parameters=parameters, **kwargs))
+    queries = []
+    row_keys = sorted(row_keys)
+    # The comparisons of the statistics filter count towards the limit of the query
+    chunk_size = MAX_FILTER_ROW_KEYS - (len(stat_filter[1]) if stat_filter else 0)
+    for start in range(0, len(row_keys), chunk_size):
+        chunk = row_keys[start:start + chunk_size]
+        parameters = {"partition_key": partition_key}
+        parameters.update({f"row_key{i}": row_key for i, row_key in enumerate(chunk)})
+        row_key_filter = " or ".join(f"RowKey eq @row_key{i}" for i in range(len(chunk)))
+        query_filter, parameters = with_stat_filter(f"PartitionKey eq @partition_key and ({row_key_filter} )",
+                                                    parameters, stat_filter)
+        queries.append(collect(table_client.query_entities(query_filter, parameters=parameters, **kwargs)))
+    results = await gather_bounded(*queries)
+    return [entity for entities in results for entity in entities]
+
+
+def with_stat_filter(query_filter, parameters, stat_filter):
+    if not stat_filter:
+        return query_filter, parameters
+    return f"{query_filter} and {stat_filter[0]}", dict(parameters, **stat_filter[1])
+
+
+async def sort_routes(route_table, row_keys, stat_filter, sort):
+    """Return the (PartitionKey, RowKey) of the routes ordered by a statistic, reading only that statistic.
+
+    row_keys maps the partitions to read to their RowKeys, None for all the routes of a partition.
+    """
+    field, descending = sort
+    partition_entities = await gather_bounded(*(
+        query_partition(route_table, partition_key, keys, stat_filter=stat_filter,
+                        select=['PartitionKey', 'RowKey', field])
+        for partition_key, keys in row_keys.items()))
+    entities = [entity for entities in partition_entities for entity in entities]
+    # Routes without the statistic, like unfinished ones, come last in both orders
+    ranked = sorted((entity for entity in entities if entity.get(field) is not None),
+                    key=lambda entity: (entity[field], entity['RowKey'], entity['PartitionKey']), reverse=descending)
+    unranked = sorted((entity['PartitionKey'], entity['RowKey']) for entity in entities if entity.get(field) is None)
+    return [(entity['PartitionKey'], entity['RowKey']) for entity in ranked] + unranked
+
+
+async def query_personal_metadata(table_client, user_name, row_keys=None, row_key_range=None):
+    # The personal metadata of the user is partitioned by the user name
+    if not user_name:
         return []
+    return await query_partition(table_client, user_name, row_keys, row_key_range)
+
+
+def get_area(params):
+    """Return the (bbox, near) area requested with bbox= or near=lat,lon&radius=, or None."""
+    if params.get('bbox'):
+        return parse_bbox(params.get('bbox')), None
+    if params.get('near'):
+        try:
+            latitude, longitude = (float(part) for part in params.get('near').split(','))
+            radius = float(params.get('radius', 1000))
+        except ValueError:
+            raise ValueError("near must be lat,lon and radius a number of meters.")
+        if radius <= 0:
+            raise ValueError("radius must be positive.")
+        return geo_index.radius_bbox(latitude, longitude, radius), (latitude, longitude, radius)
+    return None
+
+
+def get_detail(params) -> str:
+    detail = params.get('detail')
+    if detail:
+        if detail not in LEVELS_OF_DETAIL:
+            raise ValueError(f"detail must be one of {', '.join(LEVELS_OF_DETAIL)}.")
+        return detail
+    zoom = params.get('zoom')
+    if zoom:
+        try:
+            return detail_for_zoom(float(zoom))
+        except ValueError:
+            raise ValueError("zoom must be a number.")
+    return DEFAULT_DETAIL
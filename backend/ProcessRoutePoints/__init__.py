@@ -0,0 +1,65 @@
+import logging
+import os
+import azure.functions as func
+from shared_code import ingest
+from shared_code.bootstrap import lazy_import
+from shared_code.instrumentation import client_hooks, instrument
+from shared_code.tables import CONNECTION_STRING
+
+# Messages drained from the queue along with the trigger message, so the points of the
+# same route sent by many requests are written together. 32 is the most one receive returns.
+DRAIN_BATCH = int(os.getenv('INGEST_DRAIN_BATCH', '32'))
+# Seconds the drained messages stay invisible to the other workers while they are written
+VISIBILITY_TIMEOUT = 60
+
+storage_queue = lazy_import('azure.storage.queue')
+_queue_client = None
+
+
+def get_queue_client():
+    global _queue_client
+    if _queue_client is None:
+        # The Functions host base64 encodes the messages of the queue output binding
+        _queue_client = storage_queue.QueueClient.from_connection_string(
+            CONNECTION_STRING, ingest.QUEUE_NAME, message_encode_policy=storage_queue.TextBase64EncodePolicy(),
+            message_decode_policy=storage_queue.TextBase64DecodePolicy(), **client_hooks())
+    return _queue_client
+
+
+@instrument
+def main(msg: func.QueueMessage) -> None:
+    logging.info('Python queue trigger function processed a batch of route points.')
+
+    messages = [(msg.get_body().decode(), msg.dequeue_count, None)]
+    queue_client = None
+    if DRAIN_BATCH:
+        try:
+            queue_client = get_queue_client()
+            drained = queue_client.receive_messages(max_messages=DRAIN_BATCH, visibility_timeout=VISIBILITY_TIMEOUT)
+            messages.extend((message.content, message.dequeue_count, message) for message in drained)
+        except Exception as e:
+            # The drained messages reappear after the visibility timeout
+            logging.error(f"Error draining the route points queue: {e}")
+    logging.info(f"processing {len(messages)} route point messages")
+
+    trigger_failed = False
+    routes = ingest.group_messages(messages)
+    for (partition_key, row_key), (points, finish, keep_raw, last_attempt, sources) in routes.items():
+        try:
+            ingest.write_points(partition_key, row_key, points, finish, keep_raw)
+            if finish:
+                # Points queued before the end may not be written yet, they are waited for
+                # until the last delivery, which finishes the route with the points it has
+                ingest.finish_route(partition_key, row_key, points[-1], require_complete=not last_attempt)
+        except Exception as e:
+            logging.error(f"Error writing the points of route {row_key}: {e}")
+            # The drained messages of the route are left on the queue to be delivered again,
+            # the trigger message is retried by failing the invocation
+            trigger_failed = trigger_failed or None in sources
+            continue
+        for source in sources:
+            if source is not None:
+                queue_client.delete_message(source)
+
+    if trigger_failed:
+        raise RuntimeError("Could not write the points of the trigger message")
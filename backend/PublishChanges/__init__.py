@@ -0,0 +1,24 @@
+import json
+import logging
+import azure.functions as func
+from shared_code import live_updates
+from shared_code.instrumentation import instrument
+from shared_code.tables import ROUTE_CHANGES_TABLE, ROUTE_EVENTS_TABLE, STORAGE_CONFIGURED, get_async_table_client
+
+
+@instrument
+async def main(timer: func.TimerRequest, signalRMessages: func.Out[str]) -> None:
+    logging.info('Python timer trigger function published the route changes.')
+
+    if not STORAGE_CONFIGURED:
+        logging.error("AzureWebJobsStorage environment variable is not set.")
+        return
+    if not live_updates.ENABLED:
+        return
+
+    # The writes of every partition since the previous run become one message to the hub
+    messages = await live_updates.publish(get_async_table_client(ROUTE_EVENTS_TABLE),
+                                          get_async_table_client(ROUTE_CHANGES_TABLE))
+    logging.info(f"publishing {len(messages)} change messages")
+    if messages:
+        signalRMessages.set(json.dumps(messages))
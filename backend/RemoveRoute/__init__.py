@@ -1,24 +1,28 @@
 import logging
 import azure.functions as func
-import os
-from azure.data.tables import TableClient
-import json
+from shared_code import cache, changes, geo_index, live_updates, ratings, route_match
+from shared_code.concurrency import gather_bounded
+from shared_code.instrumentation import instrument
+from shared_code.partitions import city_of
+from shared_code.route_store import delete_track_async
+from shared_code.tables import (COORDINATES_TABLE, METADATA_TABLE, RAW_COORDINATES_TABLE, ROUTE_CHANGES_TABLE,
+                               ROUTE_EVENTS_TABLE, ROUTE_GEO_INDEX_TABLE, ROUTE_MATCH_TABLE, ROUTE_RATINGS_TABLE,
+                               ROUTES_TABLE, STORAGE_CONFIGURED, get_async_table_client)
 
-CONNECTION_STRING = os.getenv('AzureWebJobsStorage')
 
-
-def main(req: func.HttpRequest) -> func.HttpResponse:
+@instrument
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request to remove a route.')
     try:
-        if not CONNECTION_STRING:
+        if not STORAGE_CONFIGURED:
             logging.error("AzureWebJobsStorage environment variable is not set.")
             return func.HttpResponse("Internal Server Error", status_code=500)
 
         # Connect to the tables
-        route_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='RoutesCordinations')
-        metadata_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='RoutesMetadata')
-        route_coordinations_table = TableClient.from_connection_string(CONNECTION_STRING,
-                                                                       table_name='AllRouteCoordinations')
+        route_table = get_async_table_client(ROUTES_TABLE)
+        metadata_table = get_async_table_client(METADATA_TABLE)
+        route_coordinations_table = get_async_table_client(COORDINATES_TABLE)
+        index_table = get_async_table_client(ROUTE_GEO_INDEX_TABLE)
 
         # Get partition key and row key from request body
         try:
@@ -31,10 +35,23 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         if not partition_key or not row_key:
             return func.HttpResponse("PartitionKey and RowKey are required.", status_code=400)
 
-        # Remove the entity from the tables
-        remove_entity(route_table, partition_key, row_key)
-        remove_entity(metadata_table, partition_key, row_key)
-        remove_entity(route_coordinations_table, partition_key, row_key)
+        # The bounding box of the route is read first to find its geospatial index rows, and is
+        # kept with the tombstone for SweepRoutes
+        bbox = await read_bbox(route_table, partition_key, row_key)
+
+        # Remove the entity from the tables concurrently, and leave a tombstone for delta syncs.
+        # The rows of the route in other partitions (personal metadata) are removed by SweepRoutes
+        # from the tombstone.
+        await gather_bounded(
+            remove_entity(route_table, partition_key, row_key),
+            remove_index(index_table, row_key, bbox),
+            remove_entity(metadata_table, partition_key, row_key),
+            remove_track(route_coordinations_table, partition_key, row_key),
+            remove_track(get_async_table_client(RAW_COORDINATES_TABLE), partition_key, row_key),
+            remove_ratings(get_async_table_client(ROUTE_RATINGS_TABLE), partition_key, row_key),
+            remove_match_rows(get_async_table_client(ROUTE_MATCH_TABLE), partition_key, row_key),
+            record_removal(get_async_table_client(ROUTE_CHANGES_TABLE), partition_key, row_key, bbox))
+        cache.invalidate(cache.ROUTES, city_of(partition_key))
 
         return func.HttpResponse(f"Route {row_key} removed successfully.", status_code=200)
 
@@ -43,9 +60,61 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(f"Something went wrong: {e}", status_code=500)
 
 
-def remove_entity(table_client, partition_key, row_key):
+async def remove_entity(table_client, partition_key, row_key):
     try:
-        table_client.delete_entity(partition_key=partition_key, row_key=row_key)
+        await table_client.delete_entity(partition_key=partition_key, row_key=row_key)
         logging.info(f"Entity with PartitionKey: {partition_key} and RowKey: {row_key} removed successfully.")
     except Exception as e:
         logging.error(f"Error removing entity with PartitionKey: {partition_key} and RowKey: {row_key}: {e}")
+
+
+async def remove_track(table_client, partition_key, row_key):
+    try:
+        await delete_track_async(table_client, partition_key, row_key)
+        logging.info(f"Track with PartitionKey: {partition_key} and RowKey: {row_key} removed successfully.")
+    except Exception as e:
+        logging.error(f"Error removing track with PartitionKey: {partition_key} and RowKey: {row_key}: {e}")
+
+
+async def remove_ratings(table_client, partition_key, row_key):
+    try:
+        await ratings.delete_ratings_async(table_client, partition_key, row_key)
+    except Exception as e:
+        logging.error(f"Error removing the ratings of route {row_key}: {e}")
+
+
+async def remove_match_rows(table_client, partition_key, row_key):
+    try:
+        await route_match.remove_route_async(table_client, partition_key, row_key)
+    except Exception as e:
+        logging.error(f"Error removing the match index rows of route {row_key}: {e}")
+
+
+async def read_bbox(route_table, partition_key, row_key):
+    try:
+        route_entity = await route_table.get_entity(partition_key=partition_key, row_key=row_key,
+                                                    select=list(geo_index.bbox_properties((0, 0, 0, 0))))
+        return geo_index.entity_bbox(route_entity)
+    except Exception as e:
+        logging.error(f"Error reading the bounding box of route {row_key}: {e}")
+        return None
+
+
+async def remove_index(index_table, row_key, bbox):
+    if not bbox:
+        return
+    try:
+        await geo_index.remove_route_async(index_table, row_key, bbox)
+        logging.info(f"Index rows of route {row_key} removed successfully.")
+    except Exception as e:
+        logging.error(f"Error removing index rows of route {row_key}: {e}")
+
+
+async def record_removal(changes_table, partition_key, row_key, bbox):
+    try:
+        await changes.record_change_async(changes_table, partition_key, row_key, changes.OP_DELETE, bbox)
+    except Exception as e:
+        logging.error(f"Error recording the removal of route {row_key}: {e}")
+        return
+    # Published once the tombstone can be read from the change log
+    await live_updates.mark_routes_async(get_async_table_client(ROUTE_EVENTS_TABLE), partition_key)
@@ -1,9 +1,10 @@
 import logging
 import azure.functions as func
-import os
-from azure.data.tables import TableClient
 import json
+from shared_code.instrumentation import instrument
+from shared_code.tables import AUTHENTICATION_TABLE, STORAGE_CONFIGURED, get_table_client
 
+@instrument
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a signin request.')
 
@@ -16,14 +17,13 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         if not username or not password:
             return func.HttpResponse("Username and password are required.", status_code=400)
 
-        # Get the connection string
-        connection_string = os.getenv('AzureWebJobsStorage')
-        if not connection_string:
+        # Check the connection string
+        if not STORAGE_CONFIGURED:
             logging.error("AzureWebJobsStorage environment variable is not set.")
             return func.HttpResponse("Internal Server Error", status_code=500)
 
         # Connect to the table
-        table_client = TableClient.from_connection_string(connection_string, table_name='AuthenticationTable')
+        table_client = get_table_client(AUTHENTICATION_TABLE)
 
         try:
             # Retrieve the entity
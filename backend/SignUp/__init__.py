@@ -1,9 +1,10 @@
 import logging
 import azure.functions as func
-import os
-from azure.data.tables import TableClient
+from shared_code.instrumentation import instrument
+from shared_code.tables import AUTHENTICATION_TABLE, get_table_client
 
 
+@instrument
 def main(req: func.HttpRequest, signalrHub: func.Out[str]) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a signup request.')
 
@@ -16,11 +17,8 @@ def main(req: func.HttpRequest, signalrHub: func.Out[str]) -> func.HttpResponse:
         if not username or not password:
             return func.HttpResponse("Username and password are required.", status_code=400)
 
-        # Get the connection string
-        connection_string = os.getenv('AzureWebJobsStorage')
-
         # Connect to the table
-        table_client = TableClient.from_connection_string(connection_string, table_name='AuthenticationTable')
+        table_client = get_table_client(AUTHENTICATION_TABLE)
 
         try:
             # Try to retrieve the entity to check if the user already exists
@@ -0,0 +1,97 @@
+import logging
+import azure.functions as func
+from shared_code import cache, changes, geo_index, ratings, route_match
+from shared_code.bootstrap import core_exceptions
+from shared_code.instrumentation import instrument
+from shared_code.partitions import city_of
+from shared_code.route_store import delete_track
+from shared_code.tables import (COORDINATES_TABLE, METADATA_TABLE, PERSONAL_METADATA_TABLE, RAW_COORDINATES_TABLE,
+                               ROUTE_CHANGES_TABLE, ROUTE_GEO_INDEX_TABLE, ROUTE_MATCH_TABLE, ROUTE_RATINGS_TABLE,
+                               ROUTE_USERS_TABLE, ROUTES_TABLE, STORAGE_CONFIGURED, get_table_client)
+from shared_code.transactions import delete_operations, submit
+
+
+@instrument
+def main(timer: func.TimerRequest) -> None:
+    logging.info('Python timer trigger function swept the removed routes.')
+
+    if not STORAGE_CONFIGURED:
+        logging.error("AzureWebJobsStorage environment variable is not set.")
+        return
+
+    changes_table = get_table_client(ROUTE_CHANGES_TABLE)
+
+    # Every removed route left a copy of its tombstone in the sweep partition of the change log,
+    # it is deleted once the rows of the route are cleaned up
+    tombstones = list(changes_table.query_entities("PartitionKey eq @sweep",
+                                                   parameters={'sweep': changes.SWEEP_PARTITION}))
+    logging.info(f"sweeping {len(tombstones)} removed routes")
+    swept = []
+    for tombstone in tombstones:
+        try:
+            sweep_route(tombstone['route_partition_key'], tombstone['route_row_key'], geo_index.entity_bbox(tombstone))
+            swept.append(tombstone['RowKey'])
+        except Exception as e:
+            # The tombstone is swept again on the next run
+            logging.error(f"Error sweeping route {tombstone['route_row_key']}: {e}")
+    submit(changes_table, delete_operations(changes.SWEEP_PARTITION, swept))
+
+    # Changes past the retention are not read by delta syncs anymore
+    try:
+        prune_changes(changes_table)
+    except Exception as e:
+        logging.error(f"Error pruning the change log: {e}")
+
+
+def sweep_route(partition_key, row_key, bbox):
+    # Index rows RemoveRoute failed to delete, from the bounding box it read or the route row left behind
+    route_table = get_table_client(ROUTES_TABLE)
+    if bbox is None:
+        try:
+            bbox = geo_index.entity_bbox(route_table.get_entity(partition_key=partition_key, row_key=row_key))
+        except core_exceptions.ResourceNotFoundError:
+            pass
+    if bbox is not None:
+        geo_index.remove_route(get_table_client(ROUTE_GEO_INDEX_TABLE), row_key, bbox)
+
+    # Rows of the route partition left behind by a failed removal
+    delete_track(get_table_client(COORDINATES_TABLE), partition_key, row_key)
+    delete_track(get_table_client(RAW_COORDINATES_TABLE), partition_key, row_key)
+    ratings.delete_ratings(get_table_client(ROUTE_RATINGS_TABLE), partition_key, row_key)
+    route_match.remove_route(get_table_client(ROUTE_MATCH_TABLE), partition_key, row_key)
+    for table_client in (route_table, get_table_client(METADATA_TABLE)):
+        try:
+            table_client.delete_entity(partition_key=partition_key, row_key=row_key)
+        except core_exceptions.ResourceNotFoundError:
+            pass
+    delete_personal_metadata(row_key)
+    cache.invalidate(cache.ROUTES, city_of(partition_key))
+
+
+def delete_personal_metadata(row_key):
+    # The personal metadata is partitioned by user, RouteUsers lists the users of the route
+    users_table = get_table_client(ROUTE_USERS_TABLE)
+    user_names = [entity['RowKey'] for entity in users_table.query_entities(
+        "PartitionKey eq @row_key", parameters={'row_key': row_key}, select=['RowKey'])]
+    personal_metadata_table = get_table_client(PERSONAL_METADATA_TABLE)
+    for user_name in user_names:
+        try:
+            personal_metadata_table.delete_entity(partition_key=user_name, row_key=row_key)
+        except core_exceptions.ResourceNotFoundError:
+            pass
+    submit(users_table, delete_operations(row_key, user_names))
+
+
+def prune_changes(changes_table):
+    # One range query per partition of the log, the oldest changes come first in each
+    cutoff = f"{changes.now_ms() - changes.RETENTION_MS:013d}"
+    log_partitions = [entity['RowKey'] for entity in changes_table.query_entities(
+        "PartitionKey eq @partitions", parameters={'partitions': changes.LOG_PARTITIONS}, select=['RowKey'])]
+    pruned = 0
+    for partition_key in log_partitions:
+        expired = [entity['RowKey'] for entity in changes_table.query_entities(
+            "PartitionKey eq @partition_key and RowKey lt @cutoff",
+            parameters={'partition_key': partition_key, 'cutoff': cutoff}, select=['RowKey'])]
+        submit(changes_table, delete_operations(partition_key, expired))
+        pruned += len(expired)
+    logging.info(f"pruned {pruned} expired changes of {len(log_partitions)} partitions")
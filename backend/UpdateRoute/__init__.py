@@ -1,17 +1,21 @@
 import logging
 import azure.functions as func
-import os
-from azure.data.tables import TableClient, UpdateMode
-import json
+from shared_code import cache, changes, live_updates, ratings, route_match
+from shared_code.bootstrap import data_tables
+from shared_code.concurrency import gather_bounded
+from shared_code.instrumentation import instrument, log_payloads
+from shared_code.partitions import city_of
+from shared_code.tables import (METADATA_TABLE, PERSONAL_METADATA_TABLE, ROUTE_CHANGES_TABLE, ROUTE_EVENTS_TABLE,
+                               ROUTE_MATCH_TABLE, ROUTE_RATINGS_TABLE, ROUTE_USERS_TABLE, STORAGE_CONFIGURED,
+                               get_async_table_client)
 
-CONNECTION_STRING = os.getenv('AzureWebJobsStorage')
 
-
-def main(req: func.HttpRequest) -> func.HttpResponse:
+@instrument
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request to update route metadata.')
 
     try:
-        if not CONNECTION_STRING:
+        if not STORAGE_CONFIGURED:
             logging.error("AzureWebJobsStorage environment variable is not set.")
             return func.HttpResponse("Internal Server Error", status_code=500)
 
@@ -26,84 +30,119 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         data = req_body.get('data')
         personal_data = req_body.get('personal_data')
         user_name = req_body.get('user_name')
-        logging.info(f"data received from front is {req_body}")
+        if log_payloads():
+            logging.info(f"data received from front is {req_body}")
 
         if not partition_key or not row_key or not data:
             return func.HttpResponse("partition_key, row_key, and data are required.", status_code=400)
 
-        # Connect to the RouteMetadata table
-        metadata_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='RoutesMetadata')
-        personal_metadata_table = TableClient.from_connection_string(CONNECTION_STRING, table_name='RoutePersonalMetadata')
+        # A run attached to a route of the catalog rates that route, and its personal metadata
+        # follows the route. The other fields, like the name the runner gave the run, would
+        # overwrite those of the route and are ignored.
+        if route_match.ENABLED:
+            resolved = await route_match.resolve_async(get_async_table_client(ROUTE_MATCH_TABLE),
+                                                       partition_key, row_key)
+            if resolved != (partition_key, row_key):
+                ignored = [key for key in data if key != 'score']
+                if ignored:
+                    logging.info(f"Run {row_key} is attached to route {resolved[1]}, ignoring {ignored}")
+                data = {'score': data['score']} if data.get('score') else {}
+                partition_key, row_key = resolved
+                if not data and not personal_data:
+                    return func.HttpResponse("Route metadata updated successfully.", status_code=200)
 
-        # Update RoutesMetadata table
-        try:
-            entity = metadata_table.get_entity(partition_key=partition_key, row_key=row_key)
-        except Exception:
-            entity = {
-                'PartitionKey': partition_key,
-                'RowKey': row_key
-            }
-            for key, value in data.items():
-                if not value:
-                    continue
-                if key == 'score':
-                    entity['score'] = float(value)
-                    entity['count'] = 1
-                else:
-                    entity[key] = value
-            metadata_table.create_entity(entity=entity)
+        # Connect to the RouteMetadata table
+        metadata_table = get_async_table_client(METADATA_TABLE)
+        ratings_table = get_async_table_client(ROUTE_RATINGS_TABLE)
+        personal_metadata_table = get_async_table_client(PERSONAL_METADATA_TABLE)
 
-        try:
-            for key, value in data.items():
-                if not value:
-                    continue
-                if key == 'score':
-                    if 'score' in entity and 'count' in entity:
-                        previous_score = float(entity['score'])
-                        count = int(entity['count'])
-                        new_score = float(value)
-                        new_mean_score = (previous_score * count + new_score) / (count + 1)
-                        entity['score'] = float(new_mean_score)
-                        entity['count'] = count + 1
-                    else:
-                        entity['score'] = float(value)
-                        entity['count'] = 1
-                else:
-                    entity[key] = value
-            metadata_table.update_entity(entity=entity, mode=UpdateMode.REPLACE)
-        except Exception as e:
-            logging.error(f"Error updating RoutesMetadata: {e}")
-            return func.HttpResponse(f"Error updating RoutesMetadata: {e}", status_code=500)
-
-        # Update RoutePersonalMetadata table
+        # Update the RoutesMetadata and RoutePersonalMetadata tables concurrently, and let
+        # delta syncs pick up the updated route
+        updates = [update_metadata(metadata_table, ratings_table, partition_key, row_key, data),
+                   record_change(get_async_table_client(ROUTE_CHANGES_TABLE), partition_key, row_key)]
         if personal_data:
-            try:
-                personal_entity = personal_metadata_table.get_entity(partition_key=user_name, row_key=row_key)
-            except Exception:
-                personal_entity = {
-                    'PartitionKey': user_name,
-                    'RowKey': row_key
-                }
-                for key, value in personal_data.items():
-                    if not value:
-                        continue
-                    personal_entity[key] = value
-                personal_metadata_table.create_entity(entity=personal_entity)
-
-            try:
-                for key, value in personal_data.items():
-                    logging.info(f"for key - {key}, try to enter value - {value}")
-                    if (not value and key != "liked") or (key == "liked" and value is None):
-                        continue
-                    logging.info(f"for key - {key}, entering value - {value}")
-                    personal_entity[key] = value
-                personal_metadata_table.update_entity(entity=personal_entity, mode=UpdateMode.REPLACE)
-            except Exception as e:
-                logging.error(f"Error updating RoutePersonalMetadata: {e}")
-                return func.HttpResponse(f"Error updating RoutePersonalMetadata: {e}", status_code=500)
+            updates.append(update_personal_metadata(personal_metadata_table, user_name, row_key, personal_data))
+        errors = [error for error in await gather_bounded(*updates) if error]
+        # Even a partial update changes what GetRoutes returns
+        cache.invalidate(cache.ROUTES, city_of(partition_key))
+        if errors:
+            return func.HttpResponse(errors[0], status_code=500)
 
         return func.HttpResponse("Route metadata updated successfully.", status_code=200)
 
     except Exception as e:
         logging.error(f"Error processing the request: {e}")
         return func.HttpResponse(f"Something went wrong: {e}", status_code=500)
+
+
+async def update_metadata(metadata_table, ratings_table, partition_key, row_key, data):
+    # Update RoutesMetadata table with one merge, return an error message on failure
+    try:
+        entity = {
+            'PartitionKey': partition_key,
+            'RowKey': row_key
+        }
+        rated = False
+        for key, value in data.items():
+            if not value:
+                continue
+            if key == 'score':
+                # The score is added to the sharded rating counters, the marker lets CompactRatings
+                # fix the aggregate if a concurrent rater caches an older one after ours
+                await ratings.add_rating(ratings_table, partition_key, row_key, float(value))
+                await ratings.mark_dirty(ratings_table, partition_key, row_key)
+                rated = True
+            else:
+                entity[key] = value
+        if len(entity) > 2:
+            await metadata_table.upsert_entity(entity=entity, mode=data_tables.UpdateMode.MERGE)
+        if rated:
+            # GetRoutes reads the mean score and count cached in the metadata
+            await ratings.refresh_rating(ratings_table, metadata_table, partition_key, row_key)
+    except Exception as e:
+        logging.error(f"Error updating RoutesMetadata: {e}")
+        return f"Error updating RoutesMetadata: {e}"
+    return None
+
+
+async def update_personal_metadata(personal_metadata_table, user_name, row_key, personal_data):
+    # Update RoutePersonalMetadata table, return an error message on failure
+    try:
+        personal_entity = await personal_metadata_table.get_entity(partition_key=user_name, row_key=row_key)
+    except Exception:
+        personal_entity = {
+            'PartitionKey': user_name,
+            'RowKey': row_key
+        }
+        for key, value in personal_data.items():
+            if not value:
+                continue
+            personal_entity[key] = value
+        await personal_metadata_table.create_entity(entity=personal_entity)
+        # Lets SweepRoutes find the personal metadata of the route when it is removed
+        await get_async_table_client(ROUTE_USERS_TABLE).upsert_entity(
+            entity={'PartitionKey': row_key, 'RowKey': user_name})
+
+    try:
+        for key, value in personal_data.items():
+            logging.info(f"for key - {key}, try to enter value - {value}")
+            if (not value and key != "liked") or (key == "liked" and value is None):
+                continue
+            logging.info(f"for key - {key}, entering value - {value}")
+            personal_entity[key] = value
+        await personal_metadata_table.update_entity(entity=personal_entity, mode=data_tables.UpdateMode.REPLACE)
+    except Exception as e:
+        logging.error(f"Error updating RoutePersonalMetadata: {e}")
+        return f"Error updating RoutePersonalMetadata: {e}"
+    return None
+
+
+async def record_change(changes_table, partition_key, row_key):
+    try:
+        await changes.record_change_async(changes_table, partition_key, row_key, changes.OP_UPSERT)
+    except Exception as e:
+        logging.error(f"Error recording the change of route {row_key}: {e}")
+        return None
+    # Published once the change can be read from the change log
+    await live_updates.mark_routes_async(get_async_table_client(ROUTE_EVENTS_TABLE), partition_key)
+    return None
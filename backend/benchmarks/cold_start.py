@@ -0,0 +1,129 @@
+"""Cold start benchmark of the functions.
+
+Every function module is imported in a fresh interpreter, like a worker after a
+scale out, and the import time of each function is reported with the modules that
+took the most of it. The worker imports azure.functions before the function modules,
+so the harness does too and it is not counted.
+
+Run from the backend directory::
+
+    python benchmarks/cold_start.py [--runs 5] [--clients] [--json results.json]
+    python benchmarks/cold_start.py --url http://localhost:7071/api/GetRoutes
+
+With --clients the table clients of the worker are built after the import as well,
+with a placeholder connection string when none is set, no request is sent. With --url
+only the time of one request to a local Functions host (func start) is measured,
+restart the host before each run to measure a cold start.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLACEHOLDER_CONNECTION_STRING = ('DefaultEndpointsProtocol=https;AccountName=benchmark;'
+                                 'AccountKey=YmVuY2htYXJr;EndpointSuffix=core.windows.net')
+TOP_MODULES = 3
+
+# Runs in the fresh interpreter, prints the timings as JSON on its last line
+CHILD = """
+import json, sys, time
+import azure.functions
+start = time.perf_counter()
+__import__({name!r})
+imported = time.perf_counter()
+clients_ms = None
+if {clients!r}:
+    from shared_code import tables
+    for table_name in tables.ALL_TABLES:
+        tables.get_table_client(table_name)
+        tables.get_async_table_client(table_name)
+    clients_ms = (time.perf_counter() - imported) * 1000
+print(json.dumps({{'import_ms': (imported - start) * 1000, 'clients_ms': clients_ms}}))
+"""
+
+
+def function_names():
+    return sorted(name for name in os.listdir(BACKEND_DIR)
+                  if os.path.isfile(os.path.join(BACKEND_DIR, name, 'function.json')))
+
+
+def top_modules(importtime_output, function_name):
+    """Return the modules imported by the function or the client setup with the most cumulative time."""
+    modules = []
+    after_functions = False
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.strip() == 'azure.functions':
+            after_functions = True
+            continue
+        # Imports of the function module are indented once, the client setup ones are not
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if after_functions and level <= 1 and name.strip() != function_name:
+            modules.append((int(cumulative), name.strip()))
+    return [name for _, name in sorted(modules, reverse=True)[:TOP_MODULES]]
+
+
+def measure(name, clients):
+    env = dict(os.environ)
+    env.setdefault('AzureWebJobsStorage', PLACEHOLDER_CONNECTION_STRING)
+    # No background preload, only the import itself is measured
+    env.pop('FUNCTIONS_WORKER_RUNTIME', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD.format(name=name, clients=clients)],
+                            cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {name} failed:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['top_modules'] = top_modules(result.stderr, name)
+    return timings
+
+
+def run_imports(runs, clients):
+    results = {}
+    for name in function_names():
+        samples = [measure(name, clients) for _ in range(runs)]
+        results[name] = {
+            'import_ms': statistics.median(sample['import_ms'] for sample in samples),
+            'import_ms_min': min(sample['import_ms'] for sample in samples),
+            'clients_ms': statistics.median(sample['clients_ms'] for sample in samples) if clients else None,
+            'top_modules': samples[-1]['top_modules'],
+        }
+        line = f"{name:<22} import {results[name]['import_ms']:8.1f} ms (min {results[name]['import_ms_min']:.1f})"
+        if clients:
+            line += f"  clients {results[name]['clients_ms']:8.1f} ms"
+        print(f"{line}  {', '.join(results[name]['top_modules'])}")
+    return results
+
+
+def run_request(url):
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        response.read()
+        status = response.status
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{url} answered {status} in {elapsed:.1f} ms")
+    return {'url': url, 'status': status, 'request_ms': elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="fresh interpreters per function, the median is reported")
+    parser.add_argument('--clients', action='store_true', help="also build the table clients after the import")
+    parser.add_argument('--url', help="measure one request to a local Functions host instead")
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+
+    results = run_request(args.url) if args.url else run_imports(args.runs, args.clients)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
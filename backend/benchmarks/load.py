@@ -0,0 +1,307 @@
+"""Load benchmark of the hot paths, on the local storage backends.
+
+Seeds the tables with finished routes through the write path of the functions,
+then drives CollectCoordination, GetRoutes, GetHeatMap and UpdateRoute with many
+concurrent requests, and reports for each scenario the throughput, the p50/p99
+latency and the storage calls per request (from shared_code.instrumentation).
+
+Run from the backend directory::
+
+    python benchmarks/load.py [--backend memory|sqlite] [--routes 1000,10000] [--runners 16]
+                              [--track-points 1000] [--requests 200] [--json results.json]
+    python benchmarks/load.py --routes 1000,10000,100000 --requests 20
+
+The route counts are seeded one after the other, each on top of the previous one.
+Seeding takes a few milliseconds per route, so 100000 routes take minutes, and the
+reads of the whole city take seconds each at that size. The response cache is
+disabled unless --cache is given, so every request reaches the storage. In CI,
+compare with the results of a previous run::
+
+    python benchmarks/load.py --routes 1000 --requests 50 --baseline baseline.json
+
+which fails when a scenario makes more storage calls per request than the baseline,
+or its p99 latency grows by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CITY = 'Tel Aviv'
+# The seeded routes start in this (min_lat, min_lon, max_lat, max_lon) box
+AREA = (32.03, 34.74, 32.13, 34.84)
+SEED_TRACK_POINTS = 30
+COLLECT_BATCH = 20
+VIEWPORT_DEGREES = 0.02
+POINT_SPACING_DEGREES = 0.0001
+POINT_INTERVAL_MS = 5000
+
+
+class InvocationLog(logging.Handler):
+    """Collects the invocation records of shared_code.instrumentation and the errors logged."""
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.storage_calls = {}
+        self.errors = []
+
+    def handle(self, record):
+        if record.levelno >= logging.ERROR:
+            self.errors.append(record.getMessage())
+            return True
+        message = record.getMessage()
+        if message.startswith('{"event": "invocation"'):
+            invocation = json.loads(message)
+            self.storage_calls.setdefault(invocation['function'], []).append(invocation['storage_calls'])
+        return True
+
+
+class Out:
+    """The output binding of CollectCoordination, unused in direct ingest mode."""
+
+    def set(self, value):
+        pass
+
+
+def http_request(func, method, body=None, params=None):
+    return func.HttpRequest(method, '/api/benchmark', params=params or {},
+                            body=json.dumps(body).encode() if body is not None else b'')
+
+
+def track(rng, points):
+    latitude = rng.uniform(AREA[0], AREA[2])
+    longitude = rng.uniform(AREA[1], AREA[3])
+    heading = rng.uniform(-1, 1), rng.uniform(-1, 1)
+    return [(index, latitude + index * POINT_SPACING_DEGREES * heading[0],
+             longitude + index * POINT_SPACING_DEGREES * heading[1], 1700000000000 + index * POINT_INTERVAL_MS)
+            for index in range(points)]
+
+
+def seed(ingest, partitions, rng, start, count):
+    """Write and finish count routes of SEED_TRACK_POINTS points, return their (partition_key, row_key)."""
+    routes = []
+    for number in range(start, start + count):
+        points = track(rng, SEED_TRACK_POINTS)
+        partition_key = partitions.route_partition(CITY, points[0][1], points[0][2])
+        row_key = f"route{number:08d}"
+        ingest.write_points(partition_key, row_key, points, finish=True)
+        ingest.finish_route(partition_key, row_key, points[-1])
+        routes.append((partition_key, row_key))
+    return routes
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_sync(main, requests, runners):
+    """Call a sync main with the requests from runners threads, return the (latency, response) of each."""
+    def call(request):
+        start = time.perf_counter()
+        response = main(*request)
+        return (time.perf_counter() - start) * 1000, response
+
+    with ThreadPoolExecutor(runners) as executor:
+        return list(executor.map(call, requests))
+
+
+def run_async(main, requests, runners):
+    """Call an async main with runners concurrent requests in one event loop, like the worker."""
+    async def run():
+        semaphore = asyncio.Semaphore(runners)
+
+        async def call(request):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await main(*request)
+                return (time.perf_counter() - start) * 1000, response
+
+        return await asyncio.gather(*(call(request) for request in requests))
+
+    return asyncio.run(run())
+
+
+def collect_body(points, finish):
+    return {
+        'partition_key': CITY,
+        'points': [{'index': index, 'coordination': {'latitude': latitude, 'longitude': longitude},
+                    'timestamp': timestamp} for index, latitude, longitude, timestamp in points],
+        'finish_status': finish,
+    }
+
+
+def scenario_collect(modules, func, rng, runners, track_points, _requests, _routes):
+    """Runners record a track each and send it in batches, the last one finishing the route."""
+    main = modules['CollectCoordination'].main
+    tracks = [track(rng, track_points) for _ in range(runners)]
+    # The first batch of a runner starts its route, the next ones carry the keys it returns
+    results = run_sync(main, [(http_request(func, 'POST', collect_body(points[:COLLECT_BATCH], False)), Out())
+                              for points in tracks], runners)
+    requests = []
+    for start in range(COLLECT_BATCH, track_points, COLLECT_BATCH):
+        for points, (_, response) in zip(tracks, results[:runners]):
+            if response.status_code >= 400:
+                continue
+            body = collect_body(points[start:start + COLLECT_BATCH], start + COLLECT_BATCH >= track_points)
+            body.update(json.loads(response.get_body()))
+            requests.append((http_request(func, 'POST', body), Out()))
+    return results + run_sync(main, requests, runners)
+
+
+def viewport(rng):
+    latitude = rng.uniform(AREA[0], AREA[2] - VIEWPORT_DEGREES)
+    longitude = rng.uniform(AREA[1], AREA[3] - VIEWPORT_DEGREES)
+    return f"{latitude},{longitude},{latitude + VIEWPORT_DEGREES},{longitude + VIEWPORT_DEGREES}"
+
+
+def scenario_get_routes_viewport(modules, func, rng, runners, _track_points, requests, _routes):
+    return run_async(modules['GetRoutes'].main,
+                     [(http_request(func, 'GET', params={'partitionKey': CITY, 'bbox': viewport(rng)}),)
+                      for _ in range(requests)], runners)
+
+
+def scenario_get_routes_sorted_page(modules, func, rng, runners, _track_points, requests, _routes):
+    return run_async(modules['GetRoutes'].main,
+                     [(http_request(func, 'GET', params={'partitionKey': CITY, 'page_size': '50',
+                                                         'sort': '-distance_meters'}),)
+                      for _ in range(requests)], runners)
+
+
+def scenario_get_heat_map(modules, func, rng, runners, _track_points, requests, _routes):
+    return run_sync(modules['GetHeatMap'].main,
+                    [(http_request(func, 'GET', params={'bbox': viewport(rng), 'zoom': '15'}),)
+                     for _ in range(requests)], runners)
+
+
+def scenario_update_route(modules, func, rng, runners, _track_points, requests, routes):
+    updates = []
+    for _ in range(requests):
+        partition_key, row_key = rng.choice(routes)
+        updates.append((http_request(func, 'POST', {
+            'partition_key': partition_key, 'row_key': row_key, 'user_name': f"runner{rng.randrange(100)}",
+            'data': {'score': rng.randint(1, 5)}, 'personal_data': {'liked': rng.random() < 0.5},
+        }),))
+    return run_async(modules['UpdateRoute'].main, updates, runners)
+
+
+# (name, function, scenario)
+SCENARIOS = (
+    ('collect', 'CollectCoordination', scenario_collect),
+    ('get_routes_viewport', 'GetRoutes', scenario_get_routes_viewport),
+    ('get_routes_sorted_page', 'GetRoutes', scenario_get_routes_sorted_page),
+    ('get_heat_map', 'GetHeatMap', scenario_get_heat_map),
+    ('update_route', 'UpdateRoute', scenario_update_route),
+)
+
+
+def measure(scenario, function_name, log, *args):
+    log.storage_calls.pop(function_name, None)
+    errors = len(log.errors)
+    start = time.perf_counter()
+    results = scenario(*args)
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    failed = sum(1 for _, response in results if response.status_code >= 400)
+    storage_calls = log.storage_calls.get(function_name, [])
+    return {
+        'requests': len(results),
+        'failed': failed,
+        'throughput_rps': len(results) / elapsed,
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'storage_calls_per_request': statistics.mean(storage_calls) if storage_calls else 0.0,
+        'errors_logged': log.errors[errors:errors + 3],
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against a baseline run, as messages."""
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if result['storage_calls_per_request'] > previous['storage_calls_per_request'] + 0.01:
+            regressions.append(f"{key}: {result['storage_calls_per_request']:.2f} storage calls per request, "
+                               f"was {previous['storage_calls_per_request']:.2f}")
+        if result['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{key}: p99 {result['p99_ms']:.1f} ms, was {previous['p99_ms']:.1f} ms")
+        if result['failed'] > previous['failed']:
+            regressions.append(f"{key}: {result['failed']} failed requests, was {previous['failed']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--routes', default='1000,10000', help="comma separated route counts to seed")
+    parser.add_argument('--runners', type=int, default=16, help="concurrent runners and requests")
+    parser.add_argument('--track-points', type=int, default=1000, help="points of the tracks the runners record")
+    parser.add_argument('--requests', type=int, default=200, help="requests of the read and update scenarios")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cache', action='store_true', help="keep the response cache enabled")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results of a previous run to compare with, exit 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="allowed p99 growth over the baseline")
+    args = parser.parse_args()
+    route_counts = sorted(int(count) for count in args.routes.split(','))
+
+    # The configuration is read when the modules are imported
+    os.environ['STORAGE_BACKEND'] = args.backend
+    if args.backend == 'sqlite':
+        os.environ['STORAGE_SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    os.environ['INSTRUMENTATION'] = 'log'
+    os.environ['INGEST_MODE'] = 'direct'
+    os.environ['HISTOGRAM_LOG_SECONDS'] = '1e9'
+    if not args.cache:
+        os.environ['CACHE_TTL_SECONDS'] = '0'
+    sys.path.insert(0, BACKEND_DIR)
+    log = InvocationLog()
+    logging.basicConfig(level=logging.INFO, handlers=[log], force=True)
+
+    import azure.functions as func
+    from shared_code import ingest, partitions
+    modules = {function_name: __import__(function_name) for _, function_name, _ in SCENARIOS}
+
+    rng = random.Random(args.seed)
+    routes = []
+    results = {}
+    for route_count in route_counts:
+        start = time.perf_counter()
+        routes += seed(ingest, partitions, rng, len(routes), route_count - len(routes))
+        print(f"Seeded {route_count} routes in {time.perf_counter() - start:.1f} s")
+        for name, function_name, scenario in SCENARIOS:
+            key = f"{name}@{route_count}"
+            results[key] = measure(scenario, function_name, log, modules, func, rng, args.runners,
+                                   args.track_points, args.requests, routes)
+            result = results[key]
+            print(f"  {name:<24} {result['requests']:6d} requests {result['throughput_rps']:8.1f}/s  "
+                  f"p50 {result['p50_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  "
+                  f"{result['storage_calls_per_request']:6.1f} storage calls/request"
+                  + (f"  {result['failed']} failed" if result['failed'] else ''))
+            for error in result['errors_logged']:
+                print(f"    {error}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import azure.functions as func
+from shared_code.instrumentation import instrument
 
 
+@instrument
 def main(req: func.HttpRequest, connectionInfo) -> func.HttpResponse:
     # Real authentication is needed here.
     # For now anyone can connect to our hub!
@@ -0,0 +1,66 @@
+"""Shared bootstrap of the functions, keeps the import of the function modules cheap.
+
+The worker imports every function module before it serves the first request, so
+whatever the modules import at the top is paid by the first request after a scale
+out. The Azure SDKs take most of that time. The modules use them through the
+lazy_import proxies below, which import a module when one of its attributes is first
+used, and the table clients are built once per worker on a background thread, while
+the host is still starting. benchmarks/cold_start.py measures the import times.
+"""
+import importlib
+import logging
+import os
+import threading
+
+# Set by the Functions host, the CLIs and benchmarks build their clients on demand
+IN_FUNCTIONS_HOST = bool(os.getenv('FUNCTIONS_WORKER_RUNTIME'))
+PRELOAD_TABLE_CLIENTS = os.getenv('PRELOAD_TABLE_CLIENTS', '1') != '0'
+
+_preload_lock = threading.Lock()
+_preload_started = False
+
+
+class LazyModule:
+    """A module that is imported when one of its attributes is first used."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name}>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+# The SDK modules used across the functions
+azure_core = lazy_import('azure.core')
+core_exceptions = lazy_import('azure.core.exceptions')
+data_tables = lazy_import('azure.data.tables')
+
+
+def preload():
+    """Build the table clients of the worker on a background thread, once per worker."""
+    global _preload_started
+    if not IN_FUNCTIONS_HOST or not PRELOAD_TABLE_CLIENTS:
+        return
+    with _preload_lock:
+        if _preload_started:
+            return
+        _preload_started = True
+    threading.Thread(target=_preload_table_clients, name='preload-table-clients', daemon=True).start()
+
+
+def _preload_table_clients():
+    # Imported here, shared_code.tables starts the preload when it is imported
+    from shared_code import tables
+    try:
+        for table_name in tables.ALL_TABLES:
+            tables.get_table_client(table_name)
+            tables.get_async_table_client(table_name)
+    except Exception as e:
+        logging.error(f"Error preloading the table clients: {e}")
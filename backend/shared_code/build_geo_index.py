@@ -0,0 +1,41 @@
+"""Index the routes finished before the geospatial index existed.
+
+Run from the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.build_geo_index
+"""
+import logging
+
+from shared_code import geo_index
+from shared_code.bootstrap import data_tables
+from shared_code.route_store import read_track
+from shared_code.tables import (CONNECTION_STRING, COORDINATES_TABLE, ROUTE_GEO_INDEX_TABLE, ROUTES_TABLE,
+                                get_table_client)
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    route_table = get_table_client(ROUTES_TABLE)
+    coord_table = get_table_client(COORDINATES_TABLE)
+    index_table = get_table_client(ROUTE_GEO_INDEX_TABLE)
+
+    indexed = 0
+    for entity in route_table.list_entities():
+        # Only finished routes that were never indexed
+        if entity.get('end_cord_latitude') is None or geo_index.entity_bbox(entity) is not None:
+            continue
+        track = read_track(coord_table, entity['PartitionKey'], entity['RowKey'])
+        if not track:
+            continue
+        bbox = geo_index.index_route(index_table, entity['PartitionKey'], entity['RowKey'], track)
+        route_entity = {'PartitionKey': entity['PartitionKey'], 'RowKey': entity['RowKey']}
+        route_entity.update(geo_index.bbox_properties(bbox))
+        route_table.update_entity(entity=route_entity, mode=data_tables.UpdateMode.MERGE)
+        indexed += 1
+    logging.info(f"Indexed {indexed} routes")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,56 @@
+"""Rebuild the HeatMapGrid counters from the heat map points and the recorded routes.
+
+The grid only counts the points written since it was introduced. This recomputes
+the count of every cell from HeatMapTable and AllRouteCoordinations, the sources of
+the raw heat map, so it also covers the older points and running it again is safe.
+Remove the duplicated routes with shared_code.migrate_heat_map first.
+
+Run from the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.build_heat_grid
+
+A point written while it runs may be missing from the count of its cell, run it
+when few routes are recorded. The counters of precisions 5 and 6, which earlier
+versions also kept, are deleted.
+"""
+import logging
+from collections import Counter
+
+from shared_code import cache
+from shared_code.geohash import encode
+from shared_code.heat_grid import CELL_PRECISION, grid_partition_key
+from shared_code.route_store import decode_entity
+from shared_code.tables import (CONNECTION_STRING, COORDINATES_TABLE, HEAT_MAP_GRID_TABLE, HEAT_MAP_TABLE,
+                                get_table_client)
+from shared_code.transactions import submit
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+
+    counts = Counter()
+    for table_name in (HEAT_MAP_TABLE, COORDINATES_TABLE):
+        points = 0
+        # Every chunk row holds distinct points, the rows of a route need no grouping
+        for entity in get_table_client(table_name).list_entities():
+            for _, latitude, longitude, _ in decode_entity(entity):
+                counts[encode(latitude, longitude, CELL_PRECISION)] += 1
+                points += 1
+        logging.info(f"Counted {points} points of {table_name}")
+
+    grid_table = get_table_client(HEAT_MAP_GRID_TABLE)
+    submit(grid_table, [('upsert', {'PartitionKey': grid_partition_key(cell), 'RowKey': cell, 'count': count})
+                        for cell, count in counts.items()])
+    # The partitions of a precision start with it, the coarser ones sort first
+    coarse = list(grid_table.query_entities("PartitionKey lt @first", parameters={'first': f"{CELL_PRECISION}_"},
+                                            select=['PartitionKey', 'RowKey']))
+    submit(grid_table, [('delete', {'PartitionKey': entity['PartitionKey'], 'RowKey': entity['RowKey']})
+                        for entity in coarse])
+    cache.invalidate(cache.HEAT_MAP)
+    logging.info(f"Wrote {len(counts)} heat map cells, deleted {len(coarse)} coarser cells")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
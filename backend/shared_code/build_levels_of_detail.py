@@ -0,0 +1,47 @@
+"""Store the levels of detail of the routes finished before they were built at finish time.
+
+Run from the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.build_levels_of_detail
+
+Until then GetRoutes simplifies the tracks of these routes on every request.
+"""
+import logging
+
+from shared_code import cache
+from shared_code.bootstrap import data_tables
+from shared_code.partitions import city_of
+from shared_code.route_store import read_track
+from shared_code.simplify import DEFAULT_DETAIL, build_levels_of_detail, lod_property
+from shared_code.tables import CONNECTION_STRING, COORDINATES_TABLE, ROUTES_TABLE, get_table_client
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    route_table = get_table_client(ROUTES_TABLE)
+    coord_table = get_table_client(COORDINATES_TABLE)
+
+    updated = 0
+    partitions = set()
+    for entity in route_table.list_entities(select=['PartitionKey', 'RowKey', 'end_cord_latitude',
+                                                    lod_property(DEFAULT_DETAIL)]):
+        # Only finished routes without levels of detail
+        if entity.get('end_cord_latitude') is None or entity.get(lod_property(DEFAULT_DETAIL)) is not None:
+            continue
+        track = read_track(coord_table, entity['PartitionKey'], entity['RowKey'])
+        if not track:
+            continue
+        route_entity = {'PartitionKey': entity['PartitionKey'], 'RowKey': entity['RowKey']}
+        route_entity.update(build_levels_of_detail(track))
+        route_table.update_entity(entity=route_entity, mode=data_tables.UpdateMode.MERGE)
+        partitions.add(entity['PartitionKey'])
+        updated += 1
+    for partition_key in partitions:
+        cache.invalidate(cache.ROUTES, city_of(partition_key))
+    logging.info(f"Stored the levels of detail of {updated} routes")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,45 @@
+"""Store the match signatures of the routes finished before runs were matched to the catalog.
+
+Run from the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.build_route_match
+
+Until then new runs of these routes join the catalog as routes of their own. Routes
+already in the catalog are only indexed, never attached to each other.
+"""
+import logging
+
+from shared_code import route_match
+from shared_code.partitions import city_of
+from shared_code.route_store import read_track
+from shared_code.tables import CONNECTION_STRING, COORDINATES_TABLE, ROUTE_MATCH_TABLE, ROUTES_TABLE, get_table_client
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    route_table = get_table_client(ROUTES_TABLE)
+    coord_table = get_table_client(COORDINATES_TABLE)
+    match_table = get_table_client(ROUTE_MATCH_TABLE)
+
+    # The shape rows of the routes indexed already, s_<row_key> in the partition of their city
+    indexed = {(entity['PartitionKey'], entity['RowKey'][2:]) for entity in match_table.query_entities(
+        "RowKey ge @first and RowKey lt @last", parameters={'first': 's_', 'last': 's`'},
+        select=['PartitionKey', 'RowKey'])}
+
+    updated = 0
+    for entity in route_table.list_entities(select=['PartitionKey', 'RowKey', 'end_cord_latitude']):
+        # Only finished routes without a signature
+        if entity.get('end_cord_latitude') is None or (city_of(entity['PartitionKey']), entity['RowKey']) in indexed:
+            continue
+        signature = route_match.signature(read_track(coord_table, entity['PartitionKey'], entity['RowKey']))
+        if signature is None:
+            continue
+        route_match.index_route(match_table, entity['PartitionKey'], entity['RowKey'], signature)
+        updated += 1
+    logging.info(f"Stored the match signatures of {updated} routes")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,45 @@
+"""Store the statistics of the routes finished before they were computed at finish time.
+
+Run from the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.build_route_stats
+"""
+import logging
+
+from shared_code import cache
+from shared_code.bootstrap import data_tables
+from shared_code.partitions import city_of
+from shared_code.route_stats import DURATION, route_stats
+from shared_code.route_store import read_track
+from shared_code.tables import CONNECTION_STRING, COORDINATES_TABLE, ROUTES_TABLE, get_table_client
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    route_table = get_table_client(ROUTES_TABLE)
+    coord_table = get_table_client(COORDINATES_TABLE)
+
+    updated = 0
+    partitions = set()
+    for entity in route_table.list_entities():
+        # Only finished routes without statistics, or stored without a duration before it
+        # was taken from the point indexes
+        if entity.get('end_cord_latitude') is None or entity.get(DURATION) is not None:
+            continue
+        track = read_track(coord_table, entity['PartitionKey'], entity['RowKey'])
+        if not track:
+            continue
+        route_entity = {'PartitionKey': entity['PartitionKey'], 'RowKey': entity['RowKey']}
+        route_entity.update(route_stats(track))
+        route_table.update_entity(entity=route_entity, mode=data_tables.UpdateMode.MERGE)
+        partitions.add(entity['PartitionKey'])
+        updated += 1
+    for partition_key in partitions:
+        cache.invalidate(cache.ROUTES, city_of(partition_key))
+    logging.info(f"Stored the statistics of {updated} routes")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,133 @@
+"""Read-through cache of the responses of the read endpoints.
+
+Responses are cached in process in an LRU with a TTL, and in Redis too when
+REDIS_URL is set and the redis package is installed. Entries are keyed by a
+generation number per (namespace, partition) that writers bump to invalidate
+them. With Redis the generations are shared, so a write invalidates the entries
+of every worker, otherwise only those of the writing worker and the others expire
+with the TTL.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '256'))
+TTL_SECONDS = float(os.getenv('CACHE_TTL_SECONDS', '60'))
+# Larger bodies are not cached, a few of them would evict everything else
+MAX_BODY_BYTES = int(os.getenv('CACHE_MAX_BODY_BYTES', str(1024 * 1024)))
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Only imported when it is used, to keep the cold start of the workers without Redis short
+redis = None
+if REDIS_URL:
+    try:
+        import redis
+    except ImportError:
+        pass
+
+# Namespaces of the cached endpoints
+ROUTES = 'routes'
+HEAT_MAP = 'heat_map'
+# The heat map is not partitioned, its entries live in one partition of the namespace
+ALL_PARTITIONS = '*'
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_generations = {}
+_redis_client = None
+
+
+def _get_redis():
+    global _redis_client
+    if redis is None or not REDIS_URL:
+        return None
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis_client
+
+
+def _generation_key(namespace, partition_key):
+    return f"cache:generation:{namespace}:{partition_key}"
+
+
+def _generation(namespace, partition_key):
+    client = _get_redis()
+    if client is not None:
+        try:
+            return int(client.get(_generation_key(namespace, partition_key)) or 0)
+        except Exception as e:
+            logging.error(f"Error reading the cache generation from Redis: {e}")
+    with _lock:
+        return _generations.get((namespace, partition_key), 0)
+
+
+def invalidate(namespace, partition_key=ALL_PARTITIONS):
+    """Invalidate the cached responses of a partition of a namespace."""
+    with _lock:
+        _generations[(namespace, partition_key)] = _generations.get((namespace, partition_key), 0) + 1
+    client = _get_redis()
+    if client is not None:
+        try:
+            client.incr(_generation_key(namespace, partition_key))
+        except Exception as e:
+            logging.error(f"Error bumping the cache generation in Redis: {e}")
+
+
+def entry_key(namespace, partition_key, params):
+    generation = _generation(namespace, partition_key)
+    query = json.dumps(sorted(params.items()))
+    return f"cache:{namespace}:{partition_key}:{generation}:{hashlib.sha256(query.encode()).hexdigest()}"
+
+
+def get(key):
+    """Return the cached (body, mimetype, headers) of a key, or None."""
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                _entries.move_to_end(key)
+                return value
+            del _entries[key]
+
+    client = _get_redis()
+    if client is None:
+        return None
+    try:
+        data = client.get(key)
+    except Exception as e:
+        logging.error(f"Error reading the cache from Redis: {e}")
+        return None
+    if data is None:
+        return None
+    stored = json.loads(data)
+    value = (base64.b64decode(stored['body']), stored['mimetype'], stored['headers'])
+    _put_local(key, value)
+    return value
+
+
+def put(key, body, mimetype, headers):
+    if len(body) > MAX_BODY_BYTES:
+        return
+    value = (body, mimetype, dict(headers))
+    _put_local(key, value)
+    client = _get_redis()
+    if client is not None:
+        try:
+            client.setex(key, int(TTL_SECONDS), json.dumps({'body': base64.b64encode(body).decode(),
+                                                            'mimetype': mimetype, 'headers': dict(headers)}))
+        except Exception as e:
+            logging.error(f"Error writing the cache to Redis: {e}")
+
+
+def _put_local(key, value):
+    with _lock:
+        _entries[key] = (time.monotonic() + TTL_SECONDS, value)
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
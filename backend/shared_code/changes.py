@@ -0,0 +1,116 @@
+"""Change log of the routes of every partition, used for delta syncs.
+
+Every write that changes a route appends a row keyed by the epoch millisecond
+of the change, so the changes after a watermark are read with one range query.
+Removed routes leave a 'delete' row, the tombstone clients apply on their side.
+
+Two more partitions of the table serve SweepRoutes, so it reads them with one
+partition query each instead of scanning the whole log:
+
+    ~sweep        a copy of every tombstone not swept yet, with the bounding box of the route
+    ~partitions   one row per partition of the log, pruned one after the other
+"""
+import time
+from datetime import datetime, timezone
+
+from shared_code.concurrency import collect
+from shared_code.geo_index import bbox_properties
+
+OP_UPSERT = 'upsert'
+OP_DELETE = 'delete'
+# Changes are re-read this far before the watermark, as clocks of the workers may drift.
+# Applying a change twice is harmless for clients.
+OVERLAP_MS = 5000
+# Changes older than this may be swept, clients with an older watermark get a full sync
+RETENTION_MS = 30 * 24 * 3600 * 1000
+# Not route partitions, the cities never start with '~'
+SWEEP_PARTITION = '~sweep'
+LOG_PARTITIONS = '~partitions'
+
+# Log partitions this worker registered already, registering is idempotent
+_registered = set()
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def parse_since(value):
+    """Parse the since watermark query parameter, None when missing, raise ValueError if invalid."""
+    if not value:
+        return None
+    try:
+        since = int(value)
+    except ValueError:
+        raise ValueError("since must be a watermark returned by a previous sync.")
+    if since < 0:
+        raise ValueError("since must be a watermark returned by a previous sync.")
+    return since
+
+
+def since_datetime(since):
+    """Return the datetime to compare entity Timestamps with for a watermark, overlap included."""
+    return datetime.fromtimestamp(max(since - OVERLAP_MS, 0) / 1000, tz=timezone.utc)
+
+
+def change_entity(partition_key, row_key, op):
+    return {
+        'PartitionKey': partition_key,
+        'RowKey': f"{now_ms():013d}_{row_key}",
+        'route_row_key': row_key,
+        'op': op,
+    }
+
+
+def _entities(partition_key, row_key, op, bbox):
+    # The change, the copy of a tombstone for SweepRoutes and the first change of a partition in this worker
+    entity = change_entity(partition_key, row_key, op)
+    entities = [entity]
+    if op == OP_DELETE:
+        sweep_entity = dict(entity, PartitionKey=SWEEP_PARTITION, route_partition_key=partition_key)
+        if bbox:
+            sweep_entity.update(bbox_properties(bbox))
+        entities.append(sweep_entity)
+    if partition_key not in _registered:
+        entities.append({'PartitionKey': LOG_PARTITIONS, 'RowKey': partition_key})
+    return entities
+
+
+def record_change(table_client, partition_key, row_key, op, bbox=None):
+    """Append a change of a route, bbox is the bounding box of a removed route, if known."""
+    for entity in _entities(partition_key, row_key, op, bbox):
+        table_client.upsert_entity(entity=entity)
+    _registered.add(partition_key)
+
+
+async def record_change_async(table_client, partition_key, row_key, op, bbox=None):
+    """Like record_change with an aio TableClient."""
+    for entity in _entities(partition_key, row_key, op, bbox):
+        await table_client.upsert_entity(entity=entity)
+    _registered.add(partition_key)
+
+
+def _fold(entities, since):
+    # The last change of a route wins, the watermark is the time of the latest change
+    ops = {}
+    watermark = since
+    for entity in sorted(entities, key=lambda entity: entity['RowKey']):
+        ops[entity['route_row_key']] = entity['op']
+        watermark = max(watermark, int(entity['RowKey'].split('_', 1)[0]))
+    changed = {row_key for row_key, op in ops.items() if op == OP_UPSERT}
+    deleted = sorted(row_key for row_key, op in ops.items() if op == OP_DELETE)
+    return changed, deleted, watermark
+
+
+async def read_changes_async(table_client, partition_key, since):
+    """Return the (changed RowKeys, deleted RowKeys, new watermark) of a partition since a watermark.
+
+    The changed RowKeys are None when the watermark is older than the retention
+    of the change log, the client then needs a full sync.
+    """
+    if since < now_ms() - RETENTION_MS:
+        return None, [], now_ms()
+    entities = await collect(table_client.query_entities(
+        "PartitionKey eq @partition_key and RowKey ge @first",
+        parameters={'partition_key': partition_key, 'first': f"{max(since - OVERLAP_MS, 0):013d}"}))
+    return _fold(entities, since)
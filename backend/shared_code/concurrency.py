@@ -0,0 +1,21 @@
+import asyncio
+import os
+
+# Maximum number of storage calls an invocation runs at once
+MAX_CONCURRENCY = int(os.getenv('STORAGE_MAX_CONCURRENCY', '8'))
+
+
+async def gather_bounded(*awaitables, limit=MAX_CONCURRENCY):
+    """Await all awaitables concurrently, at most limit at a time, and return their results in order."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(awaitable):
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*(run(awaitable) for awaitable in awaitables))
+
+
+async def collect(async_iterable):
+    """Return the items of an async iterable, such as an aio query_entities pager, as a list."""
+    return [item async for item in async_iterable]
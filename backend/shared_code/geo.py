@@ -0,0 +1,43 @@
+import math
+
+EARTH_RADIUS_METERS = 6371e3
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Return the distance in meters between two points."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """Return the initial bearing in degrees from the first point to the second, 0 is north."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_lambda = math.radians(lon2 - lon1)
+    y = math.sin(d_lambda) * math.cos(phi2)
+    x = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(d_lambda)
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+def parse_bbox(value):
+    """Parse a 'min_lat,min_lon,max_lat,max_lon' query parameter, raise ValueError if invalid."""
+    try:
+        min_lat, min_lon, max_lat, max_lon = (float(part) for part in value.split(','))
+    except ValueError:
+        raise ValueError("bbox must be min_lat,min_lon,max_lat,max_lon.")
+    if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= max_lon <= 180):
+        raise ValueError("bbox is out of range.")
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def bbox_intersects(first, second):
+    return (first[0] <= second[2] and second[0] <= first[2]
+            and first[1] <= second[3] and second[1] <= first[3])
+
+
+def contains(bbox, latitude, longitude):
+    return bbox[0] <= latitude <= bbox[2] and bbox[1] <= longitude <= bbox[3]
@@ -0,0 +1,163 @@
+"""Secondary index of finished routes by geohash cell.
+
+A route gets one index row per precision-5 cell (about 4.9km) its bounding box
+touches. Rows are partitioned by the precision-4 prefix of their cell and carry
+the route start and bounding box, so viewport and radius queries are answered
+from the index alone and only the matching routes are read afterwards.
+"""
+import math
+
+from shared_code.concurrency import collect, gather_bounded
+from shared_code.geo import bbox_intersects, haversine
+from shared_code.geohash import cover
+from shared_code.transactions import delete_operations, submit, submit_async
+
+INDEX_PRECISION = 5
+PARTITION_PRECISION = 4
+# Above this number of cells a query is not worth answering from the index
+MAX_QUERY_CELLS = 1024
+METERS_PER_DEGREE = 111320.0
+
+
+def track_bbox(track):
+    """Return the (min_lat, min_lon, max_lat, max_lon) bounding box of a track."""
+    latitudes = [point[1] for point in track]
+    longitudes = [point[2] for point in track]
+    return min(latitudes), min(longitudes), max(latitudes), max(longitudes)
+
+
+def radius_bbox(latitude, longitude, radius):
+    """Return the bounding box of a circle with a radius in meters."""
+    d_lat = radius / METERS_PER_DEGREE
+    d_lon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    return (max(latitude - d_lat, -90.0), max(longitude - d_lon, -180.0),
+            min(latitude + d_lat, 90.0), min(longitude + d_lon, 180.0))
+
+
+def bbox_properties(bbox):
+    return {
+        'bbox_min_latitude': bbox[0],
+        'bbox_min_longitude': bbox[1],
+        'bbox_max_latitude': bbox[2],
+        'bbox_max_longitude': bbox[3],
+    }
+
+
+def entity_bbox(entity):
+    """Return the bounding box stored on an entity by bbox_properties, or None."""
+    bbox = (entity.get('bbox_min_latitude'), entity.get('bbox_min_longitude'),
+            entity.get('bbox_max_latitude'), entity.get('bbox_max_longitude'))
+    return None if None in bbox else bbox
+
+
+def index_entities(partition_key, row_key, start, bbox):
+    """Return the index rows of a route with its (latitude, longitude) start and bounding box."""
+    entities = []
+    for cell in sorted(cover(bbox, INDEX_PRECISION)):
+        entity = {
+            'PartitionKey': cell[:PARTITION_PRECISION],
+            'RowKey': f"{cell}_{row_key}",
+            'route_partition_key': partition_key,
+            'route_row_key': row_key,
+            'start_latitude': start[0],
+            'start_longitude': start[1],
+        }
+        entity.update(bbox_properties(bbox))
+        entities.append(entity)
+    return entities
+
+
+def index_route(table_client, partition_key, row_key, track):
+    """Index a finished route by the cells of its track, return its bounding box.
+
+    The rows sharing a partition are upserted in one transaction.
+    """
+    bbox = track_bbox(track)
+    submit(table_client, [('upsert', entity)
+                          for entity in index_entities(partition_key, row_key, track[0][1:3], bbox)])
+    return bbox
+
+
+def _remove_operations(row_key, bbox):
+    operations = []
+    for cell in sorted(cover(bbox, INDEX_PRECISION)):
+        operations.extend(delete_operations(cell[:PARTITION_PRECISION], [f"{cell}_{row_key}"]))
+    return operations
+
+
+def remove_route(table_client, row_key, bbox):
+    """Delete the index rows of a route indexed with bbox."""
+    submit(table_client, _remove_operations(row_key, bbox))
+
+
+async def remove_route_async(table_client, row_key, bbox):
+    """Like remove_route with an aio TableClient, the partitions are handled concurrently."""
+    await submit_async(table_client, _remove_operations(row_key, bbox))
+
+
+def _query_plan(bbox):
+    # Group the cells covering bbox by index partition, None when bbox is too large
+    cells = cover(bbox, INDEX_PRECISION, MAX_QUERY_CELLS)
+    if cells is None:
+        return None
+    by_partition = {}
+    for cell in cells:
+        by_partition.setdefault(cell[:PARTITION_PRECISION], []).append(cell)
+    return by_partition
+
+
+def _query_partition(table_client, index_partition, cells):
+    # The index rows of a cell share the cell prefix, so one RowKey range covers the cells
+    return table_client.query_entities(
+        "PartitionKey eq @index_partition and RowKey ge @first and RowKey lt @last",
+        parameters={'index_partition': index_partition, 'first': min(cells), 'last': f"{max(cells)}~"})
+
+
+def _match(entity, cells, partition_keys, bbox, near):
+    if entity['RowKey'][:INDEX_PRECISION] not in cells or entity['route_partition_key'] not in partition_keys:
+        return False
+    if not bbox_intersects(entity_bbox(entity), bbox):
+        return False
+    if near and haversine(near[0], near[1], entity['start_latitude'], entity['start_longitude']) > near[2]:
+        return False
+    return True
+
+
+def query_routes(table_client, partition_key, bbox, near=None):
+    """Return the RowKeys of the routes of a partition whose bounding box intersects bbox.
+
+    With near=(latitude, longitude, radius) only the routes starting within the
+    radius are returned. Returns None when bbox is too large for the index.
+    """
+    by_partition = _query_plan(bbox)
+    if by_partition is None:
+        return None
+    row_keys = set()
+    for index_partition, cells in by_partition.items():
+        cells = set(cells)
+        for entity in _query_partition(table_client, index_partition, cells):
+            if _match(entity, cells, {partition_key}, bbox, near):
+                row_keys.add(entity['route_row_key'])
+    return row_keys
+
+
+async def query_routes_async(table_client, partition_key, bbox, near=None):
+    """Like query_routes with an aio TableClient, the index partitions are queried concurrently."""
+    routes = await query_partition_routes_async(table_client, [partition_key], bbox, near)
+    return None if routes is None else routes[partition_key]
+
+
+async def query_partition_routes_async(table_client, partition_keys, bbox, near=None):
+    """Like query_routes_async for the routes of several partitions, returns {partition_key: RowKeys}."""
+    by_partition = _query_plan(bbox)
+    if by_partition is None:
+        return None
+    partitions = [(index_partition, set(cells)) for index_partition, cells in by_partition.items()]
+    results = await gather_bounded(*(collect(_query_partition(table_client, index_partition, cells))
+                                     for index_partition, cells in partitions))
+    routes = {partition_key: set() for partition_key in partition_keys}
+    for (_, cells), entities in zip(partitions, results):
+        for entity in entities:
+            if _match(entity, cells, routes, bbox, near):
+                routes[entity['route_partition_key']].add(entity['route_row_key'])
+    return routes
@@ -0,0 +1,83 @@
+"""Minimal geohash encoding used to key the spatial aggregates and indexes."""
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_DECODE = {char: i for i, char in enumerate(BASE32)}
+
+
+def encode(latitude, longitude, precision):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    cell = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(cell) < precision:
+        value_range, value = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits <<= 1
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            cell.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(cell)
+
+
+def decode_bbox(cell):
+    """Return the (min_lat, min_lon, max_lat, max_lon) bounding box of a cell."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in cell:
+        bits = _DECODE[char]
+        for shift in range(4, -1, -1):
+            value_range = lon_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def decode(cell):
+    """Return the (latitude, longitude) center of a cell."""
+    min_lat, min_lon, max_lat, max_lon = decode_bbox(cell)
+    return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+
+def cell_size(precision):
+    """Return the (height, width) in degrees of the cells of a precision."""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def cover(bbox, precision, max_cells=None):
+    """Return the cells of a precision that intersect a (min_lat, min_lon, max_lat, max_lon) bbox.
+
+    Returns None when more than max_cells cells would be needed.
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    height, width = cell_size(precision)
+    # Snap the start to the cell grid so every step lands in a new cell
+    start_lat = max(-90.0, (min_lat + 90.0) // height * height - 90.0)
+    start_lon = max(-180.0, (min_lon + 180.0) // width * width - 180.0)
+    rows = int((max_lat - start_lat) // height) + 1
+    columns = int((max_lon - start_lon) // width) + 1
+    if max_cells is not None and rows * columns > max_cells:
+        return None
+    cells = set()
+    for row in range(rows):
+        latitude = min(start_lat + (row + 0.5) * height, 90.0)
+        for column in range(columns):
+            longitude = min(start_lon + (column + 0.5) * width, 180.0)
+            cells.add(encode(latitude, longitude, precision))
+    return cells
@@ -0,0 +1,109 @@
+"""Ingest-time filtering of the GPS samples of a route.
+
+The app sends a sample every 5 seconds, so a run stores every wait at a traffic
+light as a cloud of jitter, and now and then a fix jumps hundreds of meters away.
+filter_points drops, in one pass over a batch:
+
+- speed outliers, points that could only be reached from the last kept point
+  faster than MAX_SPEED_MPS, give or take the GPS noise,
+- stationary samples, within STATIONARY_RADIUS_METERS of the cluster of samples
+  around the last kept point. The cluster is anchored at its centroid, so the
+  jitter of a phone standing still rarely leaves it,
+- points that add less than MIN_DISTANCE_METERS to the track without turning it
+  by MIN_HEADING_CHANGE_DEGREES, over a segment longer than the cluster radius.
+
+The last two only drop points reached slower than MIN_MOVING_SPEED_MPS, a runner
+keeps every sample however close the app sends them.
+Points keep their index, so the stored track is the raw one with samples left out.
+The cluster and the count of outliers in a row are state of their own, stored with
+the track as the app sends one sample per request, see
+shared_code.route_store.append_points.
+GPS_FILTER=0 stores every sample. The raw samples are also stored in
+RawRouteCoordinations for requests with keep_raw, defaulting to GPS_KEEP_RAW.
+"""
+import os
+
+from shared_code.geo import bearing, haversine
+
+ENABLED = os.getenv('GPS_FILTER', '1') != '0'
+KEEP_RAW = os.getenv('GPS_KEEP_RAW', '0') == '1'
+# Well above a sprint, below anything a GPS jump produces between two samples
+MAX_SPEED_MPS = float(os.getenv('GPS_MAX_SPEED_MPS', '12'))
+# About the noise of a phone GPS
+STATIONARY_RADIUS_METERS = float(os.getenv('GPS_STATIONARY_RADIUS_METERS', '15'))
+MIN_DISTANCE_METERS = float(os.getenv('GPS_MIN_DISTANCE_METERS', '20'))
+MIN_HEADING_CHANGE_DEGREES = float(os.getenv('GPS_MIN_HEADING_CHANGE_DEGREES', '25'))
+# Slower than a jog, the jitter of a phone standing still seldom looks faster
+MIN_MOVING_SPEED_MPS = float(os.getenv('GPS_MIN_MOVING_SPEED_MPS', '2'))
+# Sample interval of the app, for the points sent without a timestamp
+SAMPLE_INTERVAL_SECONDS = 5
+# After this many outliers in a row the runner really moved, e.g. the fix was lost
+# in a tunnel, and the next point is kept whatever its speed
+MAX_OUTLIER_RUN = 3
+
+
+def _elapsed_seconds(first, second):
+    if first[3] is not None and second[3] is not None and second[3] > first[3]:
+        return (second[3] - first[3]) / 1000
+    return max(second[0] - first[0], 1) * SAMPLE_INTERVAL_SECONDS
+
+
+def _turns(kept, point):
+    # Whether point turns the track by a meaningful heading change from its last segment
+    if len(kept) < 2:
+        return False
+    (_, lat0, lon0, _), (_, lat1, lon1, _) = kept[-2], kept[-1]
+    change = abs(bearing(lat0, lon0, lat1, lon1) - bearing(lat1, lon1, point[1], point[2])) % 360
+    return min(change, 360 - change) >= MIN_HEADING_CHANGE_DEGREES
+
+
+def encode_state(cluster, outliers):
+    """Return the stored form of an (anchor index, latitude, longitude, count) cluster and an outlier count."""
+    return ','.join(map(repr, (*cluster, outliers)))
+
+
+def decode_state(value):
+    # The states stored before the outlier count have four values
+    index, latitude, longitude, count, *outliers = value.split(',')
+    return (int(index), float(latitude), float(longitude), int(count)), int(outliers[0]) if outliers else 0
+
+
+def filter_points(points, previous=(), state=None, keep_last=False):
+    """Return the points worth storing of (index, latitude, longitude, timestamp) points sorted by index.
+
+    previous holds the stored points before them, the filter continues from the last two.
+    state is the stationary cluster and outlier count the previous call returned, it only
+    applies when its anchor is the last previous point. Returns the kept points and the new state.
+    The first point of a route is always kept, and with keep_last so is the last point
+    that is not an outlier, the end of a finished route.
+    """
+    kept = list(previous[-2:])
+    cluster, outliers = decode_state(state) if state else (None, 0)
+    if kept and (cluster is None or cluster[0] != kept[-1][0]):
+        cluster = (kept[-1][0], kept[-1][1], kept[-1][2], 1)
+        outliers = 0
+    result = []
+    for position, point in enumerate(points):
+        if kept:
+            _, latitude, longitude, _ = kept[-1]
+            distance = haversine(latitude, longitude, point[1], point[2])
+            elapsed = _elapsed_seconds(kept[-1], point)
+            # Both fixes may be off by the GPS noise, which matters with samples a second apart
+            if distance > MAX_SPEED_MPS * elapsed + STATIONARY_RADIUS_METERS and outliers < MAX_OUTLIER_RUN:
+                outliers += 1
+                continue
+            outliers = 0
+            if not (keep_last and position == len(points) - 1) and distance < MIN_MOVING_SPEED_MPS * elapsed:
+                index, cluster_latitude, cluster_longitude, count = cluster
+                if haversine(cluster_latitude, cluster_longitude, point[1], point[2]) < STATIONARY_RADIUS_METERS:
+                    # Still standing, the sample moves the centroid of the cluster
+                    cluster = (index, (cluster_latitude * count + point[1]) / (count + 1),
+                               (cluster_longitude * count + point[2]) / (count + 1), count + 1)
+                    continue
+                if distance < MIN_DISTANCE_METERS and not (distance > STATIONARY_RADIUS_METERS
+                                                           and _turns(kept, point)):
+                    continue
+        kept.append(point)
+        result.append(point)
+        cluster = (point[0], point[1], point[2], 1)
+    return result, (encode_state(cluster, outliers) if cluster else None)
@@ -0,0 +1,121 @@
+"""Heat map aggregate kept as point counters per geohash cell.
+
+Every point increments the counter of its precision 7 cell (about 150m) in
+HeatMapGrid. A counter row is keyed by its cell, and the partition groups the 1024
+sibling cells sharing the precision 5 prefix, so the points of a request are counted
+with one read and one transaction per partition. The coarser precisions served for
+lower zoom levels are summed from these counters at read time: a precision 6 cell is
+a RowKey range of a partition, and a precision 5 cell a whole partition.
+"""
+import logging
+from collections import Counter
+
+from shared_code.bootstrap import azure_core, data_tables
+from shared_code.geohash import cover, decode, encode
+
+# Precision of the stored counters
+CELL_PRECISION = 7
+# Length of the cell prefix in the partition of a counter, see grid_partition_key
+PARTITION_PREFIX = CELL_PRECISION - 2
+# Geohash precisions served, cells of about 4.9km, 1.2km and 150m
+PRECISIONS = (5, 6, 7)
+# Above this number of cells a bounding box is served from the next coarser precision
+MAX_QUERY_CELLS = 2000
+WRITE_RETRIES = 3
+# Above every geohash character, ends the RowKey range of a cell prefix
+_PREFIX_END = '~'
+
+
+def precision_for_zoom(zoom):
+    """Return the grid precision matching a map zoom level."""
+    if zoom < 11:
+        return 5
+    if zoom < 14:
+        return 6
+    return 7
+
+
+def grid_partition_key(cell):
+    return f"{len(cell)}_{cell[:-2]}"
+
+
+def add_points(table_client, points):
+    """Add (index, latitude, longitude, timestamp) points to the counters of their cells."""
+    counts = Counter(encode(latitude, longitude, CELL_PRECISION) for _, latitude, longitude, _ in points)
+    by_partition = {}
+    for cell, count in counts.items():
+        by_partition.setdefault(grid_partition_key(cell), {})[cell] = count
+    for partition_key, cell_counts in by_partition.items():
+        _increment(table_client, partition_key, cell_counts)
+
+
+def _increment(table_client, partition_key, cell_counts):
+    # One range read of the counters and one transaction, a counter changed meanwhile fails it as a whole
+    for attempt in range(WRITE_RETRIES):
+        entities = table_client.query_entities(
+            "PartitionKey eq @partition_key and RowKey ge @first and RowKey le @last",
+            parameters={'partition_key': partition_key, 'first': min(cell_counts), 'last': max(cell_counts)},
+            select=['RowKey', 'count'])
+        current = {entity['RowKey']: entity for entity in entities if entity['RowKey'] in cell_counts}
+        operations = []
+        for cell, count in cell_counts.items():
+            entity = {'PartitionKey': partition_key, 'RowKey': cell, 'count': count}
+            if cell not in current:
+                operations.append(('create', entity))
+            else:
+                entity['count'] += current[cell]['count']
+                operations.append(('update', entity, {'mode': data_tables.UpdateMode.MERGE,
+                                                      'etag': current[cell].metadata['etag'],
+                                                      'match_condition': azure_core.MatchConditions.IfNotModified}))
+        try:
+            table_client.submit_transaction(operations)
+            return
+        except data_tables.TableTransactionError:
+            logging.info(f"Concurrent update of heat map partition {partition_key}, retry {attempt + 1}")
+    raise RuntimeError(f"Could not update heat map partition {partition_key} after {WRITE_RETRIES} attempts")
+
+
+def query_cells(table_client, bbox, precision, since=None):
+    """Return the precision served and its (latitude, longitude, count) cells inside a bounding box.
+
+    The precision is lowered until the bounding box is covered by at most MAX_QUERY_CELLS cells.
+    With a since datetime only the cells updated after it are returned, with their total count.
+    """
+    cells = cover(bbox, precision, MAX_QUERY_CELLS)
+    while cells is None and precision > PRECISIONS[0]:
+        precision -= 1
+        cells = cover(bbox, precision, MAX_QUERY_CELLS)
+    if cells is None:
+        raise ValueError("bbox is too large.")
+
+    counts = Counter()
+    updated = set()
+    for query_filter, parameters in _cell_queries(cells, precision):
+        # The Timestamp of the counters tells which cells were updated, their totals are summed either way
+        select = ['RowKey', 'count', 'Timestamp'] if since is not None else ['RowKey', 'count']
+        for entity in table_client.query_entities(query_filter, parameters=parameters, select=select):
+            cell = entity['RowKey'][:precision]
+            if cell in cells:
+                counts[cell] += entity['count']
+                if since is not None and entity.metadata['timestamp'] >= since:
+                    updated.add(cell)
+    if since is not None:
+        counts = {cell: count for cell, count in counts.items() if cell in updated}
+    return precision, [(*decode(cell), count) for cell, count in counts.items()]
+
+
+def _cell_queries(cells, precision):
+    # The (filter, parameters) reading the counters of cells, one RowKey range per partition for the
+    # finer cells, and one PartitionKey range per group of precision 5 cells sharing their prefix
+    prefix_length = PARTITION_PREFIX if precision > PARTITION_PREFIX else precision - 1
+    groups = {}
+    for cell in cells:
+        groups.setdefault(cell[:prefix_length], []).append(cell)
+    for prefix, group_cells in groups.items():
+        first, last = min(group_cells), f"{max(group_cells)}{_PREFIX_END}"
+        if precision > PARTITION_PREFIX:
+            yield ("PartitionKey eq @partition_key and RowKey ge @first and RowKey lt @last",
+                   {'partition_key': f"{CELL_PRECISION}_{prefix}", 'first': first, 'last': last})
+        else:
+            yield ("PartitionKey ge @first and PartitionKey lt @last",
+                   {'first': f"{CELL_PRECISION}_{first}", 'last': f"{CELL_PRECISION}_{last}"})
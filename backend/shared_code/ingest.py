@@ -0,0 +1,182 @@
+"""Write path of the route points, shared by CollectCoordination and the queue worker.
+
+With INGEST_MODE=queue CollectCoordination only validates a request, puts it on
+the route-points queue and answers at once. ProcessRoutePoints then writes the points
+in the background, and a failed write is retried by the queue instead of being lost.
+"""
+import functools
+import json
+import logging
+import os
+
+from shared_code import cache, changes, geo_index, gps_filter, heat_grid, live_updates, partitions, route_match
+from shared_code.bootstrap import data_tables
+from shared_code.instrumentation import log_payloads
+from shared_code.route_stats import route_stats
+from shared_code.route_store import append_points, read_track_progress
+from shared_code.simplify import build_levels_of_detail
+from shared_code.tables import (COORDINATES_TABLE, HEAT_MAP_GRID_TABLE, RAW_COORDINATES_TABLE, ROUTE_CHANGES_TABLE,
+                               ROUTE_EVENTS_TABLE, ROUTE_GEO_INDEX_TABLE, ROUTE_MATCH_TABLE, ROUTE_PARTITIONS_TABLE,
+                               ROUTES_TABLE, get_table_client)
+
+INGEST_MODE_DIRECT = 'direct'
+INGEST_MODE_QUEUE = 'queue'
+INGEST_MODE = os.getenv('INGEST_MODE', INGEST_MODE_DIRECT)
+# Must match the queueName of the CollectCoordination and ProcessRoutePoints bindings
+QUEUE_NAME = 'route-points'
+# maxDequeueCount in host.json, a message is moved to the poison queue after this many deliveries
+MAX_DEQUEUE_COUNT = 5
+
+
+class TrackIncompleteError(Exception):
+    """The points before the end of a finished route were not written yet."""
+
+
+def use_queue():
+    return INGEST_MODE == INGEST_MODE_QUEUE
+
+
+def build_message(partition_key, row_key, points, finish, keep_raw=False):
+    return json.dumps({
+        'partition_key': partition_key,
+        'row_key': row_key,
+        'points': [list(point) for point in points],
+        'finish': bool(finish),
+        'keep_raw': bool(keep_raw),
+    })
+
+
+def group_messages(messages):
+    """Group the points of (body, dequeue_count, source) queue messages by route.
+
+    Returns {(partition_key, row_key): (points, finish, keep_raw, last_attempt, sources)}, the
+    points of a route deduplicated by index so a message delivered twice writes nothing
+    new. last_attempt is set when a message of the route reached its last delivery.
+    """
+    routes = {}
+    for body, dequeue_count, source in messages:
+        message = json.loads(body)
+        route = routes.setdefault((message['partition_key'], message['row_key']),
+                                  {'points': {}, 'finish': False, 'keep_raw': False, 'last_attempt': False,
+                                   'sources': []})
+        for index, latitude, longitude, timestamp in message['points']:
+            route['points'][index] = (index, latitude, longitude, timestamp)
+        route['finish'] = route['finish'] or message['finish']
+        # Messages queued before the keep_raw flag existed
+        route['keep_raw'] = route['keep_raw'] or message.get('keep_raw', False)
+        route['last_attempt'] = route['last_attempt'] or dequeue_count >= MAX_DEQUEUE_COUNT
+        route['sources'].append(source)
+    return {key: ([route['points'][index] for index in sorted(route['points'])], route['finish'],
+                  route['keep_raw'], route['last_attempt'], route['sources'])
+            for key, route in routes.items()}
+
+
+def write_points(partition_key, name, points, finish=False, keep_raw=False):
+    """Write the (index, latitude, longitude, timestamp) points of a route.
+
+    Starts the route on index 0 and feeds the heat map grid with the new points.
+    The points are filtered by shared_code.gps_filter, finish keeps the last one as
+    the end of the route and keep_raw also stores them unfiltered.
+    """
+    route_table = get_table_client(ROUTES_TABLE)
+    coord_table = get_table_client(COORDINATES_TABLE)
+
+    # Add or update the route entity in RoutesCordinations
+    if points[0][0] == 0:
+        _, latitude, longitude, _ = points[0]
+        route_entity = {
+            'PartitionKey': partition_key,
+            'RowKey': name,
+            'start_cord_latitude': latitude,
+            'start_cord_longitude': longitude
+        }
+        if log_payloads():
+            logging.info(f"start route_table with {route_entity}")
+        # Let the reads of the city find the partition of the route
+        partitions.register_partition(get_table_client(ROUTE_PARTITIONS_TABLE), partition_key)
+        route_table.upsert_entity(entity=route_entity, mode=data_tables.UpdateMode.MERGE)
+        cache.invalidate(cache.ROUTES, partitions.city_of(partition_key))
+        if log_payloads():
+            logging.info(f"end route_table with {route_entity}")
+
+    # Append the points to the packed track in AllRouteCoordinations. Points are keyed
+    # by their index, so out of order and duplicate points are applied idempotently.
+    point_filter = None
+    if gps_filter.ENABLED:
+        point_filter = functools.partial(gps_filter.filter_points, keep_last=finish)
+        if keep_raw:
+            append_points(get_table_client(RAW_COORDINATES_TABLE), partition_key, name, points)
+    new_points = append_points(coord_table, partition_key, name, points, point_filter)
+
+    # The route points also feed the heat map grid, so the app no longer sends them
+    # to CreateHeatMap. Only new points are counted, a retried request counts nothing.
+    try:
+        heat_grid.add_points(get_table_client(HEAT_MAP_GRID_TABLE), new_points)
+    except Exception as e:
+        logging.error(f"Error adding the points of {name} to the heat map: {e}")
+    if new_points:
+        cache.invalidate(cache.HEAT_MAP)
+        live_updates.mark_heat_map(get_table_client(ROUTE_EVENTS_TABLE))
+
+
+def finish_route(partition_key, name, end_point, require_complete=False):
+    """Store the end point, levels of detail and geospatial index of a finished route.
+
+    With require_complete a track missing points before end_point raises
+    TrackIncompleteError, as queued points may be written out of order.
+    A run following a route of the catalog is attached to it instead, see
+    shared_code.route_match. Returns the (partition_key, row_key) of that route,
+    or None when the run is a new route.
+    """
+    logging.info(f"start update route_table after finish with {partition_key} and {name}")
+    # Points filtered out at ingest count as received
+    track, received = read_track_progress(get_table_client(COORDINATES_TABLE), partition_key, name)
+    last_index, latitude, longitude, _ = end_point
+    if require_complete and received < last_index + 1:
+        raise TrackIncompleteError(f"Route {name} has {received} of {last_index + 1} points")
+
+    signature = route_match.signature(track) if route_match.ENABLED else None
+    if signature is not None:
+        match_table = get_table_client(ROUTE_MATCH_TABLE)
+        match = route_match.find_match(match_table, partition_key, name, signature)
+        if match is not None:
+            attach_run(match_table, partition_key, name, match)
+            return match
+
+    route_entity = {
+        'PartitionKey': partition_key,
+        'RowKey': name,
+        'end_cord_latitude': latitude,
+        'end_cord_longitude': longitude
+    }
+    # Store the simplified geometries used by the list view along with the end point
+    route_entity.update(build_levels_of_detail(track))
+    # Index the route for viewport and radius queries and keep its bounding box
+    bbox = geo_index.index_route(get_table_client(ROUTE_GEO_INDEX_TABLE), partition_key, name, track)
+    route_entity.update(geo_index.bbox_properties(bbox))
+    # Distance, duration and pace, so GetRoutes can sort and filter without the coordinates
+    route_entity.update(route_stats(track))
+    get_table_client(ROUTES_TABLE).update_entity(entity=route_entity, mode=data_tables.UpdateMode.MERGE)
+    cache.invalidate(cache.ROUTES, partitions.city_of(partition_key))
+    # Let later runs of the route be matched to it
+    if signature is not None:
+        route_match.index_route(match_table, partition_key, name, signature)
+    # Let delta syncs and the live updates pick up the finished route
+    changes.record_change(get_table_client(ROUTE_CHANGES_TABLE), partition_key, name, changes.OP_UPSERT)
+    live_updates.mark_routes(get_table_client(ROUTE_EVENTS_TABLE), partition_key)
+    logging.info(f"finish update route_table after finish with {partition_key} and {name}")
+    return None
+
+
+def attach_run(match_table, partition_key, name, match):
+    """Attach a finished run to the (partition_key, row_key) of the route it follows.
+
+    The run leaves the catalog like a removed route, its tombstone lets delta syncs drop
+    it and SweepRoutes delete its track. The alias keeps its RowKey usable.
+    """
+    logging.info(f"Run {name} follows route {match[1]}, attaching it")
+    route_match.attach_run(match_table, partition_key, name, match)
+    get_table_client(ROUTES_TABLE).delete_entity(partition_key=partition_key, row_key=name)
+    cache.invalidate(cache.ROUTES, partitions.city_of(partition_key))
+    changes.record_change(get_table_client(ROUTE_CHANGES_TABLE), partition_key, name, changes.OP_DELETE)
+    live_updates.mark_routes(get_table_client(ROUTE_EVENTS_TABLE), partition_key)
@@ -0,0 +1,207 @@
+"""Latency instrumentation of the functions and of their storage calls.
+
+Every function main is wrapped with instrument, which records the duration of the
+invocation, whether it was the first one of the worker process (a cold start), and
+the round trips of the Table SDK made during it, with their time and the bytes sent
+and received. The Table clients report their round trips through the raw hooks of
+the SDK pipeline (client_hooks), so every retry counts as a round trip.
+
+Each invocation emits one structured log line, and the duration histograms of the
+worker are logged every HISTOGRAM_LOG_SECONDS. With INSTRUMENTATION=otel and the
+opentelemetry package installed, invocations and round trips are OpenTelemetry spans
+instead. INSTRUMENTATION=off disables all of it.
+
+Payload logging (request bodies, entities) is sampled per invocation with
+PAYLOAD_LOG_SAMPLE_RATE, off by default.
+"""
+import bisect
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+MODE_LOG = 'log'
+MODE_OTEL = 'otel'
+MODE_OFF = 'off'
+INSTRUMENTATION = os.getenv('INSTRUMENTATION', MODE_LOG)
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0'))
+HISTOGRAM_LOG_SECONDS = float(os.getenv('HISTOGRAM_LOG_SECONDS', '60'))
+# Upper bounds in milliseconds of the histogram buckets, the last bucket is unbounded
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_invocation = contextvars.ContextVar('invocation', default=None)
+_lock = threading.Lock()
+_histograms = {}
+_cold_start = True
+_last_histogram_log = time.monotonic()
+_tracer = trace.get_tracer(__name__) if trace is not None and INSTRUMENTATION == MODE_OTEL else None
+
+
+class Invocation:
+    """Storage statistics of one function invocation."""
+
+    def __init__(self, function_name, cold_start):
+        self.function_name = function_name
+        self.cold_start = cold_start
+        self.log_payloads = random.random() < PAYLOAD_LOG_SAMPLE_RATE
+        self.storage_calls = 0
+        self.storage_ms = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.span = None
+
+
+def _observe(name, duration_ms):
+    global _last_histogram_log
+    with _lock:
+        histogram = _histograms.setdefault(name, [0] * (len(BUCKETS_MS) + 1))
+        histogram[bisect.bisect_left(BUCKETS_MS, duration_ms)] += 1
+        if time.monotonic() - _last_histogram_log < HISTOGRAM_LOG_SECONDS:
+            return
+        _last_histogram_log = time.monotonic()
+        snapshot = {name: list(counts) for name, counts in _histograms.items()}
+    logging.info(json.dumps({'event': 'latency_histograms', 'buckets_ms': BUCKETS_MS, 'histograms': snapshot}))
+
+
+def histograms():
+    """Return the duration histograms of the worker, {name: counts per bucket of BUCKETS_MS}."""
+    with _lock:
+        return {name: list(counts) for name, counts in _histograms.items()}
+
+
+def log_payloads():
+    """Return whether the current invocation was sampled for payload logging."""
+    invocation = _invocation.get()
+    if invocation is None:
+        return random.random() < PAYLOAD_LOG_SAMPLE_RATE
+    return invocation.log_payloads
+
+
+def _start(function_name):
+    global _cold_start
+    with _lock:
+        cold_start, _cold_start = _cold_start, False
+    invocation = Invocation(function_name, cold_start)
+    if _tracer is not None:
+        invocation.span = _tracer.start_span(function_name, attributes={'faas.coldstart': cold_start})
+    return invocation, _invocation.set(invocation), time.perf_counter()
+
+
+def _finish(invocation, token, start, result, error):
+    duration_ms = (time.perf_counter() - start) * 1000
+    _invocation.reset(token)
+    _observe(invocation.function_name, duration_ms)
+    record = {
+        'event': 'invocation',
+        'function': invocation.function_name,
+        'duration_ms': round(duration_ms, 2),
+        'cold_start': invocation.cold_start,
+        'status_code': getattr(result, 'status_code', None),
+        'error': repr(error) if error else None,
+        'storage_calls': invocation.storage_calls,
+        'storage_ms': round(invocation.storage_ms, 2),
+        'bytes_sent': invocation.bytes_sent,
+        'bytes_received': invocation.bytes_received,
+    }
+    if invocation.span is not None:
+        invocation.span.set_attributes({f"runtracker.{key}": value for key, value in record.items()
+                                        if value is not None})
+        invocation.span.end()
+    else:
+        logging.info(json.dumps(record))
+
+
+def instrument(main):
+    """Decorate the main of a function, sync or async, to record its invocations."""
+    if INSTRUMENTATION == MODE_OFF:
+        return main
+    function_name = main.__module__.rsplit('.', 1)[-1]
+
+    if inspect.iscoroutinefunction(main):
+        @functools.wraps(main)
+        async def async_wrapper(*args, **kwargs):
+            invocation, token, start = _start(function_name)
+            result = error = None
+            try:
+                result = await main(*args, **kwargs)
+                return result
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                _finish(invocation, token, start, result, error)
+        return async_wrapper
+
+    @functools.wraps(main)
+    def wrapper(*args, **kwargs):
+        invocation, token, start = _start(function_name)
+        result = error = None
+        try:
+            result = main(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _finish(invocation, token, start, result, error)
+    return wrapper
+
+
+def _on_request(request):
+    request.context['instrumentation_start'] = time.perf_counter()
+    request.context['instrumentation_start_ns'] = time.time_ns()
+
+
+def _on_response(response):
+    start = response.context.get('instrumentation_start')
+    if start is None:
+        return
+    duration_ms = (time.perf_counter() - start) * 1000
+    http_request = response.http_request
+    body = http_request.body
+    bytes_sent = len(body) if isinstance(body, (bytes, str)) else 0
+    bytes_received = int(response.http_response.headers.get('Content-Length') or 0)
+    # The operation is named after the method and the table, without the keys of the request
+    table = http_request.url.split('?', 1)[0].rsplit('/', 1)[-1].split('(', 1)[0]
+    record_storage_call(f"{http_request.method} {table}", duration_ms, bytes_sent, bytes_received,
+                        response.http_response.status_code, response.context['instrumentation_start_ns'])
+
+
+def record_storage_call(operation, duration_ms, bytes_sent=0, bytes_received=0, status_code=None, start_ns=None):
+    """Record a round trip to the storage, for the backends that do not go through the SDK pipeline."""
+    if INSTRUMENTATION == MODE_OFF:
+        return
+    _observe(f"storage {operation}", duration_ms)
+
+    invocation = _invocation.get()
+    if invocation is not None:
+        invocation.storage_calls += 1
+        invocation.storage_ms += duration_ms
+        invocation.bytes_sent += bytes_sent
+        invocation.bytes_received += bytes_received
+    if _tracer is not None:
+        parent = invocation.span if invocation is not None else None
+        attributes = {'runtracker.bytes_sent': bytes_sent, 'runtracker.bytes_received': bytes_received}
+        if status_code is not None:
+            attributes['http.status_code'] = status_code
+        span = _tracer.start_span(operation, start_time=start_ns or time.time_ns() - int(duration_ms * 1e6),
+                                  context=trace.set_span_in_context(parent) if parent is not None else None,
+                                  attributes=attributes)
+        span.end()
+
+
+def client_hooks():
+    """Return the keyword arguments of a Table client that report its round trips."""
+    if INSTRUMENTATION == MODE_OFF:
+        return {}
+    return {'raw_request_hook': _on_request, 'raw_response_hook': _on_response}
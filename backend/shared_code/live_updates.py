@@ -0,0 +1,137 @@
+"""Live updates pushed to the app over the SignalR hub it connects to with negotiate.
+
+The write paths mark what they changed in RouteEvents, a route partition or the
+heat map, with one row each, so a burst of writes leaves a single mark. Every
+WINDOW_SECONDS PublishChanges reads the marks, clears them and sends one message per mark:
+
+    routesChanged   {"partition_key", "changed", "deleted", "watermark"}
+    heatMapChanged  {"watermark"}
+
+changed and deleted are the RowKeys of the change log since the previous publish,
+changed is null when the app needs a full sync. The app applies them with a delta
+sync, GetRoutes with since, instead of refetching the routes and the heat map on
+every screen focus. A message lost on the way only delays the app to its next sync.
+
+The timer runs whether or not anything changed, so it keeps a consumption plan
+app warm: every 30 seconds is 2880 invocations a day, about 87k a month, well in
+the monthly free grant, where every 5 seconds was 17k a day. A shorter window
+makes the app react sooner at that cost, both schedules must be changed together.
+"""
+import logging
+import os
+import time
+
+from shared_code import changes
+from shared_code.bootstrap import azure_core, core_exceptions, data_tables
+from shared_code.concurrency import collect, gather_bounded
+
+ENABLED = os.getenv('LIVE_UPDATES', '1') != '0'
+PENDING_PARTITION = 'pending'
+# The heat map is not partitioned, its mark has a key of its own
+HEAT_MAP_KEY = '*'
+STATE_PARTITION = 'state'
+# Holds the watermark of the last publish, as the 13 digit epoch milliseconds of the change log
+STATE_ROW = 'published'
+ROUTES_TARGET = 'routesChanged'
+HEAT_MAP_TARGET = 'heatMapChanged'
+# The schedule of PublishChanges in its function.json
+WINDOW_SECONDS = 30
+# A worker marks the heat map at most once per interval, points keep coming while routes are
+# recorded and an aggregate a few minutes old is fine, so PublishChanges is not kept busy by them
+HEAT_MAP_INTERVAL_SECONDS = 5 * 60
+# Changes published by the first run
+FIRST_RUN_MS = 60 * 1000
+
+# When this worker last marked the heat map
+_heat_map_marked_at = None
+
+
+def _mark_entity(key):
+    return {'PartitionKey': PENDING_PARTITION, 'RowKey': key}
+
+
+# A failed mark is only logged, the write it follows succeeded and the app catches up on its next sync
+
+def mark_routes(table_client, partition_key):
+    """Mark the routes of a partition as changed, after the change was recorded in the change log."""
+    if not ENABLED:
+        return
+    try:
+        table_client.upsert_entity(entity=_mark_entity(partition_key))
+    except Exception as e:
+        logging.error(f"Error marking the changes of partition {partition_key}: {e}")
+
+
+async def mark_routes_async(table_client, partition_key):
+    """Like mark_routes with an aio TableClient."""
+    if not ENABLED:
+        return
+    try:
+        await table_client.upsert_entity(entity=_mark_entity(partition_key))
+    except Exception as e:
+        logging.error(f"Error marking the changes of partition {partition_key}: {e}")
+
+
+def mark_heat_map(table_client):
+    """Mark the heat map as changed, once per interval and worker as points keep coming."""
+    global _heat_map_marked_at
+    now = time.monotonic()
+    if not ENABLED or (_heat_map_marked_at is not None and now - _heat_map_marked_at < HEAT_MAP_INTERVAL_SECONDS):
+        return
+    try:
+        table_client.upsert_entity(entity=_mark_entity(HEAT_MAP_KEY))
+        _heat_map_marked_at = now
+    except Exception as e:
+        logging.error(f"Error marking the changes of the heat map: {e}")
+
+
+def _message(target, argument):
+    return {'target': target, 'arguments': [argument]}
+
+
+async def _clear(events_table, mark):
+    # A mark written again meanwhile is kept and published on the next run
+    try:
+        await events_table.delete_entity(partition_key=PENDING_PARTITION, row_key=mark['RowKey'],
+                                         etag=mark.metadata['etag'],
+                                         match_condition=azure_core.MatchConditions.IfNotModified)
+    except core_exceptions.ResourceModifiedError:
+        logging.info(f"Changes of {mark['RowKey']} marked again while publishing")
+    except core_exceptions.ResourceNotFoundError:
+        # Cleared by an overlapping run
+        pass
+
+
+async def publish(events_table, changes_table):
+    """Return the SignalR messages of the marks since the previous run and clear the marks."""
+    marks = await collect(events_table.query_entities("PartitionKey eq @pending",
+                                                      parameters={'pending': PENDING_PARTITION}))
+    if not marks:
+        return []
+    now = changes.now_ms()
+    try:
+        state = await events_table.get_entity(partition_key=STATE_PARTITION, row_key=STATE_ROW)
+        since = int(state['watermark'])
+    except core_exceptions.ResourceNotFoundError:
+        since = now - FIRST_RUN_MS
+
+    route_marks = [mark for mark in marks if mark['RowKey'] != HEAT_MAP_KEY]
+    route_changes = await gather_bounded(*(changes.read_changes_async(changes_table, mark['RowKey'], since)
+                                           for mark in route_marks))
+    messages = []
+    for mark, (changed, deleted, watermark) in zip(route_marks, route_changes):
+        if changed is not None and not changed and not deleted:
+            continue
+        messages.append(_message(ROUTES_TARGET, {
+            'partition_key': mark['RowKey'],
+            'changed': None if changed is None else sorted(changed),
+            'deleted': deleted,
+            'watermark': watermark,
+        }))
+    if len(route_marks) < len(marks):
+        messages.append(_message(HEAT_MAP_TARGET, {'watermark': now}))
+
+    await gather_bounded(*(_clear(events_table, mark) for mark in marks))
+    await events_table.upsert_entity(entity={'PartitionKey': STATE_PARTITION, 'RowKey': STATE_ROW,
+                                             'watermark': f"{now:013d}"}, mode=data_tables.UpdateMode.REPLACE)
+    return messages
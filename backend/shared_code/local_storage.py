@@ -0,0 +1,474 @@
+"""In-memory and SQLite stand-ins of Table storage, selected with STORAGE_BACKEND.
+
+The storage interface of the functions is the part of the azure.data.tables
+TableClient they use: get_entity, create_entity, upsert_entity, update_entity,
+delete_entity, submit_transaction, and query_entities / list_entities with
+results_per_page, select and continuation tokens. LocalTableClient and
+AsyncLocalTableClient implement it over a store, with the behaviour of the service
+the functions rely on: etags and conditional updates, atomic transactions on one
+partition, Timestamp filters, the same exceptions and pages of at most 1000 entities.
+Query parameters are substituted by the SDK code itself, so a filter it rejects, like
+a parameter not followed by a space, fails here too.
+
+With STORAGE_BACKEND=memory the tables live in the worker process, with
+STORAGE_BACKEND=sqlite in the file STORAGE_SQLITE_PATH, shared by processes. Every
+call is recorded as a storage round trip by shared_code.instrumentation, without
+bytes, so the benchmarks count the calls of a request like against Azure.
+"""
+import base64
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timezone
+from enum import Enum
+
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.core.paging import ItemPaged
+from azure.core.async_paging import AsyncItemPaged
+from azure.core import MatchConditions
+from azure.data.tables import EdmType, EntityProperty, TableEntity, TableTransactionError, UpdateMode
+from azure.data.tables._serialize import _parameter_filter_substitution
+
+from shared_code.instrumentation import record_storage_call
+from shared_code.odata_filter import Filter, normalize
+
+# Largest page the service returns
+MAX_PAGE_SIZE = 1000
+MAX_TRANSACTION_OPERATIONS = 100
+INT32_RANGE = range(-2 ** 31, 2 ** 31)
+# Rows read from a store at a time while a query scans it
+SCAN_CHUNK = 256
+
+_stores_lock = threading.Lock()
+_stores = {}
+
+
+def _new_record(properties):
+    return {'properties': properties, 'etag': f'W/"{uuid.uuid4().hex}"', 'timestamp': datetime.now(timezone.utc)}
+
+
+def _after(key, bound):
+    # Whether key is past the (value, inclusive) high bound of a scan
+    return bound is not None and (key > bound[0] or key == bound[0] and not bound[1])
+
+
+class MemoryStore:
+    """Tables kept in the process, each a dict of records and the sorted list of their keys."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._tables = {}
+
+    def _table(self, table_name):
+        return self._tables.setdefault(table_name, ({}, []))
+
+    def transaction(self):
+        return self.lock
+
+    def get(self, table_name, key):
+        with self.lock:
+            return self._table(table_name)[0].get(key)
+
+    def put(self, table_name, key, record):
+        with self.lock:
+            records, keys = self._table(table_name)
+            if key not in records:
+                insort(keys, key)
+            records[key] = record
+
+    def delete(self, table_name, key):
+        with self.lock:
+            records, keys = self._table(table_name)
+            if records.pop(key, None) is not None:
+                del keys[bisect_left(keys, key)]
+
+    def scan(self, table_name, start, include_start, partition_key, high, limit):
+        """Return up to limit (key, record) in key order from the key start on.
+
+        With a partition_key the scan stops at the end of the partition and past the
+        (value, inclusive) high bound of the RowKeys.
+        """
+        with self.lock:
+            records, keys = self._table(table_name)
+            first = bisect_left(keys, start) if include_start else bisect_right(keys, start)
+            rows = []
+            for key in keys[first:first + limit]:
+                if partition_key is not None and (key[0] != partition_key or _after(key[1], high)):
+                    break
+                rows.append((key, records[key]))
+            return rows
+
+    def clear(self):
+        with self.lock:
+            self._tables.clear()
+
+
+def _encode_value(value):
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode()}
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__} values")
+
+
+def _decode_value(value):
+    if '$bytes' in value:
+        return base64.b64decode(value['$bytes'])
+    if '$datetime' in value:
+        return datetime.fromisoformat(value['$datetime'])
+    return value
+
+
+class SqliteStore:
+    """Tables kept in one SQLite database, the properties of a row as JSON."""
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entities (table_name TEXT, partition_key TEXT, row_key TEXT, etag TEXT, "
+            "timestamp TEXT, properties TEXT, PRIMARY KEY (table_name, partition_key, row_key)) WITHOUT ROWID")
+
+    def transaction(self):
+        return _SqliteTransaction(self)
+
+    def _record(self, row):
+        return {'etag': row[0], 'timestamp': datetime.fromisoformat(row[1]),
+                'properties': json.loads(row[2], object_hook=_decode_value)}
+
+    def get(self, table_name, key):
+        with self.lock:
+            row = self._connection.execute(
+                "SELECT etag, timestamp, properties FROM entities "
+                "WHERE table_name = ? AND partition_key = ? AND row_key = ?", (table_name, *key)).fetchone()
+        return None if row is None else self._record(row)
+
+    def put(self, table_name, key, record):
+        with self.lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)",
+                (table_name, *key, record['etag'], record['timestamp'].isoformat(),
+                 json.dumps(record['properties'], default=_encode_value)))
+
+    def delete(self, table_name, key):
+        with self.lock:
+            self._connection.execute("DELETE FROM entities WHERE table_name = ? AND partition_key = ? AND row_key = ?",
+                                     (table_name, *key))
+
+    def scan(self, table_name, start, include_start, partition_key, high, limit):
+        query = "SELECT partition_key, row_key, etag, timestamp, properties FROM entities " \
+                f"WHERE table_name = ? AND (partition_key, row_key) {'>=' if include_start else '>'} (?, ?)"
+        parameters = [table_name, *start]
+        if partition_key is not None:
+            query += " AND partition_key = ?"
+            parameters.append(partition_key)
+            if high is not None:
+                query += " AND row_key <= ?" if high[1] else " AND row_key < ?"
+                parameters.append(high[0])
+        query += " ORDER BY partition_key, row_key LIMIT ?"
+        parameters.append(limit)
+        with self.lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [((row[0], row[1]), self._record(row[2:])) for row in rows]
+
+    def clear(self):
+        with self.lock:
+            self._connection.execute("DELETE FROM entities")
+
+
+class _SqliteTransaction:
+    # Holds the lock of the store and commits the writes made meanwhile, or rolls them back
+
+    def __init__(self, store):
+        self._store = store
+
+    def __enter__(self):
+        self._store.lock.acquire()
+        self._store._connection.execute("BEGIN")
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            self._store._connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self._store.lock.release()
+
+
+def get_store(backend, path=None):
+    """Return the store of a backend shared by the clients of the process, memory or sqlite."""
+    with _stores_lock:
+        store = _stores.get((backend, path))
+        if store is None:
+            if backend == 'memory':
+                store = MemoryStore()
+            elif backend == 'sqlite':
+                store = SqliteStore(path)
+            else:
+                raise ValueError(f"Unknown storage backend {backend}")
+            _stores[(backend, path)] = store
+        return store
+
+
+def _stored_value(value):
+    if isinstance(value, (EntityProperty, Enum)):
+        value = value.value
+    return normalize(value) if isinstance(value, datetime) else value
+
+
+def _returned_value(value):
+    # Like the SDK, Int64 values are returned as an EntityProperty
+    if isinstance(value, int) and not isinstance(value, bool) and value not in INT32_RANGE:
+        return EntityProperty(value, EdmType.INT64)
+    return value
+
+
+def _entity(key, record, select=None):
+    entity = TableEntity()
+    entity['PartitionKey'], entity['RowKey'] = key
+    entity.update((name, _returned_value(value)) for name, value in record['properties'].items())
+    if select:
+        entity = TableEntity((name, entity[name]) for name in select if name in entity)
+    entity._metadata = {'etag': record['etag'], 'timestamp': record['timestamp']}
+    return entity
+
+
+def _key(entity):
+    return entity['PartitionKey'], entity['RowKey']
+
+
+def _query(query_filter, parameters):
+    # The SDK sends the filter with the parameters substituted, splitting it on spaces
+    return Filter(_parameter_filter_substitution(parameters, query_filter))
+
+
+def _extract_page(page):
+    entities, continuation_token = page
+    return continuation_token, entities
+
+
+class LocalTableClient:
+    """The TableClient of a table of a local store."""
+
+    def __init__(self, store, table_name):
+        self.table_name = table_name
+        self._store = store
+
+    def _record_call(self, method, start):
+        record_storage_call(f"{method} {self.table_name}", (time.perf_counter() - start) * 1000)
+
+    def _properties(self, entity):
+        # Like the SDK, None values are not sent
+        return {name: _stored_value(value) for name, value in entity.items()
+                if name not in ('PartitionKey', 'RowKey') and value is not None}
+
+    def _write(self, operation, entity, mode=UpdateMode.MERGE, etag=None, match_condition=None):
+        # Applies one operation, the caller holds the transaction of the store
+        key = _key(entity)
+        current = self._store.get(self.table_name, key)
+        if operation == 'create':
+            if current is not None:
+                raise ResourceExistsError(f"The entity {key} already exists")
+        elif operation == 'update' or operation == 'delete' and match_condition is not None:
+            if current is None:
+                raise ResourceNotFoundError(f"The entity {key} does not exist")
+            if match_condition == MatchConditions.IfNotModified and etag != current['etag']:
+                raise ResourceModifiedError(f"The entity {key} was modified")
+        if operation == 'delete':
+            if current is None:
+                raise ResourceNotFoundError(f"The entity {key} does not exist")
+            self._store.delete(self.table_name, key)
+            return {}
+        properties = self._properties(entity)
+        if current is not None and operation != 'create' and mode == UpdateMode.MERGE:
+            properties = dict(current['properties'], **properties)
+        record = _new_record(properties)
+        self._store.put(self.table_name, key, record)
+        return {'etag': record['etag']}
+
+    def get_entity(self, partition_key, row_key, select=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            record = self._store.get(self.table_name, (partition_key, row_key))
+            if record is None:
+                raise ResourceNotFoundError(f"The entity {(partition_key, row_key)} does not exist")
+            return _entity((partition_key, row_key), record, select)
+        finally:
+            self._record_call('GET', start)
+
+    def create_entity(self, entity, **kwargs):
+        start = time.perf_counter()
+        try:
+            with self._store.transaction():
+                return self._write('create', entity)
+        finally:
+            self._record_call('POST', start)
+
+    def upsert_entity(self, entity, mode=UpdateMode.MERGE, **kwargs):
+        start = time.perf_counter()
+        try:
+            with self._store.transaction():
+                return self._write('upsert', entity, mode)
+        finally:
+            self._record_call('PATCH' if mode == UpdateMode.MERGE else 'PUT', start)
+
+    def update_entity(self, entity, mode=UpdateMode.MERGE, etag=None, match_condition=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            with self._store.transaction():
+                return self._write('update', entity, mode, etag, match_condition)
+        finally:
+            self._record_call('PATCH' if mode == UpdateMode.MERGE else 'PUT', start)
+
+    def delete_entity(self, partition_key=None, row_key=None, entity=None, etag=None, match_condition=None,
+                      **kwargs):
+        if entity is not None:
+            partition_key, row_key = _key(entity)
+        start = time.perf_counter()
+        try:
+            with self._store.transaction():
+                self._write('delete', {'PartitionKey': partition_key, 'RowKey': row_key},
+                            etag=etag, match_condition=match_condition)
+        except ResourceNotFoundError:
+            # Like the SDK, deleting an entity that does not exist succeeds
+            if match_condition is not None:
+                raise
+        finally:
+            self._record_call('DELETE', start)
+
+    def submit_transaction(self, operations, **kwargs):
+        operations = [(str(getattr(operation[0], 'value', operation[0])).lower(), *operation[1:])
+                      for operation in operations]
+        start = time.perf_counter()
+        try:
+            if not operations:
+                return []
+            if len(operations) > MAX_TRANSACTION_OPERATIONS:
+                raise TableTransactionError(message=f"0:The transaction has more than {MAX_TRANSACTION_OPERATIONS} "
+                                                    f"operations")
+            keys = [_key(operation[1]) for operation in operations]
+            if len({key[0] for key in keys}) > 1 or len(set(keys)) < len(keys):
+                raise TableTransactionError(message="0:The operations of a transaction must be on distinct rows "
+                                                    "of one partition")
+            results = []
+            with self._store.transaction():
+                # Checked against the rows before the transaction, so a failure leaves them all unchanged
+                for index, (operation, entity, *options) in enumerate(operations):
+                    options = options[0] if options else {}
+                    current = self._store.get(self.table_name, keys[index])
+                    if operation == 'create' and current is not None or \
+                            operation in ('update', 'delete') and current is None or \
+                            options.get('match_condition') == MatchConditions.IfNotModified and \
+                            (current is None or options.get('etag') != current['etag']):
+                        raise TableTransactionError(message=f"{index}:The operation on {keys[index]} failed",
+                                                    index=index)
+                for operation, entity, *options in operations:
+                    options = options[0] if options else {}
+                    results.append(self._write(operation, entity, options.get('mode', UpdateMode.MERGE)))
+            return results
+        finally:
+            self._record_call('POST $batch', start)
+
+    def _candidates(self, query, start):
+        # Yield the (key, record) from the key start on that can match the query, in key order
+        partition_key = query.partition_key if query else None
+        if partition_key is not None and query.row_keys is not None:
+            # Point reads of the RowKeys the query lists
+            for row_key in sorted(query.row_keys):
+                if (partition_key, row_key) >= start:
+                    record = self._store.get(self.table_name, (partition_key, row_key))
+                    if record is not None:
+                        yield (partition_key, row_key), record
+            return
+        low, high = (query.row_key_range if query else None) or (None, None)
+        # A scan of one partition starts at its first RowKey in range
+        if partition_key is not None and (partition_key, low[0] if low else '') > start:
+            start = (partition_key, low[0] if low else '')
+        include_start = True
+        while True:
+            rows = self._store.scan(self.table_name, start, include_start, partition_key, high, SCAN_CHUNK)
+            yield from rows
+            if len(rows) < SCAN_CHUNK:
+                return
+            start, include_start = rows[-1][0], False
+
+    def _read_page(self, query, select, page_size, continuation_token):
+        # Reads from the continuation token until a page is full, returns its entities and the next token
+        start_time = time.perf_counter()
+        try:
+            start = ('', '')
+            if continuation_token:
+                start = (continuation_token['PartitionKey'], continuation_token['RowKey'])
+            entities = []
+            for key, record in self._candidates(query, start):
+                if len(entities) == page_size:
+                    return entities, {'PartitionKey': key[0], 'RowKey': key[1]}
+                properties = dict(record['properties'], PartitionKey=key[0], RowKey=key[1],
+                                  Timestamp=record['timestamp'])
+                if query is None or query.matches(properties):
+                    entities.append(_entity(key, record, select))
+            return entities, None
+        finally:
+            self._record_call('GET', start_time)
+
+    def _page_reader(self, query, results_per_page, select):
+        # The get_next of the pagers, reads the page of a continuation token
+        page_size = min(results_per_page or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        return lambda continuation_token: self._read_page(query, select, page_size, continuation_token)
+
+    def query_entities(self, query_filter, parameters=None, results_per_page=None, select=None, **kwargs):
+        return ItemPaged(self._page_reader(_query(query_filter, parameters), results_per_page, select),
+                         _extract_page)
+
+    def list_entities(self, results_per_page=None, select=None, **kwargs):
+        return ItemPaged(self._page_reader(None, results_per_page, select), _extract_page)
+
+    def close(self):
+        pass
+
+
+class AsyncLocalTableClient:
+    """The aio TableClient of a table of a local store, its calls run inline."""
+
+    def __init__(self, store, table_name):
+        self.table_name = table_name
+        self._client = LocalTableClient(store, table_name)
+
+    async def get_entity(self, *args, **kwargs):
+        return self._client.get_entity(*args, **kwargs)
+
+    async def create_entity(self, *args, **kwargs):
+        return self._client.create_entity(*args, **kwargs)
+
+    async def upsert_entity(self, *args, **kwargs):
+        return self._client.upsert_entity(*args, **kwargs)
+
+    async def update_entity(self, *args, **kwargs):
+        return self._client.update_entity(*args, **kwargs)
+
+    async def delete_entity(self, *args, **kwargs):
+        return self._client.delete_entity(*args, **kwargs)
+
+    async def submit_transaction(self, *args, **kwargs):
+        return self._client.submit_transaction(*args, **kwargs)
+
+    def _pager(self, read_page):
+        async def get_next(continuation_token):
+            return read_page(continuation_token)
+
+        async def extract_data(page):
+            return _extract_page(page)
+
+        return AsyncItemPaged(get_next, extract_data)
+
+    def query_entities(self, query_filter, parameters=None, results_per_page=None, select=None, **kwargs):
+        return self._pager(self._client._page_reader(_query(query_filter, parameters), results_per_page, select))
+
+    def list_entities(self, results_per_page=None, select=None, **kwargs):
+        return self._pager(self._client._page_reader(None, results_per_page, select))
+
+    async def close(self):
+        pass
@@ -0,0 +1,87 @@
+"""One-time removal of the HeatMapTable tracks duplicating a recorded route.
+
+Older app versions sent every point of a route they recorded to both
+CollectCoordination and CreateHeatMap, each under its own RowKey, so the raw heat
+map, which serves AllRouteCoordinations and HeatMapTable, returns these points twice.
+A HeatMapTable track duplicates a route of the same city when it follows it from
+start to end (route_match.frechet_within) with about as many points as the route
+received: both were sampled every 5 seconds, a run with RouteTimerScreen samples
+every second. A route has at most one duplicate.
+
+Run from the backend directory with the storage connection string set, before
+rebuilding the heat map grid with shared_code.build_heat_grid::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.migrate_heat_map [--dry-run]
+"""
+import logging
+import sys
+
+from shared_code import cache
+from shared_code.partitions import city_of
+from shared_code.route_codec import merge_points
+from shared_code.route_match import MATCH_DISTANCE_METERS, SHAPE_SPACING_METERS, frechet_within, resample
+from shared_code.route_store import decode_entity, delete_track, received_indexes, route_row_key
+from shared_code.tables import CONNECTION_STRING, COORDINATES_TABLE, HEAT_MAP_TABLE, get_table_client
+
+# Share of the points a duplicate may have more or less than the route, some requests of either one failed
+POINT_COUNT_TOLERANCE = 0.2
+
+
+def read_tracks(table_client):
+    """Return {(partition_key, row_key): (track, received)} for every route of a table.
+
+    received counts the points the route received, the ones the GPS filter dropped included.
+    """
+    chunks = {}
+    received = {}
+    for entity in table_client.list_entities():
+        key = (entity['PartitionKey'], route_row_key(entity['RowKey']))
+        chunks.setdefault(key, []).append(decode_entity(entity))
+        received[key] = received.get(key, 0) + len(received_indexes(entity))
+    return {key: (merge_points(*track_chunks), received[key]) for key, track_chunks in chunks.items()}
+
+
+def shape(track):
+    return resample([(latitude, longitude) for _, latitude, longitude, _ in track], SHAPE_SPACING_METERS)
+
+
+def is_duplicate(heat_shape, heat_count, route_shape, route_count):
+    if abs(heat_count - route_count) > POINT_COUNT_TOLERANCE * max(heat_count, route_count) + 2:
+        return False
+    return frechet_within(heat_shape, route_shape, MATCH_DISTANCE_METERS)
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    dry_run = '--dry-run' in sys.argv[1:]
+    heat_table = get_table_client(HEAT_MAP_TABLE)
+
+    routes_by_city = {}
+    for (partition_key, _), (track, received) in read_tracks(get_table_client(COORDINATES_TABLE)).items():
+        if track:
+            routes_by_city.setdefault(city_of(partition_key), []).append((shape(track), received))
+
+    removed = 0
+    for (partition_key, row_key), (track, _) in read_tracks(heat_table).items():
+        if not track:
+            continue
+        heat_shape = shape(track)
+        routes = routes_by_city.get(city_of(partition_key), [])
+        match = next((i for i, (route_shape, route_count) in enumerate(routes)
+                      if is_duplicate(heat_shape, len(track), route_shape, route_count)), None)
+        if match is None:
+            continue
+        routes.pop(match)
+        logging.info(f"Heat map track {partition_key}/{row_key} duplicates a recorded route")
+        if not dry_run:
+            delete_track(heat_table, partition_key, row_key)
+        removed += 1
+    if removed and not dry_run:
+        cache.invalidate(cache.HEAT_MAP)
+    logging.info(f"{'Found' if dry_run else 'Removed'} {removed} duplicate heat map tracks")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,110 @@
+"""Copy the routes stored in the partition of their city to the partitions of the geohash strategy.
+
+Run from the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.migrate_partitions [--delete]
+
+The rows of a route are copied to its new partition and left in place, so it can run
+while the app still writes with the city strategy. Switch the app to
+PARTITION_STRATEGY=geohash, run it again for the routes started in between, then once
+more with --delete to remove the rows left in the city partitions.
+"""
+import logging
+import sys
+
+from shared_code import cache, changes, geo_index, partitions, route_match
+from shared_code.route_store import CHUNK_SEPARATOR, read_track, route_row_key
+from shared_code.tables import (CONNECTION_STRING, COORDINATES_TABLE, HEAT_MAP_TABLE, METADATA_TABLE,
+                                RAW_COORDINATES_TABLE, ROUTE_CHANGES_TABLE, ROUTE_GEO_INDEX_TABLE, ROUTE_MATCH_TABLE,
+                                ROUTE_PARTITIONS_TABLE, ROUTE_RATINGS_TABLE, ROUTES_TABLE, get_table_client)
+from shared_code.transactions import delete_operations, submit
+
+# Tables whose rows of a route are keyed by its RowKey, or its RowKey and a ~ suffix
+ROUTE_TABLES = (ROUTES_TABLE, METADATA_TABLE, COORDINATES_TABLE, RAW_COORDINATES_TABLE, ROUTE_RATINGS_TABLE)
+
+
+def route_rows(table_client, partition_key, row_key):
+    rows = table_client.query_entities(
+        "PartitionKey eq @partition_key and RowKey ge @first and RowKey lt @last",
+        parameters={'partition_key': partition_key, 'first': row_key,
+                    'last': f"{row_key}{CHUNK_SEPARATOR}{CHUNK_SEPARATOR}"})
+    return [row for row in rows if route_row_key(row['RowKey']) == row_key]
+
+
+def move_rows(table_client, partition_key, row_key, new_partition_key, delete):
+    rows = route_rows(table_client, partition_key, row_key)
+    submit(table_client, [('upsert', dict(row, PartitionKey=new_partition_key)) for row in rows])
+    if delete:
+        submit(table_client, delete_operations(partition_key, [row['RowKey'] for row in rows]))
+
+
+def migrate_route(entity, new_partition_key, delete):
+    partition_key, row_key = entity['PartitionKey'], entity['RowKey']
+    for table_name in ROUTE_TABLES:
+        move_rows(get_table_client(table_name), partition_key, row_key, new_partition_key, delete)
+
+    # The index rows keep their keys, they only point to the new partition
+    bbox = geo_index.entity_bbox(entity)
+    if bbox:
+        start = (entity['start_cord_latitude'], entity['start_cord_longitude'])
+        submit(get_table_client(ROUTE_GEO_INDEX_TABLE),
+               [('upsert', index_entity)
+                for index_entity in geo_index.index_entities(new_partition_key, row_key, start, bbox)])
+    # So do the match index rows of the route and the runs attached to it
+    route_match.move_route(get_table_client(ROUTE_MATCH_TABLE), partition_key, row_key, new_partition_key)
+
+    # Delta syncs of the city read the new partition from now on
+    changes.record_change(get_table_client(ROUTE_CHANGES_TABLE), new_partition_key, row_key, changes.OP_UPSERT)
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    delete = '--delete' in sys.argv[1:]
+    route_table = get_table_client(ROUTES_TABLE)
+    heat_table = get_table_client(HEAT_MAP_TABLE)
+    partitions_table = get_table_client(ROUTE_PARTITIONS_TABLE)
+
+    migrated = 0
+    cities = set()
+    for entity in route_table.list_entities():
+        partition_key = entity['PartitionKey']
+        if partitions.SEPARATOR in partition_key:
+            continue
+        if entity.get('start_cord_latitude') is None:
+            logging.info(f"Skipped route {entity['RowKey']} without a start point")
+            continue
+        new_partition_key = partitions.route_partition(partition_key, entity['start_cord_latitude'],
+                                                       entity['start_cord_longitude'], partitions.STRATEGY_GEOHASH)
+        partitions.register_partition(partitions_table, new_partition_key)
+        try:
+            migrate_route(entity, new_partition_key, delete)
+        except Exception as e:
+            logging.error(f"Error migrating route {entity['RowKey']}: {e}")
+            continue
+        cities.add(partition_key)
+        migrated += 1
+
+    # The points CreateHeatMap stores for routes that are not recorded
+    heat_routes = {(row['PartitionKey'], route_row_key(row['RowKey']))
+                   for row in heat_table.list_entities(select=['PartitionKey', 'RowKey'])
+                   if partitions.SEPARATOR not in row['PartitionKey']}
+    for partition_key, row_key in sorted(heat_routes):
+        track = read_track(heat_table, partition_key, row_key)
+        if not track:
+            continue
+        new_partition_key = partitions.route_partition(partition_key, track[0][1], track[0][2],
+                                                       partitions.STRATEGY_GEOHASH)
+        try:
+            move_rows(heat_table, partition_key, row_key, new_partition_key, delete)
+        except Exception as e:
+            logging.error(f"Error migrating the heat map track {row_key}: {e}")
+
+    for city in cities:
+        cache.invalidate(cache.ROUTES, city)
+    logging.info(f"Migrated {migrated} routes and {len(heat_routes)} heat map tracks")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,42 @@
+"""Seed the rating counter shards of the routes rated before the ratings were sharded.
+
+Run from the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.migrate_ratings
+
+The first refresh of a rated route seeds its older ratings too, see shared_code.ratings.
+This seeds the routes nobody rated since the deployment, it can run any time and again.
+"""
+import logging
+
+from shared_code import ratings
+from shared_code.tables import CONNECTION_STRING, METADATA_TABLE, ROUTE_RATINGS_TABLE, get_table_client
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    metadata_table = get_table_client(METADATA_TABLE)
+    ratings_table = get_table_client(ROUTE_RATINGS_TABLE)
+
+    migrated = 0
+    for entity in metadata_table.list_entities(
+            select=['PartitionKey', 'RowKey', 'score', 'count', ratings.SHARDED_PROPERTY]):
+        # The routes refreshed from their shards already hold their aggregate, not older ratings
+        shard = ratings.legacy_shard(entity['PartitionKey'], entity['RowKey'], entity)
+        if shard is None:
+            continue
+        # The cached mean and count become a shard of their own, next to the shards the new
+        # ratings landed in meanwhile. create_entity fails if it was seeded already.
+        try:
+            ratings_table.create_entity(entity=shard)
+        except Exception as e:
+            logging.info(f"Skipped route {entity['RowKey']}: {e}")
+            continue
+        migrated += 1
+    logging.info(f"Seeded the ratings of {migrated} routes")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
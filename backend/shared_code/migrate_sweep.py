@@ -0,0 +1,51 @@
+"""Prepare the rows SweepRoutes reads for the data stored before it stopped scanning the tables.
+
+Lists the users of every route in RouteUsers, copies the tombstones not swept yet to the
+sweep partition of the change log and registers the partitions of the log. Run once from
+the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.migrate_sweep
+"""
+import logging
+
+from shared_code import changes
+from shared_code.tables import (CONNECTION_STRING, PERSONAL_METADATA_TABLE, ROUTE_CHANGES_TABLE, ROUTE_USERS_TABLE,
+                                get_table_client)
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    users_table = get_table_client(ROUTE_USERS_TABLE)
+    changes_table = get_table_client(ROUTE_CHANGES_TABLE)
+
+    users = 0
+    for entity in get_table_client(PERSONAL_METADATA_TABLE).list_entities(select=['PartitionKey', 'RowKey']):
+        users_table.upsert_entity(entity={'PartitionKey': entity['RowKey'], 'RowKey': entity['PartitionKey']})
+        users += 1
+    logging.info(f"Listed {users} users of routes")
+
+    tombstones = 0
+    log_partitions = set()
+    for entity in changes_table.list_entities():
+        if entity['PartitionKey'].startswith('~'):
+            continue
+        log_partitions.add(entity['PartitionKey'])
+        # Tombstones written before the sweep partition have a swept flag
+        if entity.get('op') == changes.OP_DELETE and entity.get('swept') is False:
+            changes_table.upsert_entity(entity={
+                'PartitionKey': changes.SWEEP_PARTITION,
+                'RowKey': entity['RowKey'],
+                'route_row_key': entity['route_row_key'],
+                'route_partition_key': entity['PartitionKey'],
+                'op': changes.OP_DELETE,
+            })
+            tombstones += 1
+    for partition_key in log_partitions:
+        changes_table.upsert_entity(entity={'PartitionKey': changes.LOG_PARTITIONS, 'RowKey': partition_key})
+    logging.info(f"Queued {tombstones} tombstones to sweep, registered {len(log_partitions)} log partitions")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
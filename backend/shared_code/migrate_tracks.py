@@ -0,0 +1,23 @@
+"""One-time migration of the legacy wide Coord{i}_Lat/Coord{i}_Lon entities to packed tracks.
+
+Run from the backend directory with the storage connection string set::
+
+    AzureWebJobsStorage="<connection string>" python -m shared_code.migrate_tracks
+"""
+import logging
+
+from shared_code.route_store import migrate_table
+from shared_code.tables import CONNECTION_STRING, COORDINATES_TABLE, HEAT_MAP_TABLE, get_table_client
+
+
+def main():
+    if not CONNECTION_STRING:
+        raise SystemExit("AzureWebJobsStorage environment variable is not set.")
+    for table_name in (COORDINATES_TABLE, HEAT_MAP_TABLE):
+        migrated = migrate_table(get_table_client(table_name))
+        logging.info(f"Migrated {migrated} entities of {table_name}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,243 @@
+"""Evaluation of Table storage query filters, for the local storage backends.
+
+Supports the subset of the OData filter syntax the Table service accepts: the
+comparisons eq, ne, gt, ge, lt and le between a property and a literal or an
+@parameter, combined with and, or, not and parentheses. Like the service, a
+comparison with a missing property or a value of another type is false.
+"""
+import base64
+import re
+import uuid
+from datetime import datetime, timezone
+
+COMPARISONS = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a > b,
+    'ge': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'le': lambda a, b: a <= b,
+}
+# The operator of a comparison with its operands swapped
+FLIPPED = {'eq': 'eq', 'ne': 'ne', 'gt': 'lt', 'ge': 'le', 'lt': 'gt', 'le': 'ge'}
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<paren>[()])
+      | (?P<typed>(?:datetime|guid|X|binary)'[^']*')
+      | (?P<string>'(?:[^']|'')*')
+      | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?[LlDdMmFf]?)
+      | (?P<parameter>@\w+)
+      | (?P<word>[A-Za-z_]\w*)
+    )""", re.VERBOSE)
+
+
+def _tokenize(query_filter):
+    tokens = []
+    position = 0
+    query_filter = query_filter.rstrip()
+    while position < len(query_filter):
+        match = _TOKEN.match(query_filter, position)
+        if match is None:
+            raise ValueError(f"Invalid filter at {position}: {query_filter!r}")
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+def _parse_datetime(value):
+    value = value.replace('Z', '+00:00')
+    # The service accepts up to 7 digits of fractional seconds, Python up to 6
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value)
+    return normalize(datetime.fromisoformat(value))
+
+
+def _literal(kind, text):
+    if kind == 'string':
+        return text[1:-1].replace("''", "'")
+    if kind == 'number':
+        if text[-1] in 'LlDdMmFf':
+            return float(text[:-1]) if text[-1] not in 'Ll' else int(text[:-1])
+        return float(text) if any(c in text for c in '.eE') else int(text)
+    prefix, value = text.split("'", 1)
+    value = value[:-1]
+    if prefix == 'datetime':
+        return _parse_datetime(value)
+    if prefix == 'guid':
+        return str(uuid.UUID(value))
+    return base64.b16decode(value.upper())
+
+
+def normalize(value):
+    """Return value as it is compared, datetimes in UTC and Int64 properties as int."""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    # EntityProperty and the Int64 values the SDK returns
+    if hasattr(value, 'edm_type') and hasattr(value, 'value'):
+        return normalize(value.value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float)):
+        return 'number'
+    return type(value)
+
+
+class Filter:
+    """A compiled filter, matches(properties) tests an entity with its Timestamp in properties.
+
+    partition_key, row_keys and row_key_range hold the conditions on the keys every
+    match satisfies, so a store can narrow its scan: the PartitionKey value, the set of
+    RowKeys and the (low, high) RowKey bounds as (value, inclusive), each None when the
+    filter does not restrict it.
+    """
+
+    def __init__(self, query_filter, parameters=None):
+        self._parameters = parameters or {}
+        self._tokens = _tokenize(query_filter)
+        self._position = 0
+        tree = self._or()
+        if self._position != len(self._tokens):
+            raise ValueError(f"Unexpected {self._tokens[self._position][1]!r} in filter {query_filter!r}")
+        self.matches = self._compile(tree)
+        self.partition_key = _partition_key(tree)
+        self.row_keys = _row_keys(tree)
+        low, high = _row_key_bounds(tree)
+        self.row_key_range = (low, high) if low or high else None
+
+    # Parsing into ('or'|'and', left, right), ('not', operand) and (operator, property, value) nodes
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError("Unexpected end of filter")
+        self._position += 1
+        return token
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == ('word', 'or'):
+            self._next()
+            node = ('or', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._unary()
+        while self._peek() == ('word', 'and'):
+            self._next()
+            node = ('and', node, self._unary())
+        return node
+
+    def _unary(self):
+        if self._peek() == ('word', 'not'):
+            self._next()
+            return ('not', self._unary())
+        if self._peek() == ('paren', '('):
+            self._next()
+            node = self._or()
+            if self._next() != ('paren', ')'):
+                raise ValueError("Missing ) in filter")
+            return node
+        return self._comparison()
+
+    def _operand(self):
+        kind, text = self._next()
+        if kind == 'parameter':
+            name = text[1:]
+            if name not in self._parameters:
+                raise ValueError(f"Missing filter parameter {name}")
+            return 'value', normalize(self._parameters[name])
+        if kind == 'word':
+            if text in ('true', 'false'):
+                return 'value', text == 'true'
+            return 'property', text
+        if kind == 'paren':
+            raise ValueError(f"Unexpected {text!r} in filter")
+        return 'value', _literal(kind, text)
+
+    def _comparison(self):
+        left = self._operand()
+        kind, operator = self._next()
+        if kind != 'word' or operator not in COMPARISONS:
+            raise ValueError(f"Unknown operator {operator!r} in filter")
+        right = self._operand()
+        if left[0] == 'value' and right[0] == 'property':
+            left, right, operator = right, left, FLIPPED[operator]
+        if left[0] != 'property' or right[0] != 'value':
+            raise ValueError("A comparison needs a property and a value")
+        return (operator, left[1], right[1])
+
+    def _compile(self, node):
+        if node[0] in ('or', 'and'):
+            left, right = self._compile(node[1]), self._compile(node[2])
+            if node[0] == 'or':
+                return lambda properties: left(properties) or right(properties)
+            return lambda properties: left(properties) and right(properties)
+        if node[0] == 'not':
+            operand = self._compile(node[1])
+            return lambda properties: not operand(properties)
+
+        operator, name, value = node
+        compare = COMPARISONS[operator]
+        value_kind = _kind(value)
+
+        def matches(properties):
+            actual = properties.get(name)
+            if actual is None:
+                return False
+            actual = normalize(actual)
+            return _kind(actual) == value_kind and compare(actual, value)
+        return matches
+
+
+def _is_key_condition(node, name):
+    return node[0] in COMPARISONS and node[1] == name and isinstance(node[2], str)
+
+
+def _partition_key(node):
+    if _is_key_condition(node, 'PartitionKey') and node[0] == 'eq':
+        return node[2]
+    if node[0] == 'and':
+        return _partition_key(node[1]) or _partition_key(node[2])
+    return None
+
+
+def _row_keys(node):
+    # The RowKeys a match can have, None when any
+    if _is_key_condition(node, 'RowKey') and node[0] == 'eq':
+        return {node[2]}
+    if node[0] in ('and', 'or'):
+        left, right = _row_keys(node[1]), _row_keys(node[2])
+        if node[0] == 'or':
+            return None if left is None or right is None else left | right
+        return right if left is None else left if right is None else left & right
+    return None
+
+
+def _row_key_bounds(node):
+    # The (low, high) bounds of the RowKeys a match can have, as (value, inclusive) or None
+    if _is_key_condition(node, 'RowKey'):
+        operator, value = node[0], node[2]
+        return ((value, operator != 'gt') if operator in ('eq', 'ge', 'gt') else None,
+                (value, operator != 'lt') if operator in ('eq', 'le', 'lt') else None)
+    if node[0] not in ('and', 'or'):
+        return None, None
+    (left_low, left_high), (right_low, right_high) = _row_key_bounds(node[1]), _row_key_bounds(node[2])
+    if node[0] == 'or':
+        # Bounded only when both sides are, by the looser bound
+        low = min(left_low, right_low, key=lambda bound: (bound[0], not bound[1])) if left_low and right_low else None
+        high = max(left_high, right_high, key=lambda bound: (bound[0], bound[1])) if left_high and right_high else None
+        return low, high
+    low = max((bound for bound in (left_low, right_low) if bound), key=lambda bound: (bound[0], not bound[1]),
+              default=None)
+    high = min((bound for bound in (left_high, right_high) if bound), key=lambda bound: (bound[0], bound[1]),
+               default=None)
+    return low, high
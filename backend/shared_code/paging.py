@@ -0,0 +1,62 @@
+"""Opaque continuation tokens for the paginated list endpoints."""
+import base64
+import json
+
+# Upper bound of the page_size query parameter
+MAX_PAGE_SIZE = 1000
+CONTINUATION_HEADER = 'X-Continuation-Token'
+
+
+def encode_token(token):
+    """Encode a Table SDK continuation token (or None) into a URL-safe string."""
+    if not token:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+
+
+def decode_token(value):
+    """Decode a token from encode_token, raise ValueError if it is invalid."""
+    if not value:
+        return None
+    try:
+        token = json.loads(base64.urlsafe_b64decode(value.encode()))
+    except Exception:
+        raise ValueError("Invalid continuation token.")
+    if not isinstance(token, dict):
+        raise ValueError("Invalid continuation token.")
+    return token
+
+
+def get_page_size(params):
+    """Return the requested page size or None when the whole result is requested."""
+    page_size = params.get('page_size')
+    if not page_size:
+        return None
+    try:
+        page_size = int(page_size)
+    except ValueError:
+        raise ValueError("page_size must be an integer.")
+    if not 0 < page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {MAX_PAGE_SIZE}.")
+    return page_size
+
+
+def read_page(entities_pager, continuation_token):
+    """Read one page of a query_entities/list_entities pager created with results_per_page.
+
+    Returns the entities of the page and the continuation token of the next one.
+    """
+    pages = entities_pager.by_page(continuation_token=continuation_token)
+    entities = list(next(pages, []))
+    return entities, pages.continuation_token
+
+
+async def read_page_async(entities_pager, continuation_token):
+    """Like read_page with an aio query_entities/list_entities pager."""
+    pages = entities_pager.by_page(continuation_token=continuation_token)
+    try:
+        page = await pages.__anext__()
+    except StopAsyncIteration:
+        return [], None
+    entities = [entity async for entity in page]
+    return entities, pages.continuation_token
@@ -0,0 +1,74 @@
+"""Partition keys of the route tables.
+
+Routes are stored in the partition of their city, "Tel Aviv" by default, so all the
+writes of a city land on one Table partition, which serves about 2000 entities per
+second. With PARTITION_STRATEGY=geohash a route is stored in a partition of its city
+and the geohash prefix of its start instead, like "Tel Aviv:sv8w". The partitions of
+a city are registered in RoutePartitions, so the reads of a city can span them.
+
+The partition key returned to the app is the one of the route, the app sends it
+back on later requests for that route. Run shared_code.migrate_partitions to move
+the routes stored before the strategy was changed.
+"""
+import os
+
+from shared_code.concurrency import collect
+from shared_code.geohash import encode
+
+STRATEGY_CITY = 'city'
+STRATEGY_GEOHASH = 'geohash'
+PARTITION_STRATEGY = os.getenv('PARTITION_STRATEGY', STRATEGY_CITY)
+# Cells of about 39km, a city spans a handful of them
+PARTITION_PRECISION = int(os.getenv('PARTITION_GEOHASH_PRECISION', '4'))
+DEFAULT_CITY = "Tel Aviv"
+# Not allowed in city names, # / \ and ? are not allowed in PartitionKeys
+SEPARATOR = ':'
+
+# Partitions this worker registered already, registering is idempotent
+_registered = set()
+
+
+def city_of(partition_key):
+    """Return the city of a partition key, the response cache of GetRoutes is kept per city."""
+    return partition_key.split(SEPARATOR, 1)[0]
+
+
+def route_partition(city, latitude, longitude, strategy=None):
+    """Return the partition key of a new route of a city starting at (latitude, longitude).
+
+    city may be the partition key of the route already, it then maps to itself.
+    """
+    city = city_of(city or DEFAULT_CITY)
+    if (strategy or PARTITION_STRATEGY) != STRATEGY_GEOHASH:
+        return city
+    return f"{city}{SEPARATOR}{encode(latitude, longitude, PARTITION_PRECISION)}"
+
+
+def spans_partitions(partition_key):
+    """Return whether reading partition_key means reading all the partitions of a city."""
+    return PARTITION_STRATEGY == STRATEGY_GEOHASH and SEPARATOR not in partition_key
+
+
+def partition_entity(partition_key):
+    return {'PartitionKey': city_of(partition_key), 'RowKey': partition_key}
+
+
+def register_partition(table_client, partition_key):
+    """Register the partition of a route with its city, once per worker."""
+    if SEPARATOR not in partition_key or partition_key in _registered:
+        return
+    table_client.upsert_entity(entity=partition_entity(partition_key))
+    _registered.add(partition_key)
+
+
+async def read_partitions_async(table_client, partition_key):
+    """Return the sorted partition keys to read for a requested partition key.
+
+    A city spans its registered partitions with the geohash strategy, any other
+    partition key is read as is.
+    """
+    if not spans_partitions(partition_key):
+        return [partition_key]
+    entities = await collect(table_client.query_entities("PartitionKey eq @city",
+                                                         parameters={'city': partition_key}, select=['RowKey']))
+    return sorted(entity['RowKey'] for entity in entities)
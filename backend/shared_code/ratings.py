@@ -0,0 +1,147 @@
+"""Sharded rating counters of the routes.
+
+The ratings of a route are summed in SHARD_COUNT counter rows of RouteRatings, and
+every rating increments one shard picked at random with a conditional merge. Raters
+of the same route rarely write the same row, so they do not overwrite each other, and
+the rating throughput of a route grows with the number of shards. The mean score and
+count are cached on the RoutesMetadata entity, which is what GetRoutes reads. UpdateRoute
+refreshes them from the shards right after a rating, and leaves a marker of the route in
+the DIRTY_PARTITION of RouteRatings. Two concurrent raters may cache their aggregates in
+the wrong order, so CompactRatings refreshes the marked routes again every few minutes.
+
+The ratings given before the sharding are the score and count of the metadata entity
+without the SHARDED_PROPERTY. The first refresh of the route seeds them into the
+LEGACY_SHARD, so they are counted once however often it or migrate_ratings runs.
+"""
+import logging
+import os
+import random
+
+from shared_code.bootstrap import azure_core, core_exceptions, data_tables
+from shared_code.concurrency import collect
+from shared_code.transactions import delete_operations, submit, submit_async
+
+SHARD_COUNT = int(os.getenv('RATING_SHARDS', '8'))
+SHARD_SEPARATOR = '~'
+# Shard holding the ratings given before they were sharded, never written by add_rating
+LEGACY_SHARD = 'legacy'
+WRITE_RETRIES = 5
+# Not a route partition, the cities never start with '~'
+DIRTY_PARTITION = '~dirty'
+# Set on the metadata entities whose score and count are the aggregate of the shards
+SHARDED_PROPERTY = 'rating_sharded'
+
+
+def shard_row_key(row_key, shard):
+    if shard == LEGACY_SHARD:
+        return f"{row_key}{SHARD_SEPARATOR}{shard}"
+    return f"{row_key}{SHARD_SEPARATOR}{shard:02d}"
+
+
+def route_row_key(shard_key):
+    return shard_key.split(SHARD_SEPARATOR, 1)[0]
+
+
+def _shards_query(partition_key, row_key):
+    return ("PartitionKey eq @partition_key and RowKey gt @first and RowKey lt @last",
+            {'partition_key': partition_key, 'first': f"{row_key}{SHARD_SEPARATOR}",
+             'last': f"{row_key}{SHARD_SEPARATOR}{SHARD_SEPARATOR}"})
+
+
+def aggregate(shards):
+    """Return the (mean score, count) of the counter rows of a route, the score is None without ratings."""
+    total = sum(float(shard.get('score_sum', 0)) for shard in shards)
+    count = sum(int(shard.get('count', 0)) for shard in shards)
+    return (total / count if count else None), count
+
+
+async def add_rating(table_client, partition_key, row_key, score):
+    """Add a score to a random counter shard of a route with one conditional write."""
+    for attempt in range(WRITE_RETRIES):
+        # A conflicting rater most likely wrote this shard only, the retry picks another one
+        shard_key = shard_row_key(row_key, random.randrange(SHARD_COUNT))
+        try:
+            shard = await table_client.get_entity(partition_key=partition_key, row_key=shard_key)
+        except core_exceptions.ResourceNotFoundError:
+            shard = None
+
+        try:
+            if shard is None:
+                await table_client.create_entity(entity={'PartitionKey': partition_key, 'RowKey': shard_key,
+                                                         'score_sum': float(score), 'count': 1})
+            else:
+                await table_client.update_entity(entity={'PartitionKey': partition_key, 'RowKey': shard_key,
+                                                         'score_sum': float(shard['score_sum']) + float(score),
+                                                         'count': int(shard['count']) + 1},
+                                                 mode=data_tables.UpdateMode.MERGE, etag=shard.metadata['etag'],
+                                                 match_condition=azure_core.MatchConditions.IfNotModified)
+            return
+        except (core_exceptions.ResourceExistsError, core_exceptions.ResourceModifiedError):
+            logging.info(f"Concurrent rating of route {row_key}, retry {attempt + 1}")
+    raise RuntimeError(f"Could not rate route {row_key} after {WRITE_RETRIES} attempts")
+
+
+async def read_rating(table_client, partition_key, row_key):
+    """Return the (mean score, count) of a route summed over its shards."""
+    query_filter, parameters = _shards_query(partition_key, row_key)
+    return aggregate(await collect(table_client.query_entities(query_filter, parameters=parameters)))
+
+
+def delete_ratings(table_client, partition_key, row_key):
+    """Delete the counter shards of a route, in one transaction."""
+    query_filter, parameters = _shards_query(partition_key, row_key)
+    shards = table_client.query_entities(query_filter, parameters=parameters, select=['RowKey'])
+    submit(table_client, delete_operations(partition_key, [shard['RowKey'] for shard in shards]))
+
+
+async def delete_ratings_async(table_client, partition_key, row_key):
+    """Like delete_ratings with an aio TableClient."""
+    query_filter, parameters = _shards_query(partition_key, row_key)
+    shards = await collect(table_client.query_entities(query_filter, parameters=parameters, select=['RowKey']))
+    await submit_async(table_client, delete_operations(partition_key, [shard['RowKey'] for shard in shards]))
+
+
+def rating_properties(score, count):
+    """Return the RoutesMetadata properties caching the aggregate of a route."""
+    return {'score': float(score), 'count': count, SHARDED_PROPERTY: True}
+
+
+def legacy_shard(partition_key, row_key, entity):
+    """Return the legacy shard of the ratings a metadata entity holds from before the sharding, or None."""
+    if entity.get(SHARDED_PROPERTY) or entity.get('score') is None or not entity.get('count'):
+        return None
+    return {
+        'PartitionKey': partition_key,
+        'RowKey': shard_row_key(row_key, LEGACY_SHARD),
+        'score_sum': float(entity['score']) * int(entity['count']),
+        'count': int(entity['count']),
+    }
+
+
+async def mark_dirty(table_client, partition_key, row_key):
+    """Mark a rated route for CompactRatings."""
+    await table_client.upsert_entity(entity={'PartitionKey': DIRTY_PARTITION, 'RowKey': row_key,
+                                             'route_partition_key': partition_key})
+
+
+async def refresh_rating(ratings_table, metadata_table, partition_key, row_key):
+    """Cache the aggregate of the shards of a route on its metadata entity, return whether it has ratings."""
+    try:
+        entity = await metadata_table.get_entity(partition_key=partition_key, row_key=row_key,
+                                                 select=['score', 'count', SHARDED_PROPERTY])
+    except core_exceptions.ResourceNotFoundError:
+        entity = None
+    shard = legacy_shard(partition_key, row_key, entity) if entity is not None else None
+    if shard is not None:
+        # create_entity fails if migrate_ratings or an earlier refresh seeded it already
+        try:
+            await ratings_table.create_entity(entity=shard)
+        except core_exceptions.ResourceExistsError:
+            pass
+    score, count = await read_rating(ratings_table, partition_key, row_key)
+    if not count:
+        return False
+    entity = {'PartitionKey': partition_key, 'RowKey': row_key}
+    entity.update(rating_properties(score, count))
+    await metadata_table.upsert_entity(entity=entity, mode=data_tables.UpdateMode.MERGE)
+    return True
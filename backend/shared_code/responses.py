@@ -0,0 +1,156 @@
+import gzip
+import hashlib
+import json
+
+import azure.functions as func
+
+from shared_code import cache
+from shared_code.paging import CONTINUATION_HEADER, encode_token
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Smaller bodies fit in a few packets, compressing them is not worth the CPU
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps(value):
+    """Serialize to JSON bytes, with orjson when it is installed.
+
+    Values JSON does not know are written with str() in both cases.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(value, default=str, separators=(',', ':')).encode()
+
+
+def list_response(results, req, continuation_token=None):
+    """Return the HTTP response of a list endpoint.
+
+    With format=ndjson every item is written on its own line so clients can
+    parse and render items before the whole body has been read. The token of
+    the next page, if any, is returned in the X-Continuation-Token header.
+    """
+    headers = {}
+    token = encode_token(continuation_token)
+    if token:
+        headers[CONTINUATION_HEADER] = token
+
+    if req.params.get('format') == 'ndjson':
+        body = b''.join(dumps(item) + b'\n' for item in results)
+        return func.HttpResponse(body, status_code=200, mimetype=NDJSON_MIMETYPE, headers=headers)
+
+    return func.HttpResponse(dumps(results), status_code=200, mimetype="application/json", headers=headers)
+
+
+def delta_response(items_key, results, watermark, deleted=None, full=False, continuation_token=None):
+    """Return the HTTP response of a delta sync.
+
+    The body holds the changed items under items_key, the RowKeys of the deleted
+    items, the watermark to send as since on the next sync, and whether the client
+    must replace its state because the delta could not be computed.
+    """
+    headers = {}
+    token = encode_token(continuation_token)
+    if token:
+        headers[CONTINUATION_HEADER] = token
+    body = {items_key: results, "watermark": str(watermark), "full": full}
+    if deleted is not None:
+        body["deleted"] = deleted
+    return func.HttpResponse(dumps(body), status_code=200, mimetype="application/json", headers=headers)
+
+
+def etag(body):
+    """Return the strong ETag of a response body."""
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def accepted_encoding(accept_encoding):
+    """Return the best content coding of an Accept-Encoding header we support, or None."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def conditional_response(req, body, mimetype, headers):
+    """Return a 200 response with the ETag of its body, or an empty 304 if the client has that body.
+
+    The body is compressed with brotli or gzip as allowed by the Accept-Encoding of the
+    request, every encoding of a body has its own strong ETag.
+    """
+    headers = dict(headers)
+    headers['ETag'] = etag(body)
+    headers['Vary'] = 'Accept-Encoding'
+    coding = accepted_encoding(req.headers.get('Accept-Encoding')) if len(body) >= MIN_COMPRESS_BYTES else None
+    if coding:
+        headers['ETag'] = f'{headers["ETag"][:-1]}-{coding}"'
+    if_none_match = req.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*'
+                          or headers['ETag'] in (tag.strip() for tag in if_none_match.split(','))):
+        return func.HttpResponse(status_code=304, headers=headers)
+    if coding:
+        headers['Content-Encoding'] = coding
+        body = compress(body, coding)
+    return func.HttpResponse(body, status_code=200, mimetype=mimetype, headers=headers)
+
+
+def cached_response(req, namespace, partition_key, build):
+    """Return the response of build(req) through the response cache, with ETag and 304 support.
+
+    Only 200 responses are cached, errors are returned as built.
+    """
+    key = cache.entry_key(namespace, partition_key, req.params)
+    cached = cache.get(key)
+    if cached is None:
+        response = build(req)
+        if response.status_code != 200:
+            return response
+        cached = (response.get_body(), response.mimetype, dict(response.headers))
+        cache.put(key, *cached)
+    return conditional_response(req, *cached)
+
+
+async def cached_response_async(req, namespace, partition_key, build, cacheable=True):
+    """Like cached_response with a coroutine function build.
+
+    With cacheable false the response is built every time, with ETag and 304 support still.
+    """
+    key = cache.entry_key(namespace, partition_key, req.params) if cacheable else None
+    cached = cache.get(key) if cacheable else None
+    if cached is None:
+        response = await build(req)
+        if response.status_code != 200:
+            return response
+        cached = (response.get_body(), response.mimetype, dict(response.headers))
+        if cacheable:
+            cache.put(key, *cached)
+    return conditional_response(req, *cached)
@@ -0,0 +1,271 @@
+"""Matching of finished runs to the routes already in the catalog.
+
+Every catalog route has a signature: its shape, the track resampled every
+SHAPE_SPACING_METERS, and a MinHash of the precision-7 geohash cells (about 150m)
+the shape visits. The MinHash is split into NUM_BANDS bands of BAND_ROWS values
+and a route is stored under the bucket of every band (locality sensitive hashing),
+so routes visiting mostly the same cells share a bucket with high probability.
+
+A finished run only reads the NUM_BANDS buckets of its own signature, and the
+routes found there are confirmed with a discrete Fréchet check of the shapes:
+a match follows the run within MATCH_DISTANCE_METERS from start to end, in the
+same direction. A matched run is attached to the route instead of joining the
+catalog, and an alias row maps it to the route so later requests with its
+RowKey, like rating it with UpdateRoute, apply to the route. The aliases are
+deleted with the route, like the runs it absorbed.
+
+The rows of a city share one RouteMatchIndex partition:
+
+    b<band><bucket>_<row_key>   the bucket rows of a route
+    s_<row_key>                 the shape of a route and its buckets
+    a_<row_key>                 the route a run was attached to
+"""
+import hashlib
+import math
+import os
+import random
+
+from shared_code.bootstrap import core_exceptions
+from shared_code.geo import EARTH_RADIUS_METERS, haversine
+from shared_code.geohash import BASE32, encode
+from shared_code.partitions import city_of
+from shared_code.route_codec import decode_points, encode_points
+from shared_code.transactions import delete_operations, submit, submit_async
+
+ENABLED = os.getenv('ROUTE_MATCH', '1') != '0'
+MATCH_DISTANCE_METERS = float(os.getenv('ROUTE_MATCH_DISTANCE_METERS', '50'))
+# Shorter runs are never matched, every walk to the corner would look alike
+MIN_ROUTE_METERS = 500.0
+CELL_PRECISION = 7
+SHAPE_SPACING_METERS = 20.0
+# Longer routes get a coarser shape, a shape row stays a few KB
+MAX_SHAPE_POINTS = 500
+# Two values per band pick routes sharing about a third of their cells or more
+NUM_BANDS = 10
+BAND_ROWS = 2
+# Candidates checked per run, the ones sharing the most buckets first
+MAX_CANDIDATES = 20
+
+# Fixed hash functions, the signatures of every worker must agree
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)
+_HASHES = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME)) for _ in range(NUM_BANDS * BAND_ROWS)]
+
+
+class Signature:
+    """The shape, cells and LSH buckets of a track."""
+
+    def __init__(self, shape):
+        self.shape = shape
+        cells = {_cell_number(encode(latitude, longitude, CELL_PRECISION)) for latitude, longitude in shape}
+        minhash = [min((a * cell + b) % _PRIME for cell in cells) for a, b in _HASHES]
+        self.buckets = [_bucket(band, minhash[band * BAND_ROWS:(band + 1) * BAND_ROWS]) for band in range(NUM_BANDS)]
+
+
+def _cell_number(cell):
+    number = 0
+    for char in cell:
+        number = number * 32 + BASE32.index(char)
+    return number
+
+
+def _bucket(band, values):
+    digest = hashlib.blake2b(','.join(map(str, values)).encode(), digest_size=8).hexdigest()
+    return f"b{band:02d}{digest}"
+
+
+def _length(points):
+    return sum(haversine(lat1, lon1, lat2, lon2) for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]))
+
+
+def resample(points, spacing):
+    """Return (latitude, longitude) points every spacing meters along points, both ends included."""
+    result = [points[0]]
+    position = spacing
+    for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+        segment = haversine(lat1, lon1, lat2, lon2)
+        while position <= segment:
+            fraction = position / segment
+            result.append((lat1 + fraction * (lat2 - lat1), lon1 + fraction * (lon2 - lon1)))
+            position += spacing
+        position -= segment
+    if result[-1] != points[-1]:
+        result.append(points[-1])
+    return result
+
+
+def signature(track):
+    """Return the Signature of a finished track, None when it is too short to be matched."""
+    points = [(latitude, longitude) for _, latitude, longitude, _ in track]
+    if len(points) < 2:
+        return None
+    length = _length(points)
+    if length < MIN_ROUTE_METERS:
+        return None
+    return Signature(resample(points, max(SHAPE_SPACING_METERS, length / (MAX_SHAPE_POINTS - 1))))
+
+
+def frechet_within(first, second, threshold):
+    """Return whether the discrete Fréchet distance of two (latitude, longitude) shapes is within threshold meters.
+
+    Only the cells of the coupling table reachable within threshold are computed, so
+    shapes far apart are rejected after a few rows.
+    """
+    cos_lat = math.cos(math.radians(first[0][0]))
+    scale = math.radians(1) * EARTH_RADIUS_METERS
+    project = [(lon * scale * cos_lat, lat * scale) for lat, lon in second]
+    limit = threshold * threshold
+
+    def near(point, j):
+        x, y = point[1] * scale * cos_lat - project[j][0], point[0] * scale - project[j][1]
+        return x * x + y * y <= limit
+
+    if not near(first[0], 0) or not near(first[-1], len(second) - 1):
+        return False
+    previous = None
+    for i, point in enumerate(first):
+        row = [False] * len(second)
+        for j in range(len(second)):
+            if i == 0:
+                reachable = j == 0 or row[j - 1]
+            else:
+                reachable = previous[j] or (j > 0 and (previous[j - 1] or row[j - 1]))
+            row[j] = reachable and near(point, j)
+        if not any(row):
+            return False
+        previous = row
+    return previous[-1]
+
+
+def _shape_row_key(row_key):
+    return f"s_{row_key}"
+
+
+def _alias_row_key(row_key):
+    return f"a_{row_key}"
+
+
+def find_match(table_client, partition_key, row_key, run_signature):
+    """Return the (partition_key, row_key) of the catalog route a run follows, or None.
+
+    Reads the buckets of the run signature and the shapes of the best candidates.
+    """
+    city = city_of(partition_key)
+    hits = {}
+    for bucket in run_signature.buckets:
+        for entity in table_client.query_entities(
+                "PartitionKey eq @city and RowKey gt @first and RowKey lt @last",
+                parameters={'city': city, 'first': f"{bucket}_", 'last': f"{bucket}`"},
+                select=['route_partition_key', 'route_row_key']):
+            key = (entity['route_partition_key'], entity['route_row_key'])
+            if key != (partition_key, row_key):
+                hits[key] = hits.get(key, 0) + 1
+
+    for key in sorted(hits, key=lambda key: -hits[key])[:MAX_CANDIDATES]:
+        try:
+            entity = table_client.get_entity(partition_key=city, row_key=_shape_row_key(key[1]))
+        except core_exceptions.ResourceNotFoundError:
+            continue
+        shape = [(latitude, longitude) for _, latitude, longitude, _ in decode_points(entity['shape'])]
+        if frechet_within(run_signature.shape, shape, MATCH_DISTANCE_METERS):
+            return key
+    return None
+
+
+def index_route(table_client, partition_key, row_key, route_signature):
+    """Store the shape and bucket rows of a catalog route, in one transaction."""
+    city = city_of(partition_key)
+    shape = encode_points([(index, latitude, longitude, None)
+                           for index, (latitude, longitude) in enumerate(route_signature.shape)])
+    operations = [('upsert', {'PartitionKey': city, 'RowKey': _shape_row_key(row_key),
+                              'route_partition_key': partition_key, 'shape': shape,
+                              'buckets': ','.join(route_signature.buckets)})]
+    operations.extend(('upsert', {'PartitionKey': city, 'RowKey': f"{bucket}_{row_key}",
+                                  'route_partition_key': partition_key, 'route_row_key': row_key})
+                      for bucket in route_signature.buckets)
+    submit(table_client, operations)
+
+
+def attach_run(table_client, partition_key, row_key, match):
+    """Map a run to the (partition_key, row_key) of the route it was matched to."""
+    table_client.upsert_entity(entity={'PartitionKey': city_of(partition_key), 'RowKey': _alias_row_key(row_key),
+                                       'matched_partition_key': match[0], 'matched_row_key': match[1]})
+
+
+def resolve(table_client, partition_key, row_key):
+    """Return the (partition_key, row_key) of the route a run was attached to, the run itself otherwise."""
+    try:
+        entity = table_client.get_entity(partition_key=city_of(partition_key), row_key=_alias_row_key(row_key))
+    except core_exceptions.ResourceNotFoundError:
+        return partition_key, row_key
+    return entity['matched_partition_key'], entity['matched_row_key']
+
+
+async def resolve_async(table_client, partition_key, row_key):
+    """Like resolve with an aio TableClient."""
+    try:
+        entity = await table_client.get_entity(partition_key=city_of(partition_key), row_key=_alias_row_key(row_key))
+    except core_exceptions.ResourceNotFoundError:
+        return partition_key, row_key
+    return entity['matched_partition_key'], entity['matched_row_key']
+
+
+def _alias_query(partition_key, row_key):
+    # The aliases of the runs attached to a route, in the partition of its city
+    return ("PartitionKey eq @city and matched_row_key eq @row_key",
+            {'city': city_of(partition_key), 'row_key': row_key})
+
+
+def _index_row_keys(row_key, entity):
+    buckets = entity['buckets'].split(',') if entity.get('buckets') else []
+    return [_shape_row_key(row_key)] + [f"{bucket}_{row_key}" for bucket in buckets]
+
+
+def remove_route(table_client, partition_key, row_key):
+    """Delete the shape and bucket rows of a catalog route and the aliases of its runs."""
+    city = city_of(partition_key)
+    query_filter, parameters = _alias_query(partition_key, row_key)
+    row_keys = [alias['RowKey'] for alias in table_client.query_entities(query_filter, parameters=parameters,
+                                                                         select=['RowKey'])]
+    try:
+        entity = table_client.get_entity(partition_key=city, row_key=_shape_row_key(row_key))
+        row_keys.extend(_index_row_keys(row_key, entity))
+    except core_exceptions.ResourceNotFoundError:
+        pass
+    # All the rows share the partition of the city, one transaction per 100 rows
+    submit(table_client, delete_operations(city, row_keys))
+
+
+async def remove_route_async(table_client, partition_key, row_key):
+    """Like remove_route with an aio TableClient."""
+    city = city_of(partition_key)
+    query_filter, parameters = _alias_query(partition_key, row_key)
+    row_keys = [alias['RowKey'] async for alias in table_client.query_entities(query_filter, parameters=parameters,
+                                                                               select=['RowKey'])]
+    try:
+        entity = await table_client.get_entity(partition_key=city, row_key=_shape_row_key(row_key))
+        row_keys.extend(_index_row_keys(row_key, entity))
+    except core_exceptions.ResourceNotFoundError:
+        pass
+    await submit_async(table_client, delete_operations(city, row_keys))
+
+
+def move_route(table_client, partition_key, row_key, new_partition_key):
+    """Point the rows of a route and the aliases of the runs attached to it to its new partition.
+
+    The rows stay in the partition of the city, which a route keeps when it is moved.
+    """
+    city = city_of(partition_key)
+    operations = []
+    try:
+        entity = table_client.get_entity(partition_key=city, row_key=_shape_row_key(row_key))
+        operations.extend(('upsert', {'PartitionKey': city, 'RowKey': index_row_key,
+                                      'route_partition_key': new_partition_key})
+                          for index_row_key in _index_row_keys(row_key, entity))
+    except core_exceptions.ResourceNotFoundError:
+        pass
+    query_filter, parameters = _alias_query(partition_key, row_key)
+    aliases = table_client.query_entities(query_filter, parameters=parameters, select=['RowKey'])
+    operations.extend(('upsert', {'PartitionKey': city, 'RowKey': alias['RowKey'],
+                                  'matched_partition_key': new_partition_key}) for alias in aliases)
+    submit(table_client, operations)
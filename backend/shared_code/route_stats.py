@@ -0,0 +1,97 @@
+"""Summary statistics of a finished route, stored on its route entity.
+
+GetRoutes sorts and filters the routes on these properties, so it never has to
+read coordinates for it. The bounding box is stored by the geospatial index and
+can be sorted and filtered on too.
+"""
+import math
+import re
+
+from shared_code.geo import EARTH_RADIUS_METERS
+from shared_code.gps_filter import SAMPLE_INTERVAL_SECONDS
+
+DISTANCE = 'distance_meters'
+POINT_COUNT = 'point_count'
+DURATION = 'duration_seconds'
+PACE = 'pace_seconds_per_km'
+# Stored by geo_index.bbox_properties when the route is finished
+BBOX_FIELDS = ('bbox_min_latitude', 'bbox_min_longitude', 'bbox_max_latitude', 'bbox_max_longitude')
+STAT_FIELDS = (DISTANCE, POINT_COUNT, DURATION, PACE) + BBOX_FIELDS
+# Stored as Int32, Table queries only match values of the same type
+INT_FIELDS = (POINT_COUNT,)
+
+FILTER_OPERATORS = ('eq', 'gt', 'ge', 'lt', 'le')
+# Every condition takes one of the 15 comparisons a Table query allows
+MAX_FILTER_CONDITIONS = 4
+_FILTER_PATTERN = re.compile(r'^\s*(\w+)\s+(\w+)\s+(-?[\d.]+)\s*$')
+
+
+def route_stats(track):
+    """Return the statistics properties of the (index, latitude, longitude, timestamp) points of a track.
+
+    Everything is computed in one pass over the track. Without timestamps on the
+    points, the duration is taken from their indexes, sent every SAMPLE_INTERVAL_SECONDS.
+    """
+    distance = 0.0
+    first_timestamp = last_timestamp = None
+    previous = None
+    for _, latitude, longitude, timestamp in track:
+        phi = math.radians(latitude)
+        lam = math.radians(longitude)
+        cos_phi = math.cos(phi)
+        if previous is not None:
+            # Haversine, with the cosine of the previous point reused
+            previous_phi, previous_lam, previous_cos_phi = previous
+            a = (math.sin((phi - previous_phi) / 2) ** 2
+                 + previous_cos_phi * cos_phi * math.sin((lam - previous_lam) / 2) ** 2)
+            distance += 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0)))
+        previous = (phi, lam, cos_phi)
+        if timestamp is not None:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            last_timestamp = timestamp
+
+    duration = None
+    pace = None
+    if first_timestamp is not None and last_timestamp > first_timestamp:
+        duration = (last_timestamp - first_timestamp) / 1000
+    elif len(track) > 1:
+        duration = float((track[-1][0] - track[0][0]) * SAMPLE_INTERVAL_SECONDS)
+    if duration and distance > 0:
+        pace = duration / (distance / 1000)
+    return {DISTANCE: distance, POINT_COUNT: len(track), DURATION: duration, PACE: pace}
+
+
+def parse_sort(value):
+    """Parse a sort=[-]field parameter into (field, descending), None when missing, raise ValueError if invalid."""
+    if not value:
+        return None
+    field = value.lstrip('-')
+    if field not in STAT_FIELDS:
+        raise ValueError(f"sort must be one of {', '.join(STAT_FIELDS)}, with - for descending order.")
+    return field, value.startswith('-')
+
+
+def parse_filter(value):
+    """Parse a filter=field op value[,field op value..] parameter into a Table query filter and its parameters.
+
+    Returns None when missing, raises ValueError if invalid.
+    """
+    if not value:
+        return None
+    if len(value.split(',')) > MAX_FILTER_CONDITIONS:
+        raise ValueError(f"filter allows at most {MAX_FILTER_CONDITIONS} conditions.")
+    conditions = []
+    parameters = {}
+    for i, condition in enumerate(value.split(',')):
+        match = _FILTER_PATTERN.match(condition)
+        if not match or match.group(1) not in STAT_FIELDS or match.group(2) not in FILTER_OPERATORS:
+            raise ValueError(f"filter must be comma separated 'field op number' conditions, with a field of "
+                             f"{', '.join(STAT_FIELDS)} and an op of {', '.join(FILTER_OPERATORS)}.")
+        field_type = int if match.group(1) in INT_FIELDS else float
+        try:
+            parameters[f"stat{i}"] = field_type(match.group(3))
+        except ValueError:
+            raise ValueError(f"filter value {match.group(3)} of {match.group(1)} is not a valid {field_type.__name__}.")
+        conditions.append(f"{match.group(1)} {match.group(2)} @stat{i}")
+    return " and ".join(conditions), parameters
@@ -0,0 +1,212 @@
+import logging
+
+from shared_code.bootstrap import azure_core, core_exceptions, data_tables
+from shared_code.route_codec import (decode_points, decode_ranges, encode_points, encode_ranges, merge_points,
+                                    parse_wide_entity)
+from shared_code.transactions import delete_operations, submit, submit_async
+
+# Property holding the packed track of a chunk row
+TRACK_PROPERTY = 'Track'
+# Property listing the point indexes a chunk received when its points are filtered,
+# the stored ones and the ones filtered out, see shared_code.gps_filter
+RECEIVED_PROPERTY = 'Received'
+# Property holding the state the point filter continues from, written with RECEIVED_PROPERTY
+FILTER_STATE_PROPERTY = 'FilterState'
+# Points per chunk row, keeps a packed chunk far below the 64KB binary property limit
+CHUNK_SIZE = 2048
+# Chunk n > 0 of a route is stored in row '<row_key>~<n>', chunk 0 in the route row itself
+CHUNK_SEPARATOR = '~'
+WRITE_RETRIES = 3
+
+
+def chunk_row_key(row_key, chunk):
+    if chunk == 0:
+        return row_key
+    return f"{row_key}{CHUNK_SEPARATOR}{chunk:05d}"
+
+
+def route_row_key(chunk_row):
+    """Return the route RowKey a chunk row belongs to."""
+    return chunk_row.split(CHUNK_SEPARATOR, 1)[0]
+
+
+def decode_entity(entity):
+    """Return the points stored in a track entity, in either the packed or the legacy wide format."""
+    packed = decode_points(entity.get(TRACK_PROPERTY))
+    wide = parse_wide_entity(entity)
+    if wide:
+        return merge_points(wide, packed)
+    return packed
+
+
+def received_indexes(entity):
+    """Return the indexes of the points a track entity received, stored or filtered out."""
+    if entity.get(RECEIVED_PROPERTY) is not None:
+        return decode_ranges(entity[RECEIVED_PROPERTY])
+    return {point[0] for point in decode_entity(entity)}
+
+
+def group_tracks(entities):
+    """Group the chunk rows of a partition query into one sorted track per route RowKey."""
+    chunks = {}
+    for entity in entities:
+        chunks.setdefault(route_row_key(entity['RowKey']), []).append(decode_entity(entity))
+    return {row_key: merge_points(*route_chunks) for row_key, route_chunks in chunks.items()}
+
+
+def append_points(table_client, partition_key, row_key, points, point_filter=None):
+    """Merge points into the packed track of a route.
+
+    Points are grouped by chunk and every touched chunk is rewritten with one
+    conditional write, so concurrent writers of the same chunk never lose points.
+    Legacy wide properties found in a chunk are folded into the packed track.
+    Returns the points whose index was not stored yet, so retried requests can be
+    told apart from new points.
+
+    With a point_filter(new_points, previous_points, state) -> (kept_points, state) only
+    the new points it keeps are stored, and the chunk records every index it received
+    so a retried request does not store the points filtered out the first time. The
+    state is stored with the chunk and passed to the next call. The previous points and
+    state of the first points of a chunk are read from the chunk before it.
+    """
+    by_chunk = {}
+    for point in points:
+        by_chunk.setdefault(point[0] // CHUNK_SIZE, []).append(point)
+
+    new_points = []
+    for chunk, chunk_points in by_chunk.items():
+        previous_chunk = chunk_row_key(row_key, chunk - 1) if chunk else None
+        new_points.extend(_write_chunk(table_client, partition_key, chunk_row_key(row_key, chunk), chunk_points,
+                                       point_filter, previous_chunk))
+    return new_points
+
+
+def _read_previous_chunk(table_client, partition_key, row_key):
+    # The stored points and filter state of the chunk before, which only grows from now on
+    if row_key is None:
+        return [], None
+    try:
+        entity = table_client.get_entity(partition_key=partition_key, row_key=row_key)
+    except core_exceptions.ResourceNotFoundError:
+        return [], None
+    return decode_entity(entity)[-2:], entity.get(FILTER_STATE_PROPERTY)
+
+
+def _write_chunk(table_client, partition_key, row_key, points, point_filter=None, previous_chunk=None):
+    points = merge_points(points)
+    previous_chunk_points = None
+    for attempt in range(WRITE_RETRIES):
+        try:
+            entity = table_client.get_entity(partition_key=partition_key, row_key=row_key)
+        except core_exceptions.ResourceNotFoundError:
+            entity = None
+
+        stored = decode_entity(entity) if entity is not None else []
+        received = received_indexes(entity) if entity is not None else set()
+        new_points = [point for point in points if point[0] not in received]
+        if not new_points:
+            return []
+        kept = new_points
+        state = None
+        if point_filter is not None:
+            # The filter continues from the stored points before the batch, in the chunk before
+            # when there are none in this one yet
+            previous = [point for point in stored if point[0] < new_points[0][0]]
+            state = entity.get(FILTER_STATE_PROPERTY) if entity is not None else None
+            if not previous:
+                if previous_chunk_points is None:
+                    previous_chunk_points, previous_state = _read_previous_chunk(table_client, partition_key,
+                                                                                 previous_chunk)
+                previous = previous_chunk_points
+                state = state or previous_state
+            kept, state = point_filter(new_points, previous, state)
+
+        try:
+            if entity is None:
+                new_entity = {'PartitionKey': partition_key, 'RowKey': row_key}
+            else:
+                # Replacing the entity also drops legacy wide properties that were migrated
+                new_entity = {key: value for key, value in entity.items()
+                              if not key.startswith('Coord') and key != TRACK_PROPERTY}
+            new_entity[TRACK_PROPERTY] = encode_points(merge_points(stored, kept))
+            if point_filter is not None or RECEIVED_PROPERTY in new_entity:
+                new_entity[RECEIVED_PROPERTY] = encode_ranges(received | {point[0] for point in new_points})
+            if state is not None:
+                new_entity[FILTER_STATE_PROPERTY] = state
+
+            if entity is None:
+                table_client.create_entity(entity=new_entity)
+            else:
+                table_client.update_entity(entity=new_entity, mode=data_tables.UpdateMode.REPLACE,
+                                           etag=entity.metadata['etag'],
+                                           match_condition=azure_core.MatchConditions.IfNotModified)
+            return kept
+        except (core_exceptions.ResourceExistsError, core_exceptions.ResourceModifiedError):
+            logging.info(f"Concurrent write to track {partition_key}/{row_key}, retry {attempt + 1}")
+    raise RuntimeError(f"Could not write track {partition_key}/{row_key} after {WRITE_RETRIES} attempts")
+
+
+def migrate_table(table_client):
+    """Rewrite every legacy wide entity of a table into the packed format, return the number migrated."""
+    migrated = 0
+    for entity in table_client.list_entities():
+        if not any(key.startswith('Coord') for key in entity):
+            continue
+        points = decode_entity(entity)
+        by_chunk = {}
+        for point in points:
+            by_chunk.setdefault(point[0] // CHUNK_SIZE, []).append(point)
+        # Chunk 0 replaces the original row, later chunks are merged into their own rows
+        new_entity = {key: value for key, value in entity.items() if not key.startswith('Coord')}
+        new_entity[TRACK_PROPERTY] = encode_points(by_chunk.pop(0, []))
+        for chunk, chunk_points in by_chunk.items():
+            _write_chunk(table_client, entity['PartitionKey'], chunk_row_key(entity['RowKey'], chunk), chunk_points)
+        table_client.update_entity(entity=new_entity, mode=data_tables.UpdateMode.REPLACE,
+                                   etag=entity.metadata['etag'],
+                                   match_condition=azure_core.MatchConditions.IfNotModified)
+        migrated += 1
+    return migrated
+
+
+def _track_rows_query(partition_key, row_key):
+    return ("PartitionKey eq @partition_key and RowKey ge @first and RowKey lt @last",
+            {'partition_key': partition_key, 'first': row_key,
+             'last': f"{row_key}{CHUNK_SEPARATOR}{CHUNK_SEPARATOR}"})
+
+
+def query_track_rows(table_client, partition_key, row_key, **kwargs):
+    """Query every chunk row of a route track."""
+    query_filter, parameters = _track_rows_query(partition_key, row_key)
+    chunk_rows = table_client.query_entities(query_filter, parameters=parameters, **kwargs)
+    return [entity for entity in chunk_rows if route_row_key(entity['RowKey']) == row_key]
+
+
+async def query_track_rows_async(table_client, partition_key, row_key, **kwargs):
+    """Like query_track_rows with an aio TableClient."""
+    query_filter, parameters = _track_rows_query(partition_key, row_key)
+    chunk_rows = table_client.query_entities(query_filter, parameters=parameters, **kwargs)
+    return [entity async for entity in chunk_rows if route_row_key(entity['RowKey']) == row_key]
+
+
+def read_track(table_client, partition_key, row_key):
+    """Return the full sorted track of a route."""
+    return group_tracks(query_track_rows(table_client, partition_key, row_key)).get(row_key, [])
+
+
+def read_track_progress(table_client, partition_key, row_key):
+    """Return the full sorted track of a route and the number of points it received, filtered out ones included."""
+    chunk_rows = query_track_rows(table_client, partition_key, row_key)
+    received = sum(len(received_indexes(entity)) for entity in chunk_rows)
+    return group_tracks(chunk_rows).get(row_key, []), received
+
+
+def delete_track(table_client, partition_key, row_key):
+    """Delete every chunk row of a route track, in transactions of 100 rows."""
+    chunk_rows = query_track_rows(table_client, partition_key, row_key, select=['RowKey'])
+    submit(table_client, delete_operations(partition_key, [entity['RowKey'] for entity in chunk_rows]))
+
+
+async def delete_track_async(table_client, partition_key, row_key):
+    """Like delete_track with an aio TableClient."""
+    chunk_rows = await query_track_rows_async(table_client, partition_key, row_key, select=['RowKey'])
+    await submit_async(table_client, delete_operations(partition_key, [entity['RowKey'] for entity in chunk_rows]))
@@ -0,0 +1,94 @@
+"""Douglas-Peucker simplification of route tracks into levels of detail.
+
+The levels are computed once when a route is finished and stored as packed
+tracks on the route entity, so list views never have to load the raw track.
+"""
+import math
+
+from shared_code.route_codec import decode_points, encode_points
+
+EARTH_RADIUS_METERS = 6371e3
+
+# Tolerance in meters of every level of detail, from the finest to the coarsest
+LEVELS_OF_DETAIL = {
+    'high': 5.0,
+    'medium': 20.0,
+    'low': 80.0,
+}
+DEFAULT_DETAIL = 'high'
+
+
+def lod_property(detail):
+    return f"Lod_{detail}"
+
+
+def detail_for_zoom(zoom):
+    """Return the level of detail matching a map zoom level."""
+    if zoom >= 15:
+        return 'high'
+    if zoom >= 12:
+        return 'medium'
+    return 'low'
+
+
+def _project(track):
+    # Local equirectangular projection in meters around the first point, good enough at route scale
+    ref_lat = math.radians(track[0][1])
+    cos_lat = math.cos(ref_lat)
+    return [(math.radians(lon) * EARTH_RADIUS_METERS * cos_lat, math.radians(lat) * EARTH_RADIUS_METERS)
+            for _, lat, lon, _ in track]
+
+
+def _segment_distance(point, start, end):
+    px, py = point
+    sx, sy = start
+    ex, ey = end
+    dx, dy = ex - sx, ey - sy
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(px - sx, py - sy)
+    t = max(0.0, min(1.0, ((px - sx) * dx + (py - sy) * dy) / length_sq))
+    return math.hypot(px - sx - t * dx, py - sy - t * dy)
+
+
+def simplify(track, tolerance):
+    """Return the points of track kept by Douglas-Peucker with a tolerance in meters."""
+    if len(track) < 3:
+        return list(track)
+    projected = _project(track)
+    keep = [False] * len(track)
+    keep[0] = keep[-1] = True
+    # Iterative version, long tracks would exceed the recursion limit
+    stack = [(0, len(track) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_distance = 0.0
+        max_index = first
+        for i in range(first + 1, last):
+            distance = _segment_distance(projected[i], projected[first], projected[last])
+            if distance > max_distance:
+                max_distance = distance
+                max_index = i
+        if max_distance > tolerance:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return [point for point, kept in zip(track, keep) if kept]
+
+
+def build_levels_of_detail(track):
+    """Return the route entity properties holding every level of detail of a track."""
+    properties = {}
+    for detail, tolerance in LEVELS_OF_DETAIL.items():
+        # Coarser levels are simplified from the finer ones, which is cheaper and nests the levels
+        track = simplify(track, tolerance)
+        properties[lod_property(detail)] = encode_points(track)
+    return properties
+
+
+def get_level_of_detail(entity, detail):
+    """Return the stored level of detail of a route entity, or None if it was not computed."""
+    packed = entity.get(lod_property(detail))
+    if packed is None:
+        return None
+    return decode_points(packed)
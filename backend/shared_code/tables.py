@@ -0,0 +1,124 @@
+import os
+import threading
+
+from shared_code import bootstrap
+from shared_code.instrumentation import client_hooks
+
+CONNECTION_STRING = os.getenv('AzureWebJobsStorage')
+
+# Where the tables are stored: Azure Table storage, or the local stand-ins of
+# shared_code.local_storage for development and the benchmarks
+BACKEND_AZURE = 'azure'
+BACKEND_MEMORY = 'memory'
+BACKEND_SQLITE = 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', BACKEND_AZURE)
+SQLITE_PATH = os.getenv('STORAGE_SQLITE_PATH', 'runtracker.db')
+# The local backends need no connection string
+STORAGE_CONFIGURED = STORAGE_BACKEND != BACKEND_AZURE or bool(CONNECTION_STRING)
+
+# Table names used across the functions
+ROUTES_TABLE = 'RoutesCordinations'
+COORDINATES_TABLE = 'AllRouteCoordinations'
+# Unfiltered tracks of the routes sent with keep_raw, see shared_code.gps_filter
+RAW_COORDINATES_TABLE = 'RawRouteCoordinations'
+METADATA_TABLE = 'RoutesMetadata'
+PERSONAL_METADATA_TABLE = 'RoutePersonalMetadata'
+# The users with personal metadata on a route, partitioned by the route RowKey
+ROUTE_USERS_TABLE = 'RouteUsers'
+HEAT_MAP_TABLE = 'HeatMapTable'
+HEAT_MAP_GRID_TABLE = 'HeatMapGrid'
+ROUTE_GEO_INDEX_TABLE = 'RouteGeoIndex'
+ROUTE_CHANGES_TABLE = 'RouteChanges'
+ROUTE_RATINGS_TABLE = 'RouteRatings'
+ROUTE_PARTITIONS_TABLE = 'RoutePartitions'
+ROUTE_MATCH_TABLE = 'RouteMatchIndex'
+ROUTE_EVENTS_TABLE = 'RouteEvents'
+AUTHENTICATION_TABLE = 'AuthenticationTable'
+ALL_TABLES = (ROUTES_TABLE, COORDINATES_TABLE, RAW_COORDINATES_TABLE, METADATA_TABLE, PERSONAL_METADATA_TABLE,
+              ROUTE_USERS_TABLE, HEAT_MAP_TABLE, HEAT_MAP_GRID_TABLE, ROUTE_GEO_INDEX_TABLE, ROUTE_CHANGES_TABLE,
+              ROUTE_RATINGS_TABLE, ROUTE_PARTITIONS_TABLE, ROUTE_MATCH_TABLE, ROUTE_EVENTS_TABLE, AUTHENTICATION_TABLE)
+
+# Size of the keep-alive connection pool shared by all table clients of the worker
+POOL_SIZE = int(os.getenv('TABLES_POOL_SIZE', '16'))
+
+_lock = threading.RLock()
+_service_client = None
+_table_clients = {}
+_async_service_client = None
+_async_table_clients = {}
+
+
+def _create_service_client():
+    # The SDK is imported on first use, see shared_code.bootstrap
+    import requests
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.data.tables import TableServiceClient
+
+    # One requests session per worker keeps TLS connections alive between invocations
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    transport = RequestsTransport(session=session, session_owner=False)
+    return TableServiceClient.from_connection_string(CONNECTION_STRING, transport=transport, **client_hooks())
+
+
+def get_service_client():
+    """Return the TableServiceClient shared by all invocations of this worker process."""
+    global _service_client
+    if _service_client is None:
+        with _lock:
+            if _service_client is None:
+                _service_client = _create_service_client()
+    return _service_client
+
+
+def _create_local_table_client(table_name, aio=False):
+    from shared_code import local_storage
+    store = local_storage.get_store(STORAGE_BACKEND, SQLITE_PATH)
+    if aio:
+        return local_storage.AsyncLocalTableClient(store, table_name)
+    return local_storage.LocalTableClient(store, table_name)
+
+
+def get_table_client(table_name):
+    """Return a cached TableClient for table_name that reuses the shared connection pool."""
+    table_client = _table_clients.get(table_name)
+    if table_client is None:
+        with _lock:
+            table_client = _table_clients.get(table_name)
+            if table_client is None:
+                if STORAGE_BACKEND == BACKEND_AZURE:
+                    table_client = get_service_client().get_table_client(table_name)
+                else:
+                    table_client = _create_local_table_client(table_name)
+                _table_clients[table_name] = table_client
+    return table_client
+
+
+def get_async_table_client(table_name):
+    """Return a cached aio TableClient for table_name.
+
+    The aio clients share one aiohttp session, opened on the first request in the
+    event loop of the worker, which runs every async function invocation.
+    """
+    global _async_service_client
+    table_client = _async_table_clients.get(table_name)
+    if table_client is None:
+        with _lock:
+            if STORAGE_BACKEND == BACKEND_AZURE and _async_service_client is None:
+                from azure.data.tables.aio import TableServiceClient as AsyncTableServiceClient
+                _async_service_client = AsyncTableServiceClient.from_connection_string(CONNECTION_STRING,
+                                                                                      **client_hooks())
+            table_client = _async_table_clients.get(table_name)
+            if table_client is None:
+                if STORAGE_BACKEND == BACKEND_AZURE:
+                    table_client = _async_service_client.get_table_client(table_name)
+                else:
+                    table_client = _create_local_table_client(table_name, aio=True)
+                _async_table_clients[table_name] = table_client
+    return table_client
+
+
+# Build the clients of the worker while the host is still starting
+bootstrap.preload()
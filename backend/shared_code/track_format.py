@@ -0,0 +1,58 @@
+"""Wire formats of the coordinates of a track, selected with the coords query parameter.
+
+objects  [{"latitude": .., "longitude": ..}, ..], the default the app reads
+columns  {"latitude": [..], "longitude": [..]}, parallel arrays without repeated keys
+polyline "..", the Google encoded polyline of the track at 1e-5 degrees
+"""
+OBJECTS = 'objects'
+COLUMNS = 'columns'
+POLYLINE = 'polyline'
+FORMATS = (OBJECTS, COLUMNS, POLYLINE)
+POLYLINE_SCALE = 1e5
+
+
+def get_format(params, formats=FORMATS):
+    """Return the requested coordinates format, raise ValueError if it is not one of formats."""
+    coords = params.get('coords') or OBJECTS
+    if coords not in formats:
+        raise ValueError(f"coords must be one of {', '.join(formats)}.")
+    return coords
+
+
+def encode_polyline(track):
+    """Encode the (index, latitude, longitude, timestamp) points of a track as a polyline."""
+    chunks = []
+    previous_latitude = previous_longitude = 0
+    for _, latitude, longitude, _ in track:
+        latitude = int(round(latitude * POLYLINE_SCALE))
+        longitude = int(round(longitude * POLYLINE_SCALE))
+        for delta in (latitude - previous_latitude, longitude - previous_longitude):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        previous_latitude, previous_longitude = latitude, longitude
+    return ''.join(chunks)
+
+
+def format_track(track, coords, timestamps=False):
+    """Return the coordinates of a track in a format, with the timestamps of the points if asked.
+
+    The polyline format has no room for timestamps, use format_timestamps alongside it.
+    """
+    if coords == COLUMNS:
+        columns = {"latitude": [point[1] for point in track], "longitude": [point[2] for point in track]}
+        if timestamps:
+            columns["timestamp"] = [point[3] for point in track]
+        return columns
+    if coords == POLYLINE:
+        return encode_polyline(track)
+    if timestamps:
+        return [{"latitude": latitude, "longitude": longitude, "timestamp": timestamp}
+                for _, latitude, longitude, timestamp in track]
+    return [{"latitude": latitude, "longitude": longitude} for _, latitude, longitude, _ in track]
+
+
+def format_timestamps(track):
+    return [point[3] for point in track]
@@ -0,0 +1,68 @@
+"""Entity-group transactions of the rows a route write or removal touches in one table.
+
+A transaction holds up to 100 operations on a single partition, so the rows of a
+route are written or deleted in one round trip per partition instead of one per row.
+"""
+import logging
+
+from shared_code.bootstrap import core_exceptions, data_tables
+from shared_code.concurrency import gather_bounded
+
+MAX_BATCH_OPERATIONS = 100
+
+
+def delete_operations(partition_key, row_keys):
+    return [('delete', {'PartitionKey': partition_key, 'RowKey': row_key}) for row_key in row_keys]
+
+
+def batches(operations):
+    """Split (operation, entity[, options]) tuples into same-partition batches of at most 100."""
+    by_partition = {}
+    for operation in operations:
+        by_partition.setdefault(operation[1]['PartitionKey'], []).append(operation)
+    for partition_operations in by_partition.values():
+        for start in range(0, len(partition_operations), MAX_BATCH_OPERATIONS):
+            yield partition_operations[start:start + MAX_BATCH_OPERATIONS]
+
+
+def _deletes_only(batch):
+    return all(operation[0] == 'delete' for operation in batch)
+
+
+def submit(table_client, operations):
+    """Submit operations as transactions, one per partition and 100 operations.
+
+    A batch of deletes fails as a whole when one of its rows is already gone, its
+    rows are then deleted one by one so the others are still removed.
+    """
+    for batch in batches(operations):
+        try:
+            table_client.submit_transaction(batch)
+        except data_tables.TableTransactionError as e:
+            if not _deletes_only(batch):
+                raise
+            logging.info(f"Transaction of {len(batch)} deletes failed, deleting one by one: {e}")
+            for _, entity in batch:
+                try:
+                    table_client.delete_entity(partition_key=entity['PartitionKey'], row_key=entity['RowKey'])
+                except core_exceptions.ResourceNotFoundError:
+                    pass
+
+
+async def submit_async(table_client, operations):
+    """Like submit with an aio TableClient, the batches are submitted concurrently."""
+    await gather_bounded(*(_submit_batch_async(table_client, batch) for batch in batches(operations)))
+
+
+async def _submit_batch_async(table_client, batch):
+    try:
+        await table_client.submit_transaction(batch)
+    except data_tables.TableTransactionError as e:
+        if not _deletes_only(batch):
+            raise
+        logging.info(f"Transaction of {len(batch)} deletes failed, deleting one by one: {e}")
+        for _, entity in batch:
+            try:
+                await table_client.delete_entity(partition_key=entity['PartitionKey'], row_key=entity['RowKey'])
+            except core_exceptions.ResourceNotFoundError:
+                pass
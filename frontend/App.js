@@ -11,6 +11,7 @@ import UpdateRouteScreen from './screens/UpdateRouteScreen';
 import TimerScreen from './screens/TimerScreen';
 import NameRouteScreen from "./screens/NameRouteScreen";
 import RouteTimerScreen from './screens/RouteTimerScreen';
+import { LiveUpdatesContext } from './LiveUpdates';
 
 const Stack = createStackNavigator();
 
@@ -39,19 +40,26 @@ export default function App() {
     };
 
     startConnection();
+
+    return () => {
+      signalrConnection.stop();
+    };
   }, []);
 
+  // The screens register their handlers of the hub messages on the connection
   return (
-    <NavigationContainer>
-      <Stack.Navigator initialRouteName="Login">
-        <Stack.Screen name="Login" component={LoginScreen} options={{ headerShown: false }} />
-        <Stack.Screen name="Home" component={HomeScreen} />
-        <Stack.Screen name="RouteDetails" component={RouteDetailsScreen} />
-        <Stack.Screen name="UpdateRoute" component={UpdateRouteScreen} />
-        <Stack.Screen name="Timer" component={TimerScreen} />
-        <Stack.Screen name="NameRoute" component={NameRouteScreen} />
-        <Stack.Screen name="RouteTimer" component={RouteTimerScreen} />
-      </Stack.Navigator>
-    </NavigationContainer>
+    <LiveUpdatesContext.Provider value={connection}>
+      <NavigationContainer>
+        <Stack.Navigator initialRouteName="Login">
+          <Stack.Screen name="Login" component={LoginScreen} options={{ headerShown: false }} />
+          <Stack.Screen name="Home" component={HomeScreen} />
+          <Stack.Screen name="RouteDetails" component={RouteDetailsScreen} />
+          <Stack.Screen name="UpdateRoute" component={UpdateRouteScreen} />
+          <Stack.Screen name="Timer" component={TimerScreen} />
+          <Stack.Screen name="NameRoute" component={NameRouteScreen} />
+          <Stack.Screen name="RouteTimer" component={RouteTimerScreen} />
+        </Stack.Navigator>
+      </NavigationContainer>
+    </LiveUpdatesContext.Provider>
   );
 }
\ No newline at end of file
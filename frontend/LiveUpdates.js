@@ -0,0 +1,6 @@
+import { createContext } from 'react';
+
+// The SignalR connection of the app, null until it is connected.
+// The backend sends routesChanged {partition_key, changed, deleted, watermark}
+// and heatMapChanged {watermark} when routes or the heat map change.
+export const LiveUpdatesContext = createContext(null);
@@ -1,10 +1,11 @@
-import React, { useState, useEffect, useCallback } from 'react';
+import React, { useState, useEffect, useCallback, useRef, useContext } from 'react';
 import { View, TextInput, StyleSheet, ActivityIndicator, TouchableOpacity, Text, Platform } from 'react-native';
 import MapView, { Marker, Circle, Polyline, Callout } from 'react-native-maps';
 import * as Location from 'expo-location';
 import { useFocusEffect } from '@react-navigation/native';
 import { Heatmap } from 'react-native-maps';
 import { Ionicons } from '@expo/vector-icons';
+import { LiveUpdatesContext } from '../LiveUpdates';
 
 const HomeScreen = ({ navigation, route }) => {
     const [location, setLocation] = useState(null);
@@ -16,9 +17,72 @@ const HomeScreen = ({ navigation, route }) => {
     const [heatCoords, setHeatCoords] = useState([]);
     const [locationWatcher, setLocationWatcher] = useState(null);
     const [showHeatmap, setShowHeatmap] = useState(false);
+    const regionRef = useRef(null);
+    const showHeatmapRef = useRef(false);
+    const routesRef = useRef([]);
+    const watermarkRef = useRef(null);
+    const syncQueueRef = useRef(Promise.resolve());
+    const connection = useContext(LiveUpdatesContext);
 
     const { userName, superUser } = route.params;
 
+    // The route fields the screens use, from a GetRoutes item
+    const toRoute = (route) => ({
+        start: route.start,
+        end: route.end,
+        data: route.data,
+        steepness: route.steepness,
+        shadow: route.shadow,
+        activity_type: route.activity_type,
+        score: route.score,
+        water_dispenser: route.water_dispensers,
+        difficulty: route.difficulty,
+        view_rating: route.view,
+        wind_level: route.wind,
+        length: route.length,
+        route_name: route.name,
+        partition_key: route.partition_key,
+        row_key: route.row_key,
+        high_score: route.high_score,
+        liked: route.liked,
+        run_count: route.run_count,
+        last_run_date: route.last_run_date,
+        super_user: superUser,
+        user_name: userName
+    });
+
+    // Delta sync of the routes: GetRoutes with since returns the routes changed after the
+    // watermark and the RowKeys of the removed ones, or every route when full is set.
+    // The first sync sends since=0, which the backend answers with a full sync.
+    const syncRoutes = async () => {
+        const since = watermarkRef.current || '0';
+        const response = await fetch(`https://assignment1-sophie-miki-omer.azurewebsites.net/api/GetRoutes?user_name=${userName}&since=${since}`, {
+            method: 'GET',
+        });
+        if (!response.ok) {
+            return;
+        }
+        const data = await response.json();
+        const changed = data.routes.filter(route => route.end && route.end.latitude).map(toRoute);
+        const changedKeys = new Set(data.routes.map(route => route.row_key));
+        const deletedKeys = new Set(data.deleted || []);
+        const kept = data.full ? [] : routesRef.current.filter(route =>
+            !changedKeys.has(route.row_key) && !deletedKeys.has(route.row_key));
+        const newRoutes = [...kept, ...changed];
+        routesRef.current = newRoutes;
+        watermarkRef.current = data.watermark;
+        setRoutes(newRoutes);
+        setFilteredRoutes(newRoutes);
+    };
+
+    // Syncs run one after the other, so two of them never apply the same watermark
+    const queueSync = () => {
+        syncQueueRef.current = syncQueueRef.current
+            .then(syncRoutes)
+            .catch(error => console.log(error));
+        return syncQueueRef.current;
+    };
+
     const fetchRoutes = async () => {
         setLoading(true);
         try {
@@ -32,41 +96,14 @@ const HomeScreen = ({ navigation, route }) => {
             let location = await Location.getCurrentPositionAsync({});
             setLocation(location.coords);
 
-            const response = await fetch(`https://assignment1-sophie-miki-omer.azurewebsites.net/api/GetRoutes?user_name=${userName}`, {
-                method: 'GET',
-            });
-            const data = await response.json();
-            const newRoutes = data.filter(route => route.end && route.end.latitude).map(route => ({
-                start: route.start,
-                end: route.end,
-                data: route.data,
-                steepness: route.steepness,
-                shadow: route.shadow,
-                activity_type: route.activity_type,
-                score: route.score,
-                water_dispenser: route.water_dispensers,
-                difficulty: route.difficulty,
-                view_rating: route.view,
-                wind_level: route.wind,
-                length: route.length,
-                route_name: route.name,
-                partition_key: route.partition_key,
-                row_key: route.row_key,
-                high_score: route.high_score,
-                liked: route.liked,
-                run_count: route.run_count,
-                last_run_date: route.last_run_date,
-                super_user: superUser,
-                user_name: userName
-            }));
-            setRoutes(newRoutes);
-            setFilteredRoutes(newRoutes);
+            await queueSync();
 
-            const heatResponse = await fetch(`https://assignment1-sophie-miki-omer.azurewebsites.net/api/GetHeatMap`, {
-                method: 'GET',
+            await fetchHeatMap(regionRef.current || {
+                latitude: location.coords.latitude,
+                longitude: location.coords.longitude,
+                latitudeDelta: 0.0922,
+                longitudeDelta: 0.0421,
             });
-            let heatData = await heatResponse.json();
-            setHeatCoords(heatData);
         } catch (error) {
             console.log(error);
         } finally {
@@ -74,14 +111,71 @@ const HomeScreen = ({ navigation, route }) => {
         }
     };
 
+    // The heat map grid cells of a map region, weighted by their number of points
+    const fetchHeatMap = async (region) => {
+        const bbox = [
+            Math.max(region.latitude - region.latitudeDelta / 2, -90),
+            Math.max(region.longitude - region.longitudeDelta / 2, -180),
+            Math.min(region.latitude + region.latitudeDelta / 2, 90),
+            Math.min(region.longitude + region.longitudeDelta / 2, 180),
+        ].join(',');
+        const zoom = Math.round(Math.log2(360 / region.longitudeDelta));
+        const heatResponse = await fetch(`https://assignment1-sophie-miki-omer.azurewebsites.net/api/GetHeatMap?bbox=${bbox}&zoom=${zoom}`, {
+            method: 'GET',
+        });
+        if (heatResponse.ok) {
+            setHeatCoords(await heatResponse.json());
+        }
+    };
+
+    const handleRegionChange = (region) => {
+        regionRef.current = region;
+        if (showHeatmap) {
+            fetchHeatMap(region).catch(error => console.log(error));
+        }
+    };
+
     useEffect(() => {
         fetchRoutes();
     }, []);
 
+    // The hub tells when routes or the heat map change, only then they are read again
+    useEffect(() => {
+        if (!connection) {
+            return;
+        }
+        // The delta sync reads every partition, so the message only says when to run it
+        const handleRoutesChanged = () => {
+            queueSync();
+        };
+        const handleHeatMapChanged = () => {
+            if (showHeatmapRef.current && regionRef.current) {
+                fetchHeatMap(regionRef.current).catch(error => console.log(error));
+            }
+        };
+        // Messages sent while the connection was down are lost, catch up with a delta sync
+        const handleReconnected = () => {
+            queueSync();
+        };
+        connection.on('routesChanged', handleRoutesChanged);
+        connection.on('heatMapChanged', handleHeatMapChanged);
+        connection.onreconnected(handleReconnected);
+        // Changes made before the connection was started
+        queueSync();
+        return () => {
+            connection.off('routesChanged', handleRoutesChanged);
+            connection.off('heatMapChanged', handleHeatMapChanged);
+        };
+    }, [connection]);
+
+    // Without the hub the screen has no other way to learn about changes, so a focus
+    // runs a delta sync, which only returns the routes changed since the last one
     useFocusEffect(
         useCallback(() => {
-            fetchRoutes();
-        }, [])
+            if (!connection && watermarkRef.current) {
+                queueSync();
+            }
+        }, [connection])
     );
 
     useEffect(() => {
@@ -151,6 +245,10 @@ const HomeScreen = ({ navigation, route }) => {
 
     const toggleMapView = () => {
         // Todo: Disable for IOS
+        if (!showHeatmap && regionRef.current) {
+            fetchHeatMap(regionRef.current).catch(error => console.log(error));
+        }
+        showHeatmapRef.current = !showHeatmap;
         setShowHeatmap(prevState => !prevState);
     };
 
@@ -181,10 +279,11 @@ const HomeScreen = ({ navigation, route }) => {
                     latitudeDelta: 0.0922,
                     longitudeDelta: 0.0421,
                 }}
+                onRegionChangeComplete={handleRegionChange}
             >
                 {location && (showHeatmap ? (
                     <Heatmap
-                        points={(heatCoords.concat(routes)).flatMap(route => route.data)}
+                        points={heatCoords.flatMap(cells => cells.data)}
                         opacity={0.7}
                         radius={50}
                         gradient={{
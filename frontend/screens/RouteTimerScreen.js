@@ -52,6 +52,8 @@ const RouteTimerScreen = ({ navigation, route }) => {
                     user_name,
                     super_user,
                     index: currentIndexRef.current,
+                    // Not part of a recorded route, counted in the heat map
+                    standalone: true,
                     data: {
                         coordination: { latitude: latitude, longitude: longitude }
                     },
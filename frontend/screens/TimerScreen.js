@@ -9,12 +9,9 @@ const TimerScreen = ({ navigation, route }) => {
     const timerIntervalRef = useRef(null);
     const locationIntervalRef = useRef(null);
     const currentIndexRef = useRef(0);
-    const currentHeatIndexRef = useRef(0);
     const rowKeyRef = useRef(null);
-    const heatRowKeyRef = useRef(null);
     const finishState = useRef(false);
     const partitionKeyRef = useRef(null);
-    const heatPartitionKeyRef = useRef(null);
 
     useEffect(() => {
         return () => {
@@ -33,8 +30,8 @@ const TimerScreen = ({ navigation, route }) => {
         }, 1000);
 
         locationIntervalRef.current = setInterval(() => {
+            // CollectCoordination also feeds the heat map
             sendLocationData();
-            sendHeatMapLocation();
         }, 5000);
     };
 
@@ -82,54 +79,6 @@ const TimerScreen = ({ navigation, route }) => {
     };
 
 
-    const sendHeatMapLocation = async () => {
-        try {
-            let { status } = await Location.requestForegroundPermissionsAsync();
-            if (status !== 'granted') {
-                console.error('Location permission not granted');
-                return;
-            }
-
-            let location = await Location.getCurrentPositionAsync({});
-            const { latitude, longitude } = location.coords;
-
-            fetch(`https://assignment1-sophie-miki-omer.azurewebsites.net/api/CreateHeatMap`, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    user_name,
-                    super_user,
-                    index: currentHeatIndexRef.current,
-                    data: {
-                        coordination: { latitude: latitude, longitude: longitude }
-                    },
-                    row_key: heatRowKeyRef.current,
-                    partition_key: heatPartitionKeyRef.current
-                }),
-            }).then(response => {
-                if (response.status === 200) {
-                    response.json().then(data => {
-                        heatRowKeyRef.current = data["row_key"];
-                        heatPartitionKeyRef.current = data["partition_key"];
-                        currentHeatIndexRef.current = data["index"] + 1;
-                    });
-                }
-            }).catch(error => {
-                console.error('Error sending location:', error);
-                Alert.alert("Error sending location", error);
-                navigation.navigate('Home', {
-                    superUser: super_user,
-                    userName: user_name
-                })
-            });
-        } catch (error) {
-            console.error('Error getting location:', error);
-            Alert.alert("Error getting location", error);
-        }
-    };
-
     const sendLocationData = async () => {
         try {
             let { status } = await Location.requestForegroundPermissionsAsync();
@@ -149,6 +98,8 @@ const TimerScreen = ({ navigation, route }) => {
                     user_name,
                     super_user,
                     index: currentIndexRef.current,
+                    // Epoch milliseconds of the fix, for the duration and pace of the route
+                    timestamp: location.timestamp,
                     finish_status: finishState,
                     data: {
                         coordination: { latitude: latitude, longitude: longitude }
@@ -157,18 +108,26 @@ const TimerScreen = ({ navigation, route }) => {
                     partition_key: partitionKeyRef.current
                 }),
             }).then(response => {
-                if (response.status === 200) {
+                if (response.ok) {
+                    const finished = finishState.current;
+                    finishState.current = false;
                     response.json().then(data => {
                         rowKeyRef.current = data["row_key"];
                         partitionKeyRef.current = data["partition_key"];
                         currentIndexRef.current = data["index"] + 1; // Update currentIndexRef
-                    });
-                    if (finishState.current) {
-                        finishState.current = false;
-                        navigation.navigate("NameRoute", { super_user: super_user, user_name: user_name,
-                            partition_key: partitionKeyRef.current, row_key: rowKeyRef.current});
+                        if (!finished) {
+                            return;
+                        }
+                        if (data["matched_route"]) {
+                            // The run follows a route already on the map and was added to it, it keeps that name
+                            Alert.alert('Known route', 'This run follows an existing route, find it on the map to rate it');
+                            navigation.navigate("Home", { superUser: super_user, userName: user_name });
+                        } else {
+                            navigation.navigate("NameRoute", { super_user: super_user, user_name: user_name,
+                                partition_key: partitionKeyRef.current, row_key: rowKeyRef.current});
+                        }
                         resetTimer();
-                    }
+                    });
                 }
                 else {
                     console.error('Internal Error');